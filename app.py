@@ -1,16 +1,43 @@
-import pandas as pd
+from collections import OrderedDict
+
+import os
+import time
+
 import streamlit as st
-import numpy as np
-from io import BytesIO
-
-# ================== Cấu hình & Danh mục CT ==================
-PROGRAMS = {
-    "NMCD": "Nước mắm cao đạm",
-    "DHLM": "Dầu hào, Nước tương",
-    "KOS&XX": "Cá KOS & Xúc xích",
-    "GVIG": "Gia vị gói",
-    "LTLKC": "Lẩu Thái & Lẩu Kim chi",
-}
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from core import (
+    PROGRAMS,
+    BackgroundJob,
+    MonthExistsError,
+    UploadSpool,
+    build_filter_index,
+    compact_result,
+    enable_diagnostics_log,
+    evaluate_window,
+    export_consolidated,
+    export_excel_layout,
+    export_excel_months,
+    filter_mask,
+    frame_fingerprint,
+    key_match_report,
+    load_snapshot,
+    memory_bytes,
+    npp_summary,
+    save_snapshot,
+    slot_min_targets,
+    sort_order,
+    stage,
+    start_diagnostics,
+    stop_diagnostics,
+    sweep_upload_spools,
+    store_append_month,
+    store_months,
+    store_move_month,
+    visible_rows,
+    what_if_changes,
+    what_if_sweep,
+)
 
 st.set_page_config(page_title="Xử lý dữ liệu trưng bày", layout="wide")
 # ===== UI THEME / HEADER =====
@@ -74,298 +101,337 @@ with st.sidebar:
         "- Tính năng: Trưng bày · Doanh số · Trạng thái · Lọc · Xuất Excel"
     )
 
-# Chuẩn hoá tên sheet trong file Doanh số (tránh lệch như GVG, KOSXX)
-SHEET_NAME_ALIASES = {
-    "NMCD": "NMCD",
-    "DHLM": "DHLM",
-    "GVG": "GVIG",     # lưu GVG -> mình hiểu là GVIG
-    "GVIG": "GVIG",
-    "LTLKC": "LTLKC",
-    "KOSXX": "KOS&XX", # lưu KOSXX -> mình hiểu là KOS&XX
-    "KOS&XX": "KOS&XX",
-}
-# Mức tối thiểu / 1 suất theo CT (bạn đổi số ở đây nếu chính sách thay đổi)
-PER_SLOT_MIN = {
-    "NMCD": 150_000,  # Nước mắm cao đạm
-    "DHLM": 100_000,  # Dầu hào, Nước tương
-    "KOS&XX": 200_000,  # Cá KOS & Xúc xích
-    "GVIG": 300_000,  # Gia vị gói (Miền Trung/Bắc)
-    "LTLKC": 80_000,   # Lẩu Thái & Lẩu Kim chi
-}
-def _resolve_sheet_name(xls: pd.ExcelFile, program_code: str) -> str:
+# File đầu vào: Excel, hoặc CSV / Parquet xuất thẳng từ hệ thống nguồn (đọc nhanh hơn nhiều)
+INPUT_TYPES = ["xlsx", "csv", "parquet"]
+
+# ================== Cache file Excel xuất ==================
+# Giới hạn tổng dung lượng file Excel giữ lại trong 1 phiên (LRU, bỏ file cũ nhất trước)
+EXPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def _export_cache() -> OrderedDict:
+    return st.session_state.setdefault("__export_cache__", OrderedDict())
+
+def cached_export(key: tuple, build) -> bytes:
+    """Trả về file đã dựng theo key; chỉ gọi build() khi chưa có trong cache."""
+    cache = _export_cache()
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    data = build()
+    cache[key] = data
+    total = sum(len(v) for v in cache.values())
+    while total > EXPORT_CACHE_MAX_BYTES and len(cache) > 1:
+        _, old = cache.popitem(last=False)
+        total -= len(old)
+    return data
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def lazy_download_button(label: str, key: tuple, build, file_name: str, widget_key: str,
+                         kind: str = "EXCEL", mime: str = XLSX_MIME):
     """
-    Trả về tên sheet thực tế trong file doanh số tương ứng với program_code.
-    - Chấp nhận các alias: GVG~GVIG, KOSXX~KOS&XX
-    - Không phân biệt hoa/thường, bỏ khoảng trắng dư.
+    Nút tải file chỉ dựng file khi người dùng yêu cầu.
+    - Đã có trong cache -> hiện nút tải ngay.
+    - Chưa có -> hiện nút 'Tạo file', bấm mới dựng (rồi cache lại).
     """
-    # chuẩn hoá code được chọn
-    want = SHEET_NAME_ALIASES.get(program_code.strip().upper(), program_code.strip().upper())
-
-    # map sheet trong file -> dạng chuẩn để so
-    norm2real = {}
-    for s in xls.sheet_names:
-        norm = s.strip().upper()
-        norm = SHEET_NAME_ALIASES.get(norm, norm)  # đổi alias về tên chuẩn
-        norm2real[norm] = s  # lưu lại tên thật trong file
-
-    if want in norm2real:
-        return norm2real[want]
-
-    # fallback: thử so khớp gần đúng
-    for norm, real in norm2real.items():
-        if want in norm or norm in want:
-            return real
-
-    raise ValueError(
-        f"Không tìm thấy sheet cho chương trình '{program_code}'. "
-        f"Sheets có trong file: {', '.join(xls.sheet_names)}"
+    if key not in _export_cache():
+        if not st.button(f"📦 Tạo file – {label}", key=f"{widget_key}_build"):
+            return
+        with st.spinner(f"Đang tạo file {kind}..."):
+            cached_export(key, build)
+    st.download_button(
+        f"⬇️ Tải {kind} – {label}",
+        data=cached_export(key, build),
+        file_name=file_name,
+        mime=mime,
+        key=widget_key,
     )
 
-# ================== Helpers ==================
-BASE_COLS = ["Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng"]
-
-def read_display_excel(file) -> pd.DataFrame:
-    """Đọc file trưng bày từ hàng 3 (skiprows=2), giữ B,F,G,H,K,L,T (H=Giai đoạn)."""
-    df = pd.read_excel(file, usecols="B,F,G,H,K,L,T", skiprows=2, engine="openpyxl")
-    df.columns = [
-        "Mã CTTB","Mã NPP","Tên NPP","Giai đoạn",
-        "Mã khách hàng","Tên khách hàng","Số suất đăng ký"
-    ]
-    for c in ["Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng","Giai đoạn"]:
-        df[c] = df[c].astype(str).str.strip()
-    df = df[(df["Mã CTTB"]!="") & (df["Mã khách hàng"]!="") & (df["Giai đoạn"]!="")].copy()
-    df["Số suất đăng ký"] = pd.to_numeric(df["Số suất đăng ký"], errors="coerce").fillna(0).astype(int)
-    return df[["Giai đoạn"] + BASE_COLS + ["Số suất đăng ký"]]
-
-def extract_month_label(df: pd.DataFrame) -> str:
-    """Lấy nhãn tháng từ cột 'Giai đoạn' (giá trị phổ biến nhất)."""
-    vals = df["Giai đoạn"].dropna().astype(str).str.strip()
-    if vals.empty:
-        return "Tháng ?"
-    try:
-        return vals.mode().iloc[0]
-    except Exception:
-        return vals.iloc[0]
-
-def combine_two_months(d1: pd.DataFrame, d2: pd.DataFrame):
-    """Gộp 2 tháng theo key BASE_COLS. Trả về (out, m1, m2)."""
-    m1 = extract_month_label(d1)
-    m2 = extract_month_label(d2)
-
-    d1_slots = (d1.groupby(BASE_COLS, as_index=False)["Số suất đăng ký"]
-                  .sum().rename(columns={"Số suất đăng ký": f"Giai đoạn - {m1}"}))
-    d2_slots = (d2.groupby(BASE_COLS, as_index=False)["Số suất đăng ký"]
-                  .sum().rename(columns={"Số suất đăng ký": f"Giai đoạn - {m2}"}))
-
-    out = d1_slots.merge(d2_slots, on=BASE_COLS, how="outer").fillna(0)
-    out[f"Giai đoạn - {m1}"] = out[f"Giai đoạn - {m1}"].astype(int)
-    out[f"Giai đoạn - {m2}"] = out[f"Giai đoạn - {m2}"].astype(int)
-
-    out[f"Doanh số - {m1}"] = 0
-    out[f"Doanh số - {m2}"] = 0
-    out["TRẠNG THÁI"] = ""
-
-    cols = BASE_COLS + [f"Giai đoạn - {m1}", f"Giai đoạn - {m2}",
-                        f"Doanh số - {m1}", f"Doanh số - {m2}", "TRẠNG THÁI"]
-    out = out[cols].sort_values(["Mã NPP","Tên NPP","Tên khách hàng"]).reset_index(drop=True)
-    return out, m1, m2
-
-def read_sales_excel(file, program_sheet_name: str) -> pd.DataFrame:
+def store_result(prog: str, result, m1: str, m2: str):
+    """Lưu kết quả xử lý 1 CT vào session (dạng gọn, xem compact_result) để lọc / tải."""
+    result = compact_result(result)
+    st.session_state[f"__{prog}_data__"] = {
+        "df": result, "m1": m1, "m2": m2, "fp": frame_fingerprint(result),
+        "index": build_filter_index(result, [m1, m2]),  # dựng 1 lần, dùng cho mọi lần lọc
+        "summary": npp_summary(result, [m1, m2]),
+        "keys": key_match_report(result),
+    }
+
+def key_report_panel(report: dict):
+    """Báo cáo khớp mã KH giữa trưng bày & doanh số (key_match_report); tự mở khi có mã lệch."""
+    if not report:
+        return
+    months = report.get("months", {})
+    issues = report["ambiguous_keys"] or any(m["sales_unmatched"] for m in months.values())
+    with st.expander("🔑 Khớp mã khách hàng" + (" – có mã lệch" if issues else ""), expanded=bool(issues)):
+        st.caption(f"{report['rows']:,} dòng KH · {report['keys']:,} mã KH khác nhau")
+        if months:
+            st.dataframe([{
+                "Tháng": m,
+                "KH có doanh số": r["rows_matched"],
+                "KH không có doanh số": r["rows_unmatched"],
+                "Mã doanh số không có KH": r["sales_unmatched"],
+                "Doanh số không khớp": r["sales_unmatched_amount"],
+                "Ví dụ mã doanh số không khớp": ", ".join(r["sample_sales_unmatched"]),
+            } for m, r in months.items()], hide_index=True, use_container_width=True)
+        if report["ambiguous_keys"]:
+            st.warning(
+                f"{report['ambiguous_keys']:,} mã KH nằm ở {report['ambiguous_rows']:,} dòng (khác NPP / tên KH): "
+                "mỗi dòng đều nhận đủ doanh số của mã. Ví dụ: " + ", ".join(report["sample_ambiguous"]))
+
+WHAT_IF_MAX_STEPS = 500  # số ngưỡng tối đa / lần mô phỏng
+
+def what_if_panel(prog: str, data: dict):
     """
-    Đọc file doanh số: chỉ sheet trùng tên chương trình (ví dụ 'NMCD').
-    Tự chuẩn hoá alias sheet: GVG->GVIG, KOSXX->KOS&XX, ...
-    Trả về: ['Mã khách hàng', 'Tổng Doanh số'] đã cộng gộp theo KH.
+    Mô phỏng mức tối thiểu / suất trên kết quả đang xem (không đọc lại file):
+    số KH Đạt / Không Đạt theo từng ngưỡng, theo NPP, và danh sách KH đổi trạng thái ở 1 ngưỡng.
     """
-    xls = pd.ExcelFile(file, engine="openpyxl")
-    # tìm đúng sheet thực tế trong file theo program_sheet_name
-    sheet = _resolve_sheet_name(xls, program_sheet_name)
-    df = pd.read_excel(xls, sheet_name=sheet)
-
-    # đoán cột mã KH
-    id_candidates = [c for c in df.columns if str(c).strip().lower() in
-        ["mã khách hàng","ma khach hang","mã kh","ma kh","customerid","customer id","makh","ma_kh","mã_kh"]]
-    if not id_candidates:
-        raise ValueError("Không tìm thấy cột Mã khách hàng trong file doanh số")
-    col_id = id_candidates[0]
-
-    # đoán cột tổng doanh số
-    sales_candidates = [c for c in df.columns if str(c).strip().lower() in
-        ["tổng doanh số","tong doanh so","tongdoanhso","doanh so","doanh_số","sum sales","sales"]]
-    if not sales_candidates:
-        raise ValueError("Không tìm thấy cột 'Tổng Doanh số' trong file doanh số")
-    col_sales = sales_candidates[0]
-
-    out = df[[col_id, col_sales]].copy()
-    out.columns = ["Mã khách hàng","Tổng Doanh số"]
-    out["Mã khách hàng"] = out["Mã khách hàng"].astype(str).str.strip()
-    out["Tổng Doanh số"] = pd.to_numeric(out["Tổng Doanh số"], errors="coerce").fillna(0)
-    out = out.groupby("Mã khách hàng", as_index=False)["Tổng Doanh số"].sum()
-    return out
-
-def apply_status_generic(df: pd.DataFrame, m1: str, m2: str, per_slot_min: int) -> pd.DataFrame:
-    s1_col = f"Giai đoạn - {m1}"
-    s2_col = f"Giai đoạn - {m2}"
-    d1_col = f"Doanh số - {m1}"
-    d2_col = f"Doanh số - {m2}"
-
-    df2 = df.copy()
-    for c in [s1_col, s2_col, d1_col, d2_col]:
-        df2[c] = pd.to_numeric(df2[c], errors="coerce").fillna(0).astype(int)
-
-    min1 = df2[s1_col] * int(per_slot_min)
-    min2 = df2[s2_col] * int(per_slot_min)
-
-    join1 = df2[s1_col] > 0
-    join2 = df2[s2_col] > 0
-
-    meet1 = (df2[d1_col] >= min1) & join1
-    meet2 = (df2[d2_col] >= min2) & join2
-
-    status = []
-    for j1, j2, ok1, ok2 in zip(join1, join2, meet1, meet2):
-        if not (j1 and j2):
-            status.append("Không xét")
-        elif (not ok1) and (not ok2):
-            status.append("Không Đạt")
-        else:
-            status.append("Đạt")
-
-    df2["TRẠNG THÁI"] = status
-    df2[f"Tối thiểu - {m1}"] = min1
-    df2[f"Tối thiểu - {m2}"] = min2
-    return df2
-
-
-def apply_status_kosxx(df: pd.DataFrame, m1: str, m2: str,
-                       min_mb: int = 200_000, min_other: int = 300_000) -> pd.DataFrame:
+    result, months = data["df"], [data["m1"], data["m2"]]
+    with st.expander(f"🧪 Mô phỏng mức tối thiểu (what-if) — {prog}", expanded=False):
+        targets = slot_min_targets(prog)
+        c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+        with c1:
+            pick = st.selectbox("Nhóm đổi mức", range(len(targets)), key=f"{prog}_wi_target",
+                                format_func=lambda i: f"{targets[i][1]} (hiện tại {targets[i][2]:,}/suất)")
+        target, _, current = targets[pick]
+        step_default = max(1_000, round(current * 0.05, -3))
+        with c2:
+            lo = st.number_input("Từ (đ/suất)", min_value=0, value=int(max(0, current - 10 * step_default)), step=int(step_default),
+                                 key=f"{prog}_wi_lo_{pick}")
+        with c3:
+            hi = st.number_input("Đến (đ/suất)", min_value=0, value=int(current + 20 * step_default), step=int(step_default),
+                                 key=f"{prog}_wi_hi_{pick}")
+        with c4:
+            step = st.number_input("Bước", min_value=1, value=int(step_default), step=int(step_default),
+                                   key=f"{prog}_wi_step_{pick}")
+        if hi < lo:
+            st.warning("'Đến' phải lớn hơn hoặc bằng 'Từ'.")
+            return
+        thresholds = list(range(int(lo), int(hi) + 1, int(step)))
+        if len(thresholds) > WHAT_IF_MAX_STEPS:
+            st.warning(f"{len(thresholds):,} ngưỡng – tăng bước để còn tối đa {WHAT_IF_MAX_STEPS}.")
+            return
+
+        # 1 lần quét cho cả lưới ngưỡng; giữ kết quả gần nhất của CT trong session
+        sweep_key = (data["fp"], target, tuple(thresholds))
+        cached = st.session_state.get(f"__{prog}_whatif__")
+        if cached is None or cached["key"] != sweep_key:
+            with st.spinner("Đang mô phỏng..."):
+                summary, by_npp = what_if_sweep(result, months, prog, thresholds, target=target)
+            cached = st.session_state[f"__{prog}_whatif__"] = {"key": sweep_key, "summary": summary, "npp": by_npp}
+        summary, by_npp = cached["summary"], cached["npp"]
+
+        st.line_chart(summary.set_index("Mức / suất")[["Đạt", "Không Đạt"]])
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+
+        near = min(thresholds, key=lambda t: abs(t - current))
+        chosen = st.selectbox("Xem chi tiết ở ngưỡng", thresholds, index=thresholds.index(near),
+                              format_func=lambda t: f"{t:,} đ/suất", key=f"{prog}_wi_pick")
+        npp_view = by_npp[["Mã NPP", "Tên NPP", "Số KH xét", "Đạt hiện tại", chosen]].rename(
+            columns={chosen: f"Đạt ở {chosen:,}"})
+        npp_view["Chênh lệch"] = npp_view[f"Đạt ở {chosen:,}"] - npp_view["Đạt hiện tại"]
+        st.dataframe(npp_view, hide_index=True, use_container_width=True)
+
+        changes = what_if_changes(result, months, prog, chosen, target=target)
+        st.caption(f"{len(changes):,} KH đổi trạng thái ở mức {chosen:,} đ/suất")
+        if len(changes):
+            paged_table(f"{prog}_wi_changes", changes)
+
+PAGE_SIZES = [50, 100, 500, 1000]
+
+def paged_table(key: str, df, mask=None, orders: dict = None):
     """
-    KOS&XX theo miền:
-      - 'Mã NPP' chứa 'MB'  -> 200k/slot
-      - Còn lại             -> 300k/slot
+    Bảng chi tiết phân trang: sắp xếp trên server (thứ tự cache trong orders),
+    chỉ gửi trang đang xem xuống trình duyệt.
     """
-    s1_col = f"Giai đoạn - {m1}"
-    s2_col = f"Giai đoạn - {m2}"
-    d1_col = f"Doanh số - {m1}"
-    d2_col = f"Doanh số - {m2}"
-
-    out = df.copy()
-    for c in [s1_col, s2_col, d1_col, d2_col]:
-        out[c] = pd.to_numeric(out[c], errors="coerce").fillna(0).astype(int)
-
-    npp = out["Mã NPP"].astype(str).str.upper()
-    per_slot = np.where(npp.str.contains("MB", na=False), min_mb, min_other)
-
-    min1 = out[s1_col] * per_slot
-    min2 = out[s2_col] * per_slot
-
-    join1 = out[s1_col] > 0
-    join2 = out[s2_col] > 0
-
-    meet1 = (out[d1_col] >= min1) & join1
-    meet2 = (out[d2_col] >= min2) & join2
-
-    status = []
-    for j1, j2, ok1, ok2 in zip(join1, join2, meet1, meet2):
-        if not (j1 and j2):
-            status.append("Không xét")
-        elif (not ok1) and (not ok2):
-            status.append("Không Đạt")
+    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+    with c1:
+        sort_col = st.selectbox("Sắp xếp theo", ["(mặc định)"] + list(df.columns), key=f"{key}_sort")
+    with c2:
+        descending = st.checkbox("Giảm dần", key=f"{key}_desc")
+    with c3:
+        page_size = st.selectbox("Số dòng / trang", PAGE_SIZES, index=1, key=f"{key}_page_size")
+
+    with stage("sort_page", rows=len(df), sort=sort_col) as s_:
+        order = sort_order(df, None if sort_col == "(mặc định)" else sort_col, not descending, cache=orders)
+        rows = visible_rows(order, mask)
+        pages = max(1, -(-len(rows) // page_size))
+        if st.session_state.get(f"{key}_page", 1) > pages:
+            st.session_state[f"{key}_page"] = pages  # bộ lọc đổi -> ít trang hơn
+        with c4:
+            page = st.number_input(f"Trang (/{pages:,})", min_value=1, max_value=pages, value=1,
+                                   step=1, key=f"{key}_page")
+        lo = (int(page) - 1) * page_size
+        view = df.iloc[rows[lo:lo + page_size]]
+        s_.set(out_rows=len(rows))
+    st.caption(f"Dòng {min(lo + 1, len(rows)):,}–{lo + len(view):,} / {len(rows):,}")
+    with stage("render_table", rows=len(view)):
+        st.dataframe(view, use_container_width=True)
+
+def session_memory_report() -> list:
+    """Dung lượng bộ nhớ các dữ liệu lớn đang giữ trong session (kết quả, chỉ mục, cache)."""
+    rows = []
+    for key, value in st.session_state.items():
+        if not (isinstance(key, str) and key.startswith("__")):
+            continue
+        if isinstance(value, dict) and "df" in value:
+            rows.append({"Mục": key.strip("_"), "Dữ liệu (MB)": memory_bytes(value["df"]) / 1e6,
+                         "Chỉ mục (MB)": memory_bytes(value.get("index", {})) / 1e6})
+        elif key == "__export_cache__":
+            rows.append({"Mục": key.strip("_"), "Dữ liệu (MB)": memory_bytes(value) / 1e6,
+                         "Chỉ mục (MB)": 0.0})
+    return rows
+
+# ================== File upload (ghi xuống đĩa ngay khi nhận) ==================
+# Bản bytes của file upload bị bỏ khỏi bộ nhớ server ngay sau khi ghi vào thư mục tạm của phiên;
+# mọi bước đọc dùng file trên đĩa (SpooledUpload). Ô upload được thay bằng ô trống mới (đổi key).
+
+@st.cache_resource
+def _sweep_upload_spools() -> int:
+    """Dọn thư mục upload bị bỏ lại của server đã dừng – 1 lần / process."""
+    return sweep_upload_spools()
+
+def _spool() -> UploadSpool:
+    """Thư mục tạm của phiên; tự xoá khi phiên kết thúc (UploadSpool bị thu hồi cùng session)."""
+    if "__upload_spool__" not in st.session_state:
+        _sweep_upload_spools()
+        st.session_state["__upload_spool__"] = UploadSpool()
+    return st.session_state["__upload_spool__"]
+
+def _uploads() -> dict:
+    """key ô upload -> SpooledUpload đang dùng."""
+    return st.session_state.setdefault("__uploads__", {})
+
+def _retire_upload(upload):
+    """File không còn ô nào dùng: xoá ngay nếu không có việc nền, không thì chờ việc nền xong."""
+    st.session_state.setdefault("__uploads_retired__", []).append(upload)
+    purge_retired_uploads()
+
+def purge_retired_uploads():
+    if _jobs():
+        return  # việc nền có thể vẫn đang đọc file
+    for upload in st.session_state.pop("__uploads_retired__", []):
+        _spool().discard(upload)
+
+def _release_uploaded_file(file):
+    """Bỏ bản bytes của file upload khỏi bộ nhớ server (đã có bản trên đĩa)."""
+    ctx = get_script_run_ctx()
+    if ctx is not None and ctx.uploaded_file_mgr is not None:
+        ctx.uploaded_file_mgr.remove_file(ctx.session_id, file.file_id)
+
+def spool_upload(key: str):
+    """File vừa upload ở ô `key` (nếu có) -> ghi xuống đĩa, bỏ bản trong RAM, đổi sang ô trống mới."""
+    gen = st.session_state.get(f"__{key}_gen__", 0)
+    file = st.session_state.get(f"{key}__{gen}")
+    if file is None:
+        return
+    uploads = _uploads()
+    old = uploads.get(key)
+    uploads[key] = _spool().add(file)
+    if old is not None:
+        _retire_upload(old)
+    _release_uploaded_file(file)
+    st.session_state[f"__{key}_gen__"] = gen + 1
+
+def spool_pending_uploads():
+    """spool_upload cho mọi ô upload đã hiển thị (đầu mỗi lần chạy, trước khi dùng file)."""
+    for key in st.session_state.get("__spool_keys__", ()):
+        spool_upload(key)
+
+def spooled_uploader(label: str, key: str, type) -> object:
+    """st.file_uploader có file được ghi xuống đĩa ngay khi nhận. Trả về SpooledUpload hoặc None."""
+    st.session_state.setdefault("__spool_keys__", set()).add(key)
+    spool_upload(key)
+    upload = _uploads().get(key)
+    gen = st.session_state.get(f"__{key}_gen__", 0)
+    st.file_uploader(label if upload is None else f"{label} (upload để thay file)", type=type,
+                     key=f"{key}__{gen}")
+    if upload is not None:
+        c1, c2 = st.columns([5, 1])
+        with c1:
+            st.caption(f"📎 {upload.name} · {upload.size / 1e6:,.1f} MB (lưu tạm trên đĩa)")
+        with c2:
+            if st.button("✖ Bỏ file", key=f"{key}_drop"):
+                _retire_upload(_uploads().pop(key))
+                st.rerun()
+    return upload
+
+# ================== Xử lý nền ==================
+JOB_POLL_SECONDS = 1.0  # chu kỳ làm mới panel tiến độ
+DIAG_RUNS_KEPT = 5  # số lần chạy gần nhất giữ lại trong panel chẩn đoán (kể cả việc nền)
+
+def _jobs() -> dict:
+    """CT -> BackgroundJob đang chạy của phiên (1 việc có thể gồm nhiều CT)."""
+    return st.session_state.setdefault("__jobs__", {})
+
+def upload_signature(files: dict) -> tuple:
+    return tuple(getattr(files.get(s), "digest", None) for s in ("tb1", "tb2", "ds1", "ds2"))
+
+def start_job(jobs: dict):
+    """Giao các CT cho 1 việc nền mới; việc cũ của các CT này bị huỷ nếu không còn CT nào khác cần."""
+    diag_on = st.session_state.get("diag_on", False)
+    job = BackgroundJob(jobs, diagnostics=diag_on, memory=diag_on and st.session_state.get("diag_memory", False))
+    if diag_on:
+        st.session_state.setdefault("__diag_jobs__", []).append(job)
+    registry = _jobs()
+    old = {id(registry[p]): registry[p] for p in jobs if p in registry}
+    for prog, files in jobs.items():
+        registry[prog] = job
+        st.session_state[f"__{prog}_files_sig__"] = upload_signature(files)
+    for o in old.values():
+        if o.running and not any(j is o for j in registry.values()):
+            o.cancel()
+
+def collect_job_results() -> bool:
+    """Đưa kết quả CT đã xong (hoặc lỗi / huỷ) từ việc nền vào session. True nếu có thay đổi."""
+    registry = _jobs()
+    changed = False
+    for prog, job in list(registry.items()):
+        if prog in job.results:
+            out = job.results[prog]
+            if isinstance(out, Exception):
+                msg = ("error", f"Lỗi khi xử lý: {out}")
+            else:
+                store_result(prog, *out)
+                msg = ("success", f"✅ Hoàn tất sau {job.elapsed:.1f} s: đã ghép doanh số & tính trạng thái.")
+        elif job.running:
+            continue
+        elif job.state == "cancelled":
+            msg = ("warning", "Đã huỷ xử lý.")
         else:
-            status.append("Đạt")
-
-    out["TRẠNG THÁI"] = status
-    out[f"Tối thiểu - {m1}"] = min1
-    out[f"Tối thiểu - {m2}"] = min2
-    return out
-
-def export_excel_layout(df: pd.DataFrame, m1: str, m2: str, prog: str) -> bytes:
-    """
-    Xuất .xlsx:
-    - Header gộp 2 hàng (Giai đoạn m1/m2, Doanh số m1/m2).
-    - KHÔNG có hàng tiêu đề lặp ở dòng 3.
-    - Tô màu TRẠNG THÁI, định dạng số & độ rộng cột.
-    """
-    from io import BytesIO
-    import xlsxwriter
-
-    cols = [
-        "Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng",
-        f"Giai đoạn - {m1}", f"Giai đoạn - {m2}",
-        f"Doanh số - {m1}", f"Doanh số - {m2}", "TRẠNG THÁI"
-    ]
-
-    d = df.copy()
-    for c in cols:
-        if c not in d.columns:
-            d[c] = ""
-    d = d[cols].reset_index(drop=True)
-
-    # Chuẩn hoá kiểu số
-    for c in [f"Giai đoạn - {m1}", f"Giai đoạn - {m2}"]:
-        d[c] = pd.to_numeric(d[c], errors="coerce").fillna(0).astype(int)
-    for c in [f"Doanh số - {m1}", f"Doanh số - {m2}"]:
-        d[c] = pd.to_numeric(d[c], errors="coerce").fillna(0).astype(int)
-
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-        wb = writer.book
-        ws = wb.add_worksheet(f"{prog}")
-
-        # ==== formats ====
-        header = wb.add_format({"bold": True,"align":"center","valign":"vcenter",
-                                "border":1,"bg_color":"#00B0F0","font_color":"#FFFFFF"})
-        sub = wb.add_format({"bold": True,"align":"center","valign":"vcenter",
-                             "border":1,"bg_color":"#D9EDF7"})
-        cell = wb.add_format({"border":1})
-        center = wb.add_format({"border":1,"align":"center"})
-        intfmt = wb.add_format({"border":1,"num_format":"#,##0"})
-        okfmt  = wb.add_format({"border":1,"align":"center","bg_color":"#C6EFCE"})
-        badfmt = wb.add_format({"border":1,"align":"center","bg_color":"#FFC7CE"})
-        neut   = wb.add_format({"border":1,"align":"center","bg_color":"#F2F2F2"})
-
-        # ==== header gộp (2 hàng) ====
-        ws.merge_range(0,0,1,0,"Mã CTTB", header)
-        ws.merge_range(0,1,1,1,"Mã NPP", header)
-        ws.merge_range(0,2,1,2,"Tên NPP", header)
-        ws.merge_range(0,3,1,3,"Mã khách hàng", header)
-        ws.merge_range(0,4,1,4,"Tên khách hàng", header)
-        ws.merge_range(0,5,0,6,"Giai đoạn", header)
-        ws.merge_range(0,7,0,8,"Doanh số", header)
-        ws.merge_range(0,9,1,9,"TRẠNG THÁI", header)
-
-        # Hàng 2 (subheader) chỉ ghi tiêu đề con cho 4 cột nhóm
-        ws.write(1,5, m1, sub)
-        ws.write(1,6, m2, sub)
-        ws.write(1,7, m1, sub)
-        ws.write(1,8, m2, sub)
-
-        # ==== data (bắt đầu từ hàng 3 - index 2) ====
-        start_row = 2
-        n = len(d)
-        for i in range(n):
-            r = start_row + i
-            ws.write(r,0, d.iloc[i,0], cell)           # Mã CTTB
-            ws.write(r,1, d.iloc[i,1], cell)           # Mã NPP
-            ws.write(r,2, d.iloc[i,2], cell)           # Tên NPP
-            ws.write(r,3, d.iloc[i,3], cell)           # Mã KH
-            ws.write(r,4, d.iloc[i,4], cell)           # Tên KH
-            ws.write_number(r,5, int(d.iloc[i,5]), center)   # Giai đoạn m1
-            ws.write_number(r,6, int(d.iloc[i,6]), center)   # Giai đoạn m2
-            ws.write_number(r,7, int(d.iloc[i,7]), intfmt)   # Doanh số m1
-            ws.write_number(r,8, int(d.iloc[i,8]), intfmt)   # Doanh số m2
-
-            stt = str(d.iloc[i,9]).strip()
-            fmt = okfmt if stt == "Đạt" else badfmt if stt == "Không Đạt" else neut if stt == "Không xét" else center
-            ws.write(r,9, stt, fmt)
-
-        # width & freeze panes
-        widths = [12,12,22,16,28,14,14,16,16,14]
-        for c, w in enumerate(widths):
-            ws.set_column(c, c, w)
-        ws.freeze_panes(start_row, 0)
-        ws.set_footer('&R© Nguyen Anh Tai')
-
-    return buf.getvalue()
+            msg = ("error", f"Lỗi khi xử lý: {job.error}")
+        st.session_state[f"__{prog}_job_msg__"] = msg
+        del registry[prog]
+        changed = True
+    collect_job_diagnostics()
+    return changed
+
+def collect_job_diagnostics():
+    """Record chẩn đoán của việc nền đã kết thúc -> thêm vào các lần chạy của panel chẩn đoán."""
+    jobs = st.session_state.get("__diag_jobs__", [])
+    for job in [j for j in jobs if not j.running and j.finished is not None]:
+        jobs.remove(job)
+        if job.diagnostics:
+            runs = st.session_state.setdefault("__diag_runs__", [])
+            label = time.strftime("%H:%M:%S", time.localtime(job.started)) + " · việc nền " + ", ".join(job.programs)
+            runs.insert(0, (label, job.diagnostics))
+            del runs[DIAG_RUNS_KEPT:]
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_panel(prog: str):
+    """Tiến độ việc nền của 1 CT (tự làm mới, phần còn lại của trang vẫn dùng được); xong -> chạy lại cả trang."""
+    if collect_job_results():
+        st.rerun()
+    job = _jobs().get(prog)
+    if job is None:
+        return
+    done, total, msg = job.progress.get(prog, (0, 0, ""))
+    c1, c2 = st.columns([5, 1])
+    with c1:
+        st.progress(done / max(total, 1), text=f"⏳ {msg} ({done}/{total} file · {job.elapsed:.0f} s)")
+    with c2:
+        if st.button("✖ Huỷ", key=f"{prog}_job_cancel"):
+            job.cancel()
 
 # ================== UI / Main ==================
 selected_programs = st.multiselect(
@@ -378,154 +444,356 @@ if not selected_programs:
     st.stop()
 st.success(f"Đã chọn: {', '.join(selected_programs)}")
 
-for prog in selected_programs:
-    st.markdown("---")
-    st.subheader(f"📌 Xử lý CT: {prog} - {PROGRAMS[prog]}")
-
-    # Upload
-    st.markdown("**Upload 2 file TRƯNG BÀY (App tự lấy tháng từ cột H 'Giai đoạn')**")
-    tb1 = st.file_uploader(f"[{prog}] File trưng bày #1", type=["xlsx"], key=f"{prog}_tb1")
-    tb2 = st.file_uploader(f"[{prog}] File trưng bày #2", type=["xlsx"], key=f"{prog}_tb2")
-
-    st.markdown("**Upload 2 file DOANH SỐ (sheet phải trùng tên CT, ví dụ 'NMCD')**")
-    ds1 = st.file_uploader(f"[{prog}] File doanh số #1", type=["xlsx"], key=f"{prog}_ds1")
-    ds2 = st.file_uploader(f"[{prog}] File doanh số #2", type=["xlsx"], key=f"{prog}_ds2")
-
-    data_key = f"__{prog}_data__"
-
-    # Nút xử lý & lưu session
-    if tb1 and tb2 and st.button(f"Xử lý CT {prog}", key=f"{prog}_process_btn"):
-        try:
-            df1 = read_display_excel(tb1)
-            df2 = read_display_excel(tb2)
-            result, m1, m2 = combine_two_months(df1, df2)
-
-            if ds1:
-                s1 = read_sales_excel(ds1, program_sheet_name=prog)
-                result = result.merge(s1, on="Mã khách hàng", how="left")
-                result[f"Doanh số - {m1}"] = result.pop("Tổng Doanh số").fillna(0)
-            if ds2:
-                s2 = read_sales_excel(ds2, program_sheet_name=prog)
-                result = result.merge(s2, on="Mã khách hàng", how="left")
-                if "Tổng Doanh số" in result.columns:
-                    result[f"Doanh số - {m2}"] = result.pop("Tổng Doanh số").fillna(0)
-
-            for c in [f"Doanh số - {m1}", f"Doanh số - {m2}"]:
-                result[c] = pd.to_numeric(result[c], errors="coerce").fillna(0).astype(int)
-                
-            if prog == "KOS&XX":
-                # Miền MB: 200k/slot, miền khác: 300k/slot
-                result = apply_status_kosxx(result, m1, m2, min_mb=200_000, min_other=300_000)
-            else:
-                per_min = PER_SLOT_MIN.get(prog, 0)
-                result = apply_status_generic(result, m1, m2, per_slot_min=per_min)
-
-            st.session_state[data_key] = {"df": result, "m1": m1, "m2": m2}
-            st.success("✅ Hoàn tất: đã ghép doanh số & tính trạng thái.")
-        except Exception as e:
-            st.error(f"Lỗi khi xử lý: {e}")
-
-    # Hiển thị/lọc khi đã có dữ liệu
-    if data_key in st.session_state:
-        result = st.session_state[data_key]["df"].copy()
-        m1 = st.session_state[data_key]["m1"]
-        m2 = st.session_state[data_key]["m2"]
-
-        with st.expander(f"🔎 Bộ lọc — {prog}", expanded=False):
-            c1, c2, c3, c4 = st.columns([1,1,1,1])
-            with c1:
-                npp_codes = st.multiselect(
-                    "Mã NPP",
-                    options=sorted(result["Mã NPP"].dropna().unique()),
-                    key=f"{prog}_npp_codes"
+# Chẩn đoán hiệu năng (tắt mặc định): ghi thời gian / bộ nhớ từng bước của lần chạy này
+with st.sidebar:
+    diag_on = st.toggle("🩺 Chẩn đoán hiệu năng", key="diag_on")
+    diag_memory = diag_on and st.checkbox("Đo peak bộ nhớ (chậm hơn)", key="diag_memory")
+if diag_on:
+    enable_diagnostics_log()
+    start_diagnostics(memory=diag_memory)
+
+try:
+    # Doanh số dùng chung: 1 file / tháng chứa sheet của mọi CT, upload & đọc 1 lần
+    use_shared_sales = st.checkbox(
+        "Dùng chung 2 file DOANH SỐ cho tất cả CT đã chọn (mỗi CT 1 sheet trong file)",
+        key="use_shared_sales",
+    )
+    if use_shared_sales:
+        sds1 = spooled_uploader("File doanh số #1 (dùng chung)", "shared_ds1", INPUT_TYPES)
+        sds2 = spooled_uploader("File doanh số #2 (dùng chung)", "shared_ds2", INPUT_TYPES)
+
+    # ===== Xử lý nền (đọc file trên process pool, giao diện không bị chặn) =====
+    collect_job_results()
+    purge_retired_uploads()
+    spool_pending_uploads()
+
+    # File upload của từng CT lấy từ các file đã ghi xuống đĩa (ô upload đã render ở lần chạy trước).
+    # CT đủ cả 4 file (hoặc 2 file trưng bày + doanh số dùng chung) và bộ file mới -> tự xử lý nền ngay.
+    ready_jobs, auto_jobs = {}, {}
+    for prog in selected_programs:
+        tb1, tb2 = _uploads().get(f"{prog}_tb1"), _uploads().get(f"{prog}_tb2")
+        if not (tb1 and tb2):
+            continue
+        if use_shared_sales:
+            ds1, ds2 = sds1, sds2
+        else:
+            ds1, ds2 = _uploads().get(f"{prog}_ds1"), _uploads().get(f"{prog}_ds2")
+        ready_jobs[prog] = {"tb1": tb1, "tb2": tb2, "ds1": ds1, "ds2": ds2}
+        if ds1 and ds2 and st.session_state.get(f"__{prog}_files_sig__") != upload_signature(ready_jobs[prog]):
+            auto_jobs[prog] = ready_jobs[prog]
+    if auto_jobs:
+        start_job(auto_jobs)
+
+    if len(ready_jobs) > 1 and st.button(
+        f"⚡ Xử lý tất cả ({', '.join(ready_jobs)}) song song", key="process_all_btn"
+    ):
+        start_job(ready_jobs)
+
+    for prog in selected_programs:
+        st.markdown("---")
+        st.subheader(f"📌 Xử lý CT: {prog} - {PROGRAMS[prog]}")
+
+        # Mở lại kết quả đã lưu (snapshot) – không cần upload / xử lý lại
+        with st.expander(f"📂 Mở kết quả đã lưu — {prog}", expanded=False):
+            snap = spooled_uploader(f"[{prog}] File snapshot (.parquet)", f"{prog}_snapshot", ["parquet"])
+            if snap is not None and st.session_state.get(f"__{prog}_snapshot_id__") != snap.digest:
+                try:
+                    snap_df, snap_m1, snap_m2, snap_prog = load_snapshot(snap)
+                    if snap_prog != prog:
+                        raise ValueError(f"snapshot là của CT {snap_prog}, không phải {prog}")
+                    store_result(prog, snap_df, snap_m1, snap_m2)
+                    st.session_state[f"__{prog}_snapshot_id__"] = snap.digest
+                    st.success(f"✅ Đã mở kết quả {snap_m1} → {snap_m2}.")
+                except Exception as e:
+                    st.error(f"Lỗi khi mở snapshot: {e}")
+
+        # Upload
+        st.markdown("**Upload 2 file TRƯNG BÀY (.xlsx / .csv / .parquet – App tự lấy tháng từ cột 'Giai đoạn')**")
+        tb1 = spooled_uploader(f"[{prog}] File trưng bày #1", f"{prog}_tb1", INPUT_TYPES)
+        tb2 = spooled_uploader(f"[{prog}] File trưng bày #2", f"{prog}_tb2", INPUT_TYPES)
+
+        if use_shared_sales:
+            st.caption("Doanh số: dùng 2 file doanh số chung ở trên.")
+            ds1, ds2 = sds1, sds2
+        else:
+            st.markdown("**Upload 2 file DOANH SỐ (Excel: sheet trùng tên CT, ví dụ 'NMCD'; CSV / Parquet: cột Mã KH + Tổng Doanh số, có thể thêm cột CT)**")
+            ds1 = spooled_uploader(f"[{prog}] File doanh số #1", f"{prog}_ds1", INPUT_TYPES)
+            ds2 = spooled_uploader(f"[{prog}] File doanh số #2", f"{prog}_ds2", INPUT_TYPES)
+
+        data_key = f"__{prog}_data__"
+
+        # Nút xử lý (đủ 4 file thì đã tự chạy nền; nút dùng khi thiếu doanh số / muốn chạy lại)
+        if tb1 and tb2 and st.button(f"Xử lý CT {prog}", key=f"{prog}_process_btn"):
+            start_job({prog: {"tb1": tb1, "tb2": tb2, "ds1": ds1, "ds2": ds2}})
+        if prog in _jobs():
+            job_panel(prog)
+        job_msg = st.session_state.pop(f"__{prog}_job_msg__", None)
+        if job_msg:
+            getattr(st, job_msg[0])(job_msg[1])
+
+        # Kho nhiều tháng: thêm từng tháng 1 lần, đánh giá cửa sổ N tháng bất kỳ
+        with st.expander(f"🗂️ Kho nhiều tháng — {prog}", expanded=False):
+            months = store_months(prog)
+            st.caption("Tháng đã lưu: " + (", ".join(months) if months else "(chưa có)"))
+            new_tb = spooled_uploader(f"[{prog}] File trưng bày tháng mới", f"{prog}_store_tb", INPUT_TYPES)
+            new_ds = spooled_uploader(f"[{prog}] File doanh số tháng mới", f"{prog}_store_ds", INPUT_TYPES)
+            pending_key = f"__{prog}_store_overwrite__"
+            if new_tb and st.button("➕ Thêm tháng vào kho", key=f"{prog}_store_add"):
+                st.session_state.pop(pending_key, None)
+                try:
+                    m = store_append_month(prog, new_tb, new_ds)
+                    st.success(f"✅ Đã lưu tháng {m}.")
+                    months = store_months(prog)
+                except MonthExistsError as e:
+                    # kho dùng chung: không ghi đè tháng của người khác khi chưa xác nhận
+                    st.session_state[pending_key] = e.label
+                except Exception as e:
+                    st.error(f"Lỗi khi thêm tháng: {e}")
+            pending = st.session_state.get(pending_key)
+            if pending and new_tb:
+                st.warning(f"Kho đã có tháng {pending}. Ghi đè sẽ thay dữ liệu tháng này cho mọi người dùng.")
+                c1, c2 = st.columns([1, 1])
+                if c1.button(f"♻️ Ghi đè tháng {pending}", key=f"{prog}_store_overwrite"):
+                    st.session_state.pop(pending_key, None)
+                    try:
+                        m = store_append_month(prog, new_tb, new_ds, overwrite=True)
+                        st.success(f"✅ Đã ghi đè tháng {m}.")
+                        months = store_months(prog)
+                    except Exception as e:
+                        st.error(f"Lỗi khi thêm tháng: {e}")
+                elif c2.button("Huỷ", key=f"{prog}_store_overwrite_cancel"):
+                    st.session_state.pop(pending_key, None)
+                    st.rerun()
+
+            if len(months) > 1:
+                # thứ tự mặc định theo thời gian đọc từ nhãn; nhãn không rõ năm/tháng thì tự sắp
+                o1, o2, o3 = st.columns([2, 1, 1])
+                moving = o1.selectbox("Sắp lại thứ tự", options=months, key=f"{prog}_store_move")
+                for col, text, offset in ((o2, "⬆️ Sớm hơn", -1), (o3, "⬇️ Muộn hơn", 1)):
+                    if col.button(text, key=f"{prog}_store_move_{offset}"):
+                        store_move_month(prog, moving, offset)
+                        st.rerun()
+
+            if months:
+                w1, w2 = st.columns([1, 1])
+                with w1:
+                    window = st.number_input("Số tháng xét", min_value=1, max_value=len(months),
+                                             value=min(2, len(months)), step=1, key=f"{prog}_store_window")
+                with w2:
+                    end = st.selectbox("Đến tháng", options=months[::-1], key=f"{prog}_store_end")
+                if st.button("📊 Đánh giá cửa sổ", key=f"{prog}_store_eval"):
+                    try:
+                        win_df, win_months = evaluate_window(prog, int(window), end)
+                        if len(win_months) == 2:
+                            # 2 tháng -> dùng chung bộ lọc / tải như kết quả xử lý thường
+                            store_result(prog, win_df, *win_months)
+                            st.session_state.pop(f"__{prog}_window__", None)
+                        else:
+                            win_df = compact_result(win_df)
+                            st.session_state[f"__{prog}_window__"] = {
+                                "df": win_df, "months": win_months, "fp": frame_fingerprint(win_df),
+                                "summary": npp_summary(win_df, win_months), "orders": {},
+                            }
+                    except Exception as e:
+                        st.error(f"Lỗi khi đánh giá: {e}")
+
+            window_data = st.session_state.get(f"__{prog}_window__")
+            if window_data:
+                win_df, win_months = window_data["df"], window_data["months"]
+                st.markdown(f"**Cửa sổ {' → '.join(win_months)}** – tổng hợp theo NPP")
+                st.dataframe(window_data["summary"], hide_index=True, use_container_width=True)
+                if st.toggle("Xem bảng chi tiết", key=f"{prog}_win_show_detail"):
+                    paged_table(f"{prog}_win", win_df, orders=window_data["orders"])
+                label = "_".join(win_months)
+                lazy_download_button(
+                    f"Kết quả {len(win_months)} tháng",
+                    key=("xlsx", prog, window_data["fp"], tuple(win_months), None),
+                    build=lambda: export_excel_months(win_df, win_months, prog),
+                    file_name=f"{prog}_ketqua_{label}.xlsx",
+                    widget_key=f"{prog}_dl_window",
                 )
-            with c2:
-                npp_names = st.multiselect(
-                    "Tên NPP",
-                    options=sorted(result["Tên NPP"].dropna().unique()),
-                    key=f"{prog}_npp_names"
+
+        # Hiển thị/lọc khi đã có dữ liệu
+        if data_key in st.session_state:
+            data = st.session_state[data_key]
+            result, m1, m2, index = data["df"], data["m1"], data["m2"], data["index"]
+
+            with st.expander(f"🔎 Bộ lọc — {prog}", expanded=False):
+                c1, c2, c3, c4 = st.columns([1,1,1,1])
+                with c1:
+                    npp_codes = st.multiselect(
+                        "Mã NPP",
+                        options=index["npp_code"][1],
+                        key=f"{prog}_npp_codes"
+                    )
+                with c2:
+                    npp_names = st.multiselect(
+                        "Tên NPP",
+                        options=index["npp_name"][1],
+                        key=f"{prog}_npp_names"
+                    )
+                with c3:
+                    statuses = st.multiselect(
+                        "Trạng thái",
+                        options=["Đạt","Không Đạt","Không xét"],
+                        key=f"{prog}_statuses"
+                    )
+                with c4:
+                    kw = st.text_input("Tìm (Mã KH / Tên KH)", key=f"{prog}_kw")
+            
+            c5, c6, c7, c8 = st.columns(4)
+            with c5:
+                min_sales_m1 = st.number_input(
+                    f"Doanh số tối thiểu – {m1}",
+                    min_value=0, value=0, step=50_000, key=f"{prog}_min_sales_m1"
                 )
-            with c3:
-                statuses = st.multiselect(
-                    "Trạng thái",
-                    options=["Đạt","Không Đạt","Không xét"],
-                    key=f"{prog}_statuses"
+            with c6:
+                min_sales_m2 = st.number_input(
+                    f"Doanh số tối thiểu – {m2}",
+                    min_value=0, value=0, step=50_000, key=f"{prog}_min_sales_m2"
                 )
-            with c4:
-                kw = st.text_input("Tìm (Mã KH / Tên KH)", key=f"{prog}_kw")
-        
-        c5, c6, c7, c8 = st.columns(4)
-        with c5:
-            min_sales_m1 = st.number_input(
-                f"Doanh số tối thiểu – {m1}",
-                min_value=0, value=0, step=50_000, key=f"{prog}_min_sales_m1"
-            )
-        with c6:
-            min_sales_m2 = st.number_input(
-                f"Doanh số tối thiểu – {m2}",
-                min_value=0, value=0, step=50_000, key=f"{prog}_min_sales_m2"
-            )
-        with c7:
-            min_slots_m1 = st.number_input(
-                f"Giai đoạn (số suất) – {m1}",
-                min_value=0, value=0, step=1, key=f"{prog}_min_slots_m1"
+            with c7:
+                min_slots_m1 = st.number_input(
+                    f"Giai đoạn (số suất) – {m1}",
+                    min_value=0, value=0, step=1, key=f"{prog}_min_slots_m1"
+                )
+            with c8:
+                min_slots_m2 = st.number_input(
+                    f"Giai đoạn (số suất) – {m2}",
+                    min_value=0, value=0, step=1, key=f"{prog}_min_slots_m2"
+                )
+
+            # ================== Áp dụng lọc ==================
+            # Ghép mask trên chỉ mục dựng sẵn; chỉ tạo frame con khi thật sự có dòng bị loại
+            with stage("filter", program=prog, rows=len(result)) as s_:
+                mask = filter_mask(
+                    index, npp_codes, npp_names, statuses, kw,
+                    min_sales={m1: min_sales_m1, m2: min_sales_m2},
+                    min_slots={m1: min_slots_m1, m2: min_slots_m2},
+                )
+                s_.set(out_rows=int(mask.sum()))
+
+            # ================== Hiển thị & Tải xuống ==================
+            # Bảng tổng hợp theo NPP (tính sẵn khi xử lý) – đa số chỉ cần xem bảng này
+            st.markdown("**Tổng hợp theo NPP** (toàn bộ kết quả)")
+            st.dataframe(data["summary"], hide_index=True, use_container_width=True)
+            key_report_panel(data.get("keys"))
+            what_if_panel(prog, data)
+
+            # Bảng chi tiết chỉ dựng khi được bật, và chỉ gửi 1 trang
+            if st.toggle("Xem bảng chi tiết (theo bộ lọc)", key=f"{prog}_show_detail"):
+                paged_table(f"{prog}_detail", result, mask, index["orders"])
+
+            # Excel chỉ dựng khi được yêu cầu; cache theo (dữ liệu, tháng, trạng thái bộ lọc)
+            data_fp = data["fp"]
+            filter_state = (
+                tuple(npp_codes), tuple(npp_names), tuple(statuses), kw.strip().lower(),
+                int(min_sales_m1), int(min_sales_m2), int(min_slots_m1), int(min_slots_m2),
             )
-        with c8:
-            min_slots_m2 = st.number_input(
-                f"Giai đoạn (số suất) – {m2}",
-                min_value=0, value=0, step=1, key=f"{prog}_min_slots_m2"
+            if mask.all():
+                filter_state = None  # bộ lọc không loại dòng nào -> dùng chung file với bản chuẩn
+
+            # Excel sau khi lọc
+            lazy_download_button(
+                "Kết quả (Sau khi lọc)",
+                key=("xlsx", prog, data_fp, m1, m2, filter_state),
+                build=lambda: export_excel_layout(result[mask], m1, m2, prog),
+                file_name=f"{prog}_ketqua_loc_{m1}_{m2}.xlsx",
+                widget_key=f"{prog}_dl_filtered",
             )
 
-        # ================== Áp dụng lọc ==================
-        filtered = result.copy()
-
-        if npp_codes:
-            filtered = filtered[filtered["Mã NPP"].isin(npp_codes)]
-        if npp_names:
-            filtered = filtered[filtered["Tên NPP"].isin(npp_names)]
-        if statuses:
-            filtered = filtered[filtered["TRẠNG THÁI"].isin(statuses)]
-        if kw:
-            kw_l = kw.strip().lower()
-            filtered = filtered[
-                filtered["Mã khách hàng"].astype(str).str.lower().str.contains(kw_l)
-                | filtered["Tên khách hàng"].astype(str).str.lower().str.contains(kw_l)
-            ]
-
-        # Doanh số tối thiểu theo từng tháng
-        filtered = filtered[
-            (filtered[f"Doanh số - {m1}"].astype(int) >= int(min_sales_m1))
-            & (filtered[f"Doanh số - {m2}"].astype(int) >= int(min_sales_m2))
-        ]
-
-        # Giai đoạn (số suất) tối thiểu theo từng tháng
-        if int(min_slots_m1) > 0:
-            filtered = filtered[filtered[f"Giai đoạn - {m1}"].astype(int) >= int(min_slots_m1)]
-        if int(min_slots_m2) > 0:
-            filtered = filtered[filtered[f"Giai đoạn - {m2}"].astype(int) >= int(min_slots_m2)]
-
-        # ================== Hiển thị & Tải xuống ==================
-        st.dataframe(filtered, use_container_width=True)
-
-        # Excel sau khi lọc
-        excel_filtered = export_excel_layout(filtered, m1, m2, prog)
-        st.download_button(
-            "⬇️ Tải EXCEL – Kết quả (Sau khi lọc)",
-            data=excel_filtered,
-            file_name=f"{prog}_ketqua_loc_{m1}_{m2}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key=f"{prog}_dl_filtered",
-        )
+            # Excel bản chuẩn (không lọc) – dựng 1 lần cho mỗi lần xử lý
+            lazy_download_button(
+                "Kết quả (Bản chuẩn)",
+                key=("xlsx", prog, data_fp, m1, m2, None),
+                build=lambda: export_excel_layout(result, m1, m2, prog),
+                file_name=f"{prog}_ketqua_chuan_{m1}_{m2}.xlsx",
+                widget_key=f"{prog}_dl_raw",
+            )
 
-        # Excel bản chuẩn (không lọc)
-        excel_raw = export_excel_layout(result, m1, m2, prog)
-        st.download_button(
-            "⬇️ Tải EXCEL – Kết quả (Bản chuẩn)",
-            data=excel_raw,
-            file_name=f"{prog}_ketqua_chuan_{m1}_{m2}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key=f"{prog}_dl_raw",
+            # Snapshot kết quả (Parquet gọn) – mở lại ở mục "Mở kết quả đã lưu" trong vài phần nghìn giây
+            lazy_download_button(
+                "Snapshot kết quả (mở lại nhanh)",
+                key=("snapshot", prog, data_fp, m1, m2),
+                build=lambda: save_snapshot(result, m1, m2, prog),
+                file_name=f"{prog}_ketqua_{m1}_{m2}.parquet",
+                widget_key=f"{prog}_dl_snapshot",
+                kind="SNAPSHOT", mime="application/vnd.apache.parquet",
+            )
+        else:
+            st.info("👉 Upload file và bấm **Xử lý** để tạo dữ liệu trước khi lọc/tải.")
+
+    # ================== Xuất 1 file gộp nhiều CT ==================
+    done_programs = [p for p in selected_programs if f"__{p}_data__" in st.session_state]
+    if done_programs:
+        st.markdown("---")
+        st.subheader("📚 File Excel gộp nhiều CT")
+        picked_programs = st.multiselect(
+            "CT đưa vào file gộp (mỗi CT 1 sheet + sheet Tổng quan)",
+            options=done_programs, default=done_programs, key="consolidated_programs",
         )
-    else:
-        st.info("👉 Upload file và bấm **Xử lý** để tạo dữ liệu trước khi lọc/tải.")
-
+        if picked_programs:
+            datas = {p: st.session_state[f"__{p}_data__"] for p in picked_programs}
+            cons_key = tuple((p, d["fp"], d["m1"], d["m2"]) for p, d in datas.items())
+            # File gộp ghi thẳng ra file tạm trong thư mục upload của phiên (bị xoá cùng phiên, không giữ
+            # trong cache bytes); chỉ giữ file mới nhất
+            built = st.session_state.get("__consolidated_export__")
+            if built and (built["key"] != cons_key or not os.path.exists(built["path"])):
+                if os.path.exists(built["path"]):
+                    os.remove(built["path"])
+                del st.session_state["__consolidated_export__"]
+                built = None
+            if built is None and st.button("📦 Tạo file gộp", key="consolidated_build"):
+                with st.spinner("Đang tạo file Excel gộp..."):
+                    path = export_consolidated(
+                        {p: (d["df"], [d["m1"], d["m2"]]) for p, d in datas.items()},
+                        summaries={p: d["summary"] for p, d in datas.items()},
+                        temp_dir=_spool().path,
+                    )
+                built = st.session_state["__consolidated_export__"] = {"key": cons_key, "path": path}
+            if built is not None:
+                with open(built["path"], "rb") as fh:
+                    st.download_button(
+                        f"⬇️ Tải EXCEL – Gộp {len(picked_programs)} CT",
+                        data=fh,
+                        file_name=f"ketqua_gop_{time.strftime('%Y%m%d')}.xlsx",
+                        mime=XLSX_MIME,
+                        key="consolidated_download",
+                    )
+
+    # ================== Bộ nhớ phiên ==================
+    with st.sidebar:
+        report = session_memory_report()
+        if report:
+            with st.expander("🧠 Bộ nhớ phiên", expanded=False):
+                total = sum(r["Dữ liệu (MB)"] + r["Chỉ mục (MB)"] for r in report)
+                st.caption(f"Tổng: {total:,.1f} MB · file upload trên đĩa: {_spool().disk_bytes() / 1e6:,.1f} MB")
+                st.dataframe(report, hide_index=True, use_container_width=True)
+finally:
+    # luôn dừng ghi (kể cả lỗi / st.stop() / phiên đóng giữa chừng): không để tracemalloc chạy mãi
+    diag_records = stop_diagnostics()
+
+# ================== Chẩn đoán hiệu năng ==================
+if diag_on:
+    runs = st.session_state.setdefault("__diag_runs__", [])
+    if diag_records:
+        runs.insert(0, (time.strftime("%H:%M:%S"), diag_records))
+        del runs[DIAG_RUNS_KEPT:]
+    with st.sidebar:
+        with st.expander("🩺 Thời gian / bộ nhớ từng bước", expanded=True):
+            if not runs:
+                st.caption("Chưa có bước nào được đo.")
+            else:
+                picked = st.selectbox(
+                    "Lần chạy", options=range(len(runs)), key="diag_run",
+                    format_func=lambda i: f"{runs[i][0]} · {sum(r['seconds'] for r in runs[i][1] if r['depth'] == 0):.2f} s",
+                )
+                rows = [{
+                    "Bước": "· " * r["depth"] + r["stage"],
+                    "Giây": r["seconds"],
+                    "Peak (MB)": round(r["peak_bytes"] / 1e6, 2) if "peak_bytes" in r else None,
+                    "Dòng": r.get("rows"),
+                    "Chi tiết": ", ".join(f"{k}={v}" for k, v in r.items()
+                                          if k not in ("stage", "seconds", "depth", "at", "peak_bytes", "rows")),
+                } for r in sorted(runs[min(picked, len(runs) - 1)][1], key=lambda r: (r["at"], r["depth"]))]
+                st.dataframe(rows, hide_index=True, use_container_width=True)
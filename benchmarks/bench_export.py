@@ -0,0 +1,112 @@
+"""
+So sánh tốc độ / bộ nhớ của export_excel_layout với vòng lặp ghi từng ô cũ.
+
+    python benchmarks/bench_export.py --rows 200000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_result(n: int, m1: str = "T07", m2: str = "T08") -> pd.DataFrame:
+    """Bảng kết quả giả lập (đúng các cột mà export_excel_layout cần)."""
+    rng = np.random.default_rng(0)
+    ids = np.arange(n)
+    return pd.DataFrame({
+        "Mã CTTB": "CT01",
+        "Mã NPP": np.where(ids % 3 == 0, "MB01", "MN02"),
+        "Tên NPP": np.where(ids % 3 == 0, "NPP Miền Bắc", "NPP Miền Nam"),
+        "Mã khách hàng": ids.astype(str),
+        "Tên khách hàng": [f"Khách hàng {i}" for i in ids],
+        f"Giai đoạn - {m1}": rng.integers(0, 4, n),
+        f"Giai đoạn - {m2}": rng.integers(0, 4, n),
+        f"Doanh số - {m1}": rng.integers(0, 2_000_000, n),
+        f"Doanh số - {m2}": rng.integers(0, 2_000_000, n),
+        "TRẠNG THÁI": rng.choice(["Đạt", "Không Đạt", "Không xét"], n),
+    })
+
+
+def legacy_export(df: pd.DataFrame, m1: str, m2: str, prog: str) -> bytes:
+    """Bản cũ: ghi từng ô bằng d.iloc[i, j] (giữ lại chỉ để so sánh)."""
+    cols = ["Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng",
+            f"Giai đoạn - {m1}", f"Giai đoạn - {m2}",
+            f"Doanh số - {m1}", f"Doanh số - {m2}", "TRẠNG THÁI"]
+    d = df[cols].reset_index(drop=True)
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+        wb = writer.book
+        ws = wb.add_worksheet(prog)
+        header = wb.add_format({"bold": True, "border": 1, "bg_color": "#00B0F0"})
+        cell = wb.add_format({"border": 1})
+        center = wb.add_format({"border": 1, "align": "center"})
+        intfmt = wb.add_format({"border": 1, "num_format": "#,##0"})
+        okfmt = wb.add_format({"border": 1, "align": "center", "bg_color": "#C6EFCE"})
+        badfmt = wb.add_format({"border": 1, "align": "center", "bg_color": "#FFC7CE"})
+        neut = wb.add_format({"border": 1, "align": "center", "bg_color": "#F2F2F2"})
+        for c in range(10):
+            ws.write(0, c, cols[c], header)
+        for i in range(len(d)):
+            r = 2 + i
+            for c in range(5):
+                ws.write(r, c, d.iloc[i, c], cell)
+            ws.write_number(r, 5, int(d.iloc[i, 5]), center)
+            ws.write_number(r, 6, int(d.iloc[i, 6]), center)
+            ws.write_number(r, 7, int(d.iloc[i, 7]), intfmt)
+            ws.write_number(r, 8, int(d.iloc[i, 8]), intfmt)
+            stt = str(d.iloc[i, 9]).strip()
+            fmt = okfmt if stt == "Đạt" else badfmt if stt == "Không Đạt" else neut
+            ws.write(r, 9, stt, fmt)
+    return buf.getvalue()
+
+
+def measure(fn, *args, memory: bool = False):
+    """Thời gian chạy; kèm peak bộ nhớ (tracemalloc, chạy lại lần 2) nếu memory=True."""
+    t0 = time.perf_counter()
+    out = fn(*args)
+    elapsed = time.perf_counter() - t0
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, len(out)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--rows", type=int, default=200_000)
+    ap.add_argument("--skip-legacy", action="store_true", help="chỉ đo bản mới")
+    ap.add_argument("--memory", action="store_true", help="đo thêm peak bộ nhớ (chậm hơn)")
+    args = ap.parse_args()
+
+    import warnings
+    warnings.filterwarnings("ignore")
+    from core import export_excel_layout
+
+    df = make_result(args.rows)
+    runs = [("export_excel_layout", export_excel_layout)]
+    if not args.skip_legacy:
+        runs.append(("legacy (iloc từng ô)", legacy_export))
+
+    results = {}
+    for name, fn in runs:
+        elapsed, peak, size = measure(fn, df, "T07", "T08", "BENCH", memory=args.memory)
+        results[name] = elapsed
+        mem = f"  peak {peak / 2**20:8.1f} MiB" if peak is not None else ""
+        print(f"{name:<22} {args.rows:>9,} dòng  {elapsed:8.2f} s{mem}  file {size / 2**20:6.1f} MiB")
+    if len(results) == 2:
+        new, old = results.values()
+        print(f"Tăng tốc: x{old / new:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Đo thời gian & peak bộ nhớ từng bước của pipeline 1 CT trên dữ liệu giả lập (gen_data.py).
+
+    python benchmarks/bench_pipeline.py --sizes 10000,100000
+    python benchmarks/bench_pipeline.py --sizes 10000 --save-baseline
+    python benchmarks/bench_pipeline.py --sizes 10000 --fail-on-regression
+
+Các bước: read_display_excel (2 file), combine_two_months, read_sales_excel (2 file),
+attach_sales (ghép doanh số), apply_status, export_excel_layout.
+Mỗi lần chạy được ghi thêm vào history.json; so với baseline.json để đánh dấu chậm / tốn bộ nhớ hơn.
+Số KH vượt giới hạn dòng Excel: bỏ các bước đọc / xuất file, các bước còn lại chạy trên bảng sinh trong bộ nhớ.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+RESULTS_DIR = os.path.join(HERE, "results")
+TIME_TOLERANCE = 0.25    # chậm hơn baseline > 25% -> regression
+MEMORY_TOLERANCE = 0.20  # peak bộ nhớ hơn baseline > 20% -> regression
+TIME_NOISE_FLOOR = 0.05  # chênh lệch < 50 ms coi là nhiễu đo
+
+
+def measure(fn, memory: bool = True):
+    """Chạy fn() lấy thời gian; nếu memory=True chạy lại lần 2 dưới tracemalloc lấy peak (MiB)."""
+    gc.collect()
+    t0 = time.perf_counter()
+    out = fn()
+    seconds = time.perf_counter() - t0
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return out, {"seconds": round(seconds, 4), "peak_mib": None if peak is None else round(peak, 2)}
+
+
+def run_size(n: int, prog: str, data_dir: str, memory: bool) -> dict:
+    """Chạy các bước cho n KH. Trả về {bước: {"seconds", "peak_mib"} | {"skipped": lý do}}."""
+    import core
+    import gen_data
+
+    stages = {}
+    in_file = n <= gen_data.max_file_customers()
+    if in_file:
+        print(f"  chuẩn bị file {n:,} KH ...", flush=True)
+        files = gen_data.ensure_dataset(data_dir, n)
+        (d1, d2), stages["read_display_excel"] = measure(
+            lambda: (core.read_display_excel(files["tb1"]), core.read_display_excel(files["tb2"])), memory)
+    else:
+        reason = "vượt giới hạn dòng Excel, dùng bảng sinh trong bộ nhớ"
+        stages["read_display_excel"] = {"skipped": reason}
+        d1 = gen_data.make_display_frame(n, gen_data.MONTHS[0], seed=1)
+        d2 = gen_data.make_display_frame(n, gen_data.MONTHS[1], seed=2)
+
+    (combined, m1, m2), stages["combine_two_months"] = measure(lambda: core.combine_two_months(d1, d2), memory)
+
+    if in_file:
+        (s1, s2), stages["read_sales_excel"] = measure(
+            lambda: (core.read_sales_excel(files["ds1"], prog), core.read_sales_excel(files["ds2"], prog)), memory)
+    else:
+        stages["read_sales_excel"] = {"skipped": reason}
+        s1, s2 = gen_data.make_sales_frame(n, seed=11), gen_data.make_sales_frame(n, seed=12)
+
+    merged, stages["attach_sales"] = measure(lambda: core.attach_sales(combined, m1, m2, s1, s2), memory)
+    result, stages["apply_status"] = measure(lambda: core.apply_status(merged, m1, m2, prog), memory)
+
+    if len(result) + 2 <= core.EXCEL_MAX_ROWS:
+        _, stages["export_excel_layout"] = measure(lambda: core.export_excel_layout(result, m1, m2, prog), memory)
+    else:
+        stages["export_excel_layout"] = {"skipped": f"{len(result):,} dòng vượt giới hạn dòng Excel"}
+    return stages
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def load_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def save_json(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(data, fh, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def find_regressions(run: dict, baseline: dict, time_tol: float, mem_tol: float) -> list:
+    """So run với baseline (cùng cấu trúc {số KH: {bước: số đo}}). Trả về list dòng mô tả regression."""
+    out = []
+    for size, stages in run.items():
+        for stage, cur in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if not base or "skipped" in cur or "skipped" in base:
+                continue
+            if (cur["seconds"] > base["seconds"] * (1 + time_tol)
+                    and cur["seconds"] - base["seconds"] > TIME_NOISE_FLOOR):
+                out.append(f"{size} KH · {stage}: {base['seconds']:.3f}s -> {cur['seconds']:.3f}s")
+            if (cur.get("peak_mib") is not None and base.get("peak_mib")
+                    and cur["peak_mib"] > base["peak_mib"] * (1 + mem_tol)):
+                out.append(f"{size} KH · {stage}: {base['peak_mib']:.1f} MiB -> {cur['peak_mib']:.1f} MiB")
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--sizes", default="10000,100000", help="số KH, cách nhau dấu phẩy (10k..2M)")
+    ap.add_argument("--program", default="KOS&XX", help="CT dùng để đọc sheet doanh số & tính trạng thái")
+    ap.add_argument("--data-dir", default=os.path.join(HERE, "data"), help="thư mục file giả lập (tái sử dụng)")
+    ap.add_argument("--history", default=os.path.join(RESULTS_DIR, "history.json"))
+    ap.add_argument("--baseline", default=os.path.join(RESULTS_DIR, "baseline.json"))
+    ap.add_argument("--save-baseline", action="store_true", help="ghi kết quả lần này làm baseline")
+    ap.add_argument("--no-memory", action="store_true", help="không đo peak bộ nhớ (nhanh gấp đôi)")
+    ap.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE)
+    ap.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE)
+    ap.add_argument("--fail-on-regression", action="store_true", help="thoát mã 1 nếu có regression")
+    args = ap.parse_args()
+
+    import warnings
+    warnings.filterwarnings("ignore")
+
+    run = {}
+    for n in (int(x) for x in args.sizes.split(",") if x.strip()):
+        print(f"== {n:,} KH ==", flush=True)
+        run[str(n)] = stages = run_size(n, args.program, args.data_dir, memory=not args.no_memory)
+        for stage, r in stages.items():
+            if "skipped" in r:
+                print(f"  {stage:<20} bỏ qua ({r['skipped']})")
+            else:
+                mem = f"  peak {r['peak_mib']:9.1f} MiB" if r["peak_mib"] is not None else ""
+                print(f"  {stage:<20} {r['seconds']:9.3f} s{mem}")
+
+    entry = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "program": args.program,
+        "results": run,
+    }
+    history = load_json(args.history, [])
+    history.append(entry)
+    save_json(args.history, history)
+    print(f"Đã ghi lịch sử: {args.history} ({len(history)} lần chạy)")
+
+    baseline = load_json(args.baseline, None)
+    regressions = []
+    if baseline is not None:
+        regressions = find_regressions(run, baseline.get("results", {}),
+                                       args.time_tolerance, args.memory_tolerance)
+        if regressions:
+            print(f"⚠️ Regression so với baseline ({baseline.get('commit') or baseline.get('time')}):")
+            for line in regressions:
+                print(f"  - {line}")
+        else:
+            print("Không có regression so với baseline.")
+    if args.save_baseline:
+        if baseline is not None:
+            for size, stages in baseline.get("results", {}).items():
+                entry["results"].setdefault(size, stages)  # giữ baseline các cỡ không chạy lần này
+        save_json(args.baseline, entry)
+        print(f"Đã lưu baseline: {args.baseline}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
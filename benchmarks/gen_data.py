@@ -0,0 +1,147 @@
+"""
+Sinh dữ liệu giả lập cho benchmark: file trưng bày & file doanh số nhiều sheet.
+
+    python benchmarks/gen_data.py --customers 100000 --out bench_data/
+
+- File trưng bày: đúng layout read_display_excel đọc (tiêu đề ở hàng 3, dữ liệu từ hàng 4,
+  các cột B,F,G,H,K,L,T; các cột khác có dữ liệu nhiễu).
+- File doanh số: mỗi CT 1 sheet, tên sheet lấy theo SHEET_NAME_ALIASES (GVG, KOSXX, ...),
+  hàng tiêu đề không nằm ở hàng 1, mỗi KH có thể có nhiều dòng.
+File Excel giới hạn 1.048.576 dòng / sheet: số KH lớn hơn chỉ dựng được bảng trong bộ nhớ
+(make_display_frame / make_sales_frame) cho các bước không đọc file.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import EXCEL_MAX_ROWS, PROGRAMS, SHEET_NAME_ALIASES
+
+MONTHS = ("T07", "T08")
+DISPLAY_HEADER_ROW = 2     # hàng tiêu đề (0-based), layout cũ của file trưng bày (tiêu đề hàng 3)
+SALES_HEADER_ROW = 2       # hàng tiêu đề sheet doanh số (0-based), 2 hàng trên là tiêu đề báo cáo
+SALES_LINES_PER_CUSTOMER = 1.3  # số dòng doanh số trung bình / KH (KH lặp lại được cộng gộp)
+NPP_COUNT = 40
+
+
+def max_file_customers() -> int:
+    """Số KH tối đa ghi được vào 1 sheet trưng bày."""
+    return EXCEL_MAX_ROWS - DISPLAY_HEADER_ROW - 1
+
+
+def sales_sheet_names() -> dict:
+    """CT -> tên sheet dùng trong file doanh số (ưu tiên alias khác tên chuẩn, ví dụ KOSXX)."""
+    names = {}
+    for alias, prog in SHEET_NAME_ALIASES.items():
+        if prog in PROGRAMS and (prog not in names or alias != prog):
+            names[prog] = alias
+    return names
+
+
+def make_display_frame(n: int, month: str, seed: int = 0) -> pd.DataFrame:
+    """n dòng trưng bày (đúng các cột read_display_excel trả về), KH 0..n-1 lệch nhau giữa các tháng."""
+    rng = np.random.default_rng(seed)
+    ids = rng.permutation(int(n * 1.1))[:n]  # ~10% KH chỉ có ở 1 tháng
+    npp = ids % NPP_COUNT
+    region = np.where(npp % 2 == 0, "MB", "MN")
+    return pd.DataFrame({
+        "Giai đoạn": month,
+        "Mã CTTB": "CT01",
+        "Mã NPP": pd.Series(region).str.cat(pd.Series(npp).astype(str).str.zfill(3)),
+        "Tên NPP": "NPP " + pd.Series(npp).astype(str),
+        "Mã khách hàng": pd.Series(ids).astype(str).str.zfill(8),
+        "Tên khách hàng": "Tạp hoá " + pd.Series(ids).astype(str),
+        "Số suất đăng ký": rng.integers(0, 4, n),
+    })
+
+
+def make_sales_frame(n: int, seed: int = 0) -> pd.DataFrame:
+    """Doanh số đã cộng gộp theo KH (giống kết quả read_sales_excel) cho KH 0..~1.1n."""
+    rng = np.random.default_rng(seed)
+    ids = np.unique(rng.integers(0, int(n * 1.1), int(n * SALES_LINES_PER_CUSTOMER)))
+    return pd.DataFrame({
+        "Mã khách hàng": pd.Series(ids).astype(str).str.zfill(8),
+        "Tổng Doanh số": rng.integers(0, 2_000_000, len(ids)),
+    })
+
+
+def write_display_workbook(path: str, n: int, month: str, seed: int = 0):
+    """Ghi file trưng bày n KH (constant_memory: ghi tuần tự từng dòng)."""
+    import xlsxwriter
+
+    if n > max_file_customers():
+        raise ValueError(f"{n:,} KH vượt giới hạn dòng của Excel ({max_file_customers():,})")
+    df = make_display_frame(n, month, seed)
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    ws = wb.add_worksheet("Trưng bày")
+    ws.write(0, 0, f"BÁO CÁO TRƯNG BÀY {month}")
+    header = ["STT", "Mã CTTB", "Tên CTTB", "Khu vực", "Vùng", "Mã NPP", "Tên NPP", "Giai đoạn",
+              "Tỉnh", "Quận", "Mã khách hàng", "Tên khách hàng", "Địa chỉ", "SĐT", "Kênh",
+              "Loại", "Ngày ĐK", "Ngày duyệt", "Ghi chú", "Số suất đăng ký"]
+    ws.write_row(DISPLAY_HEADER_ROW, 0, header)
+    cols = [df[c].tolist() for c in ("Mã CTTB", "Mã NPP", "Tên NPP", "Giai đoạn",
+                                      "Mã khách hàng", "Tên khách hàng", "Số suất đăng ký")]
+    for i, (cttb, npp, npp_name, m, kh, kh_name, slots) in enumerate(zip(*cols)):
+        # A..T: chỉ B,F,G,H,K,L,T là dữ liệu thật, còn lại là cột nhiễu
+        ws.write_row(DISPLAY_HEADER_ROW + 1 + i, 0, (
+            i + 1, cttb, "Trưng bày kệ", "KV1", "V1", npp, npp_name, m, "Tỉnh", "Quận",
+            kh, kh_name, "Địa chỉ", "0900000000", "GT", "A", "01/07", "02/07", "", int(slots),
+        ))
+    wb.close()
+
+
+def write_sales_workbook(path: str, n: int, seed: int = 0, programs=None):
+    """Ghi file doanh số: mỗi CT 1 sheet (tên alias), ~SALES_LINES_PER_CUSTOMER dòng / KH."""
+    import xlsxwriter
+
+    rows = int(n * SALES_LINES_PER_CUSTOMER)
+    if rows > EXCEL_MAX_ROWS - SALES_HEADER_ROW - 1:
+        raise ValueError(f"{rows:,} dòng doanh số vượt giới hạn dòng của Excel")
+    names = sales_sheet_names()
+    rng = np.random.default_rng(seed)
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    for prog in (programs or list(PROGRAMS)):
+        ws = wb.add_worksheet(names[prog])
+        ws.write(0, 0, f"DOANH SỐ {prog}")
+        ws.write_row(SALES_HEADER_ROW, 0, ["STT", "Mã khách hàng", "Tên khách hàng", "SKU", "Tổng Doanh số"])
+        ids = pd.Series(rng.integers(0, int(n * 1.1), rows)).astype(str).str.zfill(8).tolist()
+        sales = rng.integers(0, 1_500_000, rows).tolist()
+        for i, (kh, value) in enumerate(zip(ids, sales)):
+            ws.write_row(SALES_HEADER_ROW + 1 + i, 0, (i + 1, kh, "KH", "SKU", value))
+    wb.close()
+
+
+def ensure_dataset(folder: str, n: int) -> dict:
+    """Bộ file tb1/tb2/ds1/ds2 cho n KH trong folder (chỉ sinh file chưa có). Trả về {tên: đường dẫn}."""
+    target = os.path.join(folder, f"n{n}")
+    os.makedirs(target, exist_ok=True)
+    files = {}
+    for i, month in enumerate(MONTHS, start=1):
+        for kind, write in (("tb", write_display_workbook), ("ds", write_sales_workbook)):
+            path = os.path.join(target, f"{kind}{i}.xlsx")
+            if not os.path.exists(path):
+                tmp = path + ".tmp.xlsx"
+                if kind == "tb":
+                    write(tmp, n, month, seed=i)
+                else:
+                    write(tmp, n, seed=10 + i)
+                os.replace(tmp, path)
+            files[f"{kind}{i}"] = path
+    return files
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--customers", type=int, default=100_000)
+    ap.add_argument("--out", default="bench_data")
+    args = ap.parse_args()
+    for name, path in ensure_dataset(args.out, args.customers).items():
+        print(f"{name}: {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
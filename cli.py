@@ -0,0 +1,189 @@
+"""
+Chạy xử lý không cần giao diện (dùng cho lịch chạy đêm).
+
+    python cli.py DU_LIEU/ -o KET_QUA/
+    python cli.py manifest.json -o KET_QUA/ --programs NMCD,GVIG
+
+Thư mục đầu vào:
+    DU_LIEU/<CT>/tb1.xlsx, tb2.xlsx        2 file trưng bày của CT (bắt buộc)
+    DU_LIEU/<CT>/ds1.xlsx, ds2.xlsx        2 file doanh số riêng của CT (tuỳ chọn)
+    DU_LIEU/ds1.xlsx, ds2.xlsx             doanh số dùng chung (1 sheet / CT), dùng khi CT không có file riêng
+    (mỗi file có thể là .xlsx, .csv hoặc .parquet)
+
+Manifest JSON (đường dẫn tương đối tính từ thư mục chứa manifest):
+    {"programs": {"NMCD": {"tb1": "...", "tb2": "...", "ds1": "...", "ds2": "..."}},
+     "shared_sales": {"ds1": "...", "ds2": "..."}}
+
+Kết quả cho mỗi CT: file Excel bản chuẩn, danh sách huỷ (Không Đạt) và danh sách
+cảnh báo (Đạt nhưng tháng gần nhất chưa đạt mức tối thiểu); cùng summary.json.
+--consolidated ghi thêm ketqua_gop.xlsx gồm mọi CT (1 sheet / CT + sheet Tổng quan).
+Mã thoát: 0 = mọi CT thành công, 1 = có CT lỗi, 2 = sai tham số / thiếu đầu vào.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from core import (
+    PROGRAMS,
+    SHEET_NAME_ALIASES,
+    enable_diagnostics_log,
+    export_consolidated,
+    export_excel_layout,
+    key_match_report,
+    run_programs,
+    save_snapshot,
+    start_diagnostics,
+    status_summary,
+    stop_diagnostics,
+    warning_cancel_lists,
+)
+
+SLOTS = ("tb1", "tb2", "ds1", "ds2")
+INPUT_EXTENSIONS = (".xlsx", ".csv", ".parquet")  # thứ tự ưu tiên khi có nhiều file cùng tên
+
+
+def _find_input(folder: str, stem: str):
+    """<folder>/<stem>.xlsx | .csv | .parquet (file đầu tiên tồn tại), hoặc None."""
+    for ext in INPUT_EXTENSIONS:
+        path = os.path.join(folder, stem + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _program_code(name: str):
+    """Tên thư mục / khoá manifest -> mã CT chuẩn (chấp nhận alias như KOSXX, GVG)."""
+    code = SHEET_NAME_ALIASES.get(name.strip().upper(), name.strip().upper())
+    return code if code in PROGRAMS else None
+
+
+def jobs_from_dir(root: str) -> dict:
+    shared = {s: _find_input(root, s) for s in ("ds1", "ds2")}
+    jobs = {}
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        prog = _program_code(entry.name) if entry.is_dir() else None
+        if prog is None:
+            continue
+        files = {}
+        for slot in SLOTS:
+            path = _find_input(entry.path, slot)
+            if path:
+                files[slot] = path
+            elif shared.get(slot):
+                files[slot] = shared[slot]
+        jobs[prog] = files
+    return jobs
+
+
+def jobs_from_manifest(path: str) -> dict:
+    with open(path, encoding="utf-8") as fh:
+        manifest = json.load(fh)
+    base = os.path.dirname(os.path.abspath(path))
+    shared = manifest.get("shared_sales") or {}
+    jobs = {}
+    for name, files in (manifest.get("programs") or {}).items():
+        prog = _program_code(name)
+        if prog is None:
+            raise ValueError(f"CT không hợp lệ trong manifest: {name}")
+        merged = {s: files.get(s) or shared.get(s) for s in SLOTS}
+        jobs[prog] = {s: os.path.join(base, p) for s, p in merged.items() if p}
+    return jobs
+
+
+def _safe(label: str) -> str:
+    """Nhãn tháng / mã CT -> phần tên file an toàn (vd '07/2025' -> '07-2025')."""
+    return re.sub(r"[^\w.-]+", "-", str(label), flags=re.UNICODE).strip("-") or "x"
+
+
+def write_outputs(prog: str, result, m1: str, m2: str, out_dir: str, snapshot: bool = False) -> dict:
+    """Ghi 3 file Excel (+ snapshot .parquet nếu cần) của 1 CT, trả về phần tóm tắt cho summary.json."""
+    warning, cancel = warning_cancel_lists(result, m1, m2)
+    stem = f"{_safe(prog)}_{{}}_{_safe(m1)}_{_safe(m2)}.xlsx"
+    files = {}
+    for kind, df in (("ketqua_chuan", result), ("huy", cancel), ("canhbao", warning)):
+        path = os.path.join(out_dir, stem.format(kind))
+        with open(path, "wb") as fh:
+            fh.write(export_excel_layout(df, m1, m2, prog))
+        files[kind] = os.path.basename(path)
+    if snapshot:
+        path = os.path.join(out_dir, stem.format("ketqua")[:-len(".xlsx")] + ".parquet")
+        save_snapshot(result, m1, m2, prog, path)
+        files["snapshot"] = os.path.basename(path)
+    return {
+        "ok": True, "m1": m1, "m2": m2, "rows": int(len(result)),
+        "cancel": int(len(cancel)), "warning": int(len(warning)),
+        "status": status_summary(result), "by_npp": status_summary(result, by_npp=True),
+        "keys": key_match_report(result),
+        "files": files,
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(
+        description="Xử lý trưng bày + doanh số cho mọi CT, xuất Excel & summary.json.")
+    ap.add_argument("input", help="thư mục dữ liệu hoặc file manifest .json")
+    ap.add_argument("-o", "--out", required=True, help="thư mục ghi kết quả")
+    ap.add_argument("--programs", help="chỉ chạy các CT này (phân cách bằng dấu phẩy)")
+    ap.add_argument("--workers", type=int, default=None, help="số process đọc file (mặc định: số CPU; tối đa DSPS_POOL_WORKERS)")
+    ap.add_argument("--snapshots", action="store_true",
+                    help="ghi thêm snapshot .parquet của mỗi CT (mở lại trong app không cần xử lý lại)")
+    ap.add_argument("--consolidated", action="store_true",
+                    help="ghi thêm ketqua_gop.xlsx: mọi CT thành công trong 1 file (1 sheet / CT + Tổng quan)")
+    ap.add_argument("--diagnostics", action="store_true",
+                    help="đo thời gian / bộ nhớ từng bước: log JSON ra stderr và ghi vào summary.json")
+    args = ap.parse_args(argv)
+
+    try:
+        if os.path.isdir(args.input):
+            jobs = jobs_from_dir(args.input)
+        else:
+            jobs = jobs_from_manifest(args.input)
+    except (OSError, ValueError) as e:
+        print(f"Lỗi đầu vào: {e}", file=sys.stderr)
+        return 2
+    if args.programs:
+        wanted = {_program_code(p) for p in args.programs.split(",")}
+        jobs = {p: f for p, f in jobs.items() if p in wanted}
+    if not jobs:
+        print("Không tìm thấy CT nào có dữ liệu.", file=sys.stderr)
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+
+    def on_progress(prog, done, total, msg):
+        print(f"[{prog}] {msg} ({done}/{total} file)", file=sys.stderr)
+
+    if args.diagnostics:
+        enable_diagnostics_log()
+        start_diagnostics(memory=True)
+    started = time.time()
+    results = run_programs(jobs, max_workers=args.workers, on_progress=on_progress)
+
+    summary = {"generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "programs": {}}
+    for prog in jobs:
+        out = results[prog]
+        if not isinstance(out, Exception):
+            try:
+                summary["programs"][prog] = write_outputs(prog, *out, args.out, snapshot=args.snapshots)
+                continue
+            except Exception as e:
+                out = e
+        print(f"[{prog}] Lỗi: {out}", file=sys.stderr)
+        summary["programs"][prog] = {"ok": False, "error": str(out)}
+    done = {p: (out[0], list(out[1:])) for p, out in results.items() if summary["programs"][p]["ok"]}
+    if args.consolidated and done:
+        export_consolidated(done, target=os.path.join(args.out, "ketqua_gop.xlsx"))
+        summary["consolidated"] = "ketqua_gop.xlsx"
+    summary["elapsed_seconds"] = round(time.time() - started, 2)
+    if args.diagnostics:
+        summary["diagnostics"] = stop_diagnostics()
+
+    with open(os.path.join(args.out, "summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, ensure_ascii=False, indent=2)
+    return 0 if all(p["ok"] for p in summary["programs"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
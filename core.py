@@ -0,0 +1,2379 @@
+"""
+Xử lý dữ liệu trưng bày & doanh số: đọc file, gộp tháng, tính trạng thái, xuất Excel.
+Không phụ thuộc Streamlit (app.py chỉ lo giao diện) để chạy được trong process con / CLI.
+"""
+import functools
+import hashlib
+import io
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+import weakref
+import zipfile
+import queue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+# ================== Cấu hình & Danh mục CT ==================
+PROGRAMS = {
+    "NMCD": "Nước mắm cao đạm",
+    "DHLM": "Dầu hào, Nước tương",
+    "KOS&XX": "Cá KOS & Xúc xích",
+    "GVIG": "Gia vị gói",
+    "LTLKC": "Lẩu Thái & Lẩu Kim chi",
+}
+
+# Chuẩn hoá tên sheet trong file Doanh số (tránh lệch như GVG, KOSXX)
+SHEET_NAME_ALIASES = {
+    "NMCD": "NMCD",
+    "DHLM": "DHLM",
+    "GVG": "GVIG",     # lưu GVG -> mình hiểu là GVIG
+    "GVIG": "GVIG",
+    "LTLKC": "LTLKC",
+    "KOSXX": "KOS&XX", # lưu KOSXX -> mình hiểu là KOS&XX
+    "KOS&XX": "KOS&XX",
+}
+# Mức tối thiểu / 1 suất theo CT (bạn đổi số ở đây nếu chính sách thay đổi)
+PER_SLOT_MIN = {
+    "NMCD": 150_000,  # Nước mắm cao đạm
+    "DHLM": 100_000,  # Dầu hào, Nước tương
+    "KOS&XX": 200_000,  # Cá KOS & Xúc xích
+    "GVIG": 300_000,  # Gia vị gói (Miền Trung/Bắc)
+    "LTLKC": 80_000,   # Lẩu Thái & Lẩu Kim chi
+}
+# Quy tắc ghi đè mức tối thiểu / 1 suất (quy tắc đứng trước được ưu tiên):
+#   (CT, mẫu tìm trong 'Mã NPP' - None = mọi NPP, nhãn tháng 'Giai đoạn' - None = mọi tháng, mức / suất)
+# Dòng không khớp quy tắc nào dùng PER_SLOT_MIN. Chính sách mới chỉ cần thêm dòng ở đây.
+SLOT_MIN_RULES = [
+    ("KOS&XX", "MB", None, 200_000),  # KOS&XX miền Bắc (Mã NPP chứa 'MB')
+    ("KOS&XX", None, None, 300_000),  # KOS&XX miền khác
+]
+def _resolve_sheet_name(sheet_names: list, program_code: str) -> str:
+    """
+    Trả về tên sheet thực tế trong file doanh số tương ứng với program_code.
+    - Chấp nhận các alias: GVG~GVIG, KOSXX~KOS&XX
+    - Không phân biệt hoa/thường, bỏ khoảng trắng dư.
+    """
+    # chuẩn hoá code được chọn
+    want = SHEET_NAME_ALIASES.get(program_code.strip().upper(), program_code.strip().upper())
+
+    # map sheet trong file -> dạng chuẩn để so
+    norm2real = {}
+    for s in sheet_names:
+        norm = s.strip().upper()
+        norm = SHEET_NAME_ALIASES.get(norm, norm)  # đổi alias về tên chuẩn
+        norm2real[norm] = s  # lưu lại tên thật trong file
+
+    if want in norm2real:
+        return norm2real[want]
+
+    # fallback: thử so khớp gần đúng
+    for norm, real in norm2real.items():
+        if want in norm or norm in want:
+            return real
+
+    raise ValueError(
+        f"Không tìm thấy sheet cho chương trình '{program_code}'. "
+        f"Sheets có trong file: {', '.join(sheet_names)}"
+    )
+
+# ================== Chẩn đoán: thời gian / bộ nhớ từng bước ==================
+# Tắt (mặc định): stage() trả về 1 đối tượng rỗng dùng chung -> gần như không tốn gì.
+# Bật cho luồng hiện tại bằng start_diagnostics() (panel chẩn đoán của app), hoặc ghi log mọi
+# bước bằng biến môi trường DSPS_DIAGNOSTICS_LOG=1. Mỗi bước cũng được ghi 1 dòng JSON vào
+# logger "dsps.diagnostics".
+DIAGNOSTICS_LOG = os.environ.get("DSPS_DIAGNOSTICS_LOG", "") not in ("", "0")
+_diag_logger = logging.getLogger("dsps.diagnostics")
+_diag_local = threading.local()
+_diag_memory_users = 0
+_diag_memory_lock = threading.Lock()
+
+class _NullStage:
+    """Bước không đo (chẩn đoán đang tắt)."""
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def set(self, **info):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """1 bước đang đo: thời gian, peak bộ nhớ (tracemalloc, nếu bật) và thông tin thêm (số dòng, byte...)."""
+    __slots__ = ("name", "info", "records", "start", "base", "peak", "parent")
+
+    def __init__(self, name: str, info: dict, records):
+        self.name, self.info, self.records = name, info, records
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def __enter__(self):
+        stack = _diag_local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        self.peak = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None and self.parent.peak is not None:
+                self.parent.peak = max(self.parent.peak, peak)  # giữ peak của bước cha trước khi reset
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _diag_local.stack.pop()
+        record = {"stage": self.name, "seconds": round(seconds, 4), "depth": len(_diag_local.stack),
+                  "at": round(self.start - getattr(_diag_local, "t0", self.start), 4)}
+        if self.peak is not None and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record["peak_bytes"] = self.peak - self.base
+            if self.parent is not None and self.parent.peak is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        record.update(self.info)
+        if self.records is not None:
+            self.records.append(record)
+        _diag_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        return False
+
+def stage(name: str, **info):
+    """
+    Đo 1 bước:  with stage("combine_two_months", rows=len(df)) as s: ...; s.set(out_rows=n)
+    Chẩn đoán tắt -> trả về _NULL_STAGE (không đo, không ghi gì).
+    Có việc nền đang theo dõi luồng này (progress_scope) -> báo tên bước cho việc đó.
+    """
+    hook = getattr(_progress_local, "hook", None)
+    if hook is not None:
+        hook({"stage": name})
+    records = getattr(_diag_local, "records", None)
+    if records is None and not DIAGNOSTICS_LOG:
+        return _NULL_STAGE
+    return _Stage(name, info, records)
+
+def start_diagnostics(memory: bool = False) -> list:
+    """
+    Bắt đầu ghi các bước của luồng hiện tại; trả về list record (được thêm dần).
+    memory=True: đo thêm peak bộ nhớ bằng tracemalloc (chậm hơn khi bật).
+    Gọi lại khi đang bật -> bỏ phiên cũ, bắt đầu phiên mới.
+    """
+    global _diag_memory_users
+    stop_diagnostics()
+    _diag_local.records = []
+    _diag_local.stack = []
+    _diag_local.t0 = time.perf_counter()  # mốc cho trường "at" (giây kể từ lúc bắt đầu)
+    if memory:
+        with _diag_memory_lock:
+            _diag_memory_users += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        _diag_local.memory = True
+    return _diag_local.records
+
+def stop_diagnostics() -> list:
+    """Dừng ghi cho luồng hiện tại; trả về các record đã ghi (hoặc [] nếu chưa bật)."""
+    global _diag_memory_users
+    records = getattr(_diag_local, "records", None)
+    _diag_local.records = None
+    if getattr(_diag_local, "memory", False):
+        _diag_local.memory = False
+        with _diag_memory_lock:
+            _diag_memory_users -= 1
+            if _diag_memory_users <= 0 and tracemalloc.is_tracing():
+                _diag_memory_users = 0
+                tracemalloc.stop()
+    return records or []
+
+def merge_diagnostics(records: list, started: float, **info):
+    """
+    Thêm record ghi ở process khác (process con đọc file; bắt đầu ghi lúc `started`, time.time())
+    vào phiên ghi của luồng hiện tại, lồng dưới bước đang chạy. Luồng chưa bật chẩn đoán -> bỏ qua.
+    """
+    own = getattr(_diag_local, "records", None)
+    if own is None:
+        return
+    offset = started - (time.time() - (time.perf_counter() - _diag_local.t0))  # mốc "at" của luồng này
+    depth = len(getattr(_diag_local, "stack", ()))
+    for r in records:
+        own.append(dict(r, depth=r["depth"] + depth, at=round(r["at"] + offset, 4), **info))
+
+def _stage_info(args, out, source: bool) -> dict:
+    """Số dòng kết quả / byte đầu vào (source=True: tham số đầu là file) & đầu ra cho record của staged()."""
+    info = {}
+    if source and args:
+        size = source_size(args[0])
+        if size is not None:
+            info["in_bytes"] = size
+    first = out[0] if isinstance(out, tuple) and out else out
+    if isinstance(first, pd.DataFrame):
+        info["rows"] = len(first)
+    elif isinstance(out, (bytes, bytearray)):
+        info["out_bytes"] = len(out)
+    return info
+
+def staged(name: str = None, source: bool = False):
+    """
+    Decorator: đo cả hàm như 1 bước (kèm số dòng / byte); chẩn đoán tắt thì gọi thẳng hàm.
+    source=True: tham số đầu là file nguồn -> ghi thêm kích thước file.
+    """
+    def wrap(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            s = stage(label)
+            if s is _NULL_STAGE:
+                return fn(*args, **kwargs)
+            with s:
+                out = fn(*args, **kwargs)
+                s.set(**_stage_info(args, out, source))
+            return out
+        return inner
+    return wrap
+
+def enable_diagnostics_log(stream=None):
+    """Ghi các record chẩn đoán ra stream (mặc định stderr), mỗi bước 1 dòng JSON. Gọi nhiều lần không sao."""
+    if not any(getattr(h, "_dsps_diag", False) for h in _diag_logger.handlers):
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler._dsps_diag = True
+        _diag_logger.addHandler(handler)
+    _diag_logger.setLevel(logging.INFO)
+
+if DIAGNOSTICS_LOG:
+    enable_diagnostics_log()
+
+# ================== Tiến độ & huỷ (việc chạy nền) ==================
+# Mỗi luồng / process con có thể gắn 1 hook nhận {"stage": tên bước} (từ stage()) và
+# {"rows": số dòng đã đọc} (từ các hàm đọc file). Hook cũng là điểm kiểm tra huỷ:
+# việc đã bị huỷ -> hook ném JobCancelled, bước đang chạy dừng ở lần báo kế tiếp.
+PROGRESS_ROW_STEP = 50_000  # báo tiến độ sau mỗi ngần này dòng khi đọc streaming
+_progress_local = threading.local()
+
+class JobCancelled(Exception):
+    """Việc xử lý bị huỷ giữa chừng."""
+
+def report_progress(**info):
+    """Báo tiến độ cho hook của luồng hiện tại (không có hook -> bỏ qua)."""
+    hook = getattr(_progress_local, "hook", None)
+    if hook is not None:
+        hook(info)
+
+class progress_scope:
+    """with progress_scope(hook): ... -> gắn hook cho luồng hiện tại, trả lại hook cũ khi ra."""
+    def __init__(self, hook):
+        self.hook = hook
+    def __enter__(self):
+        self.prev = getattr(_progress_local, "hook", None)
+        _progress_local.hook = self.hook
+        return self
+    def __exit__(self, *exc):
+        _progress_local.hook = self.prev
+        return False
+
+def source_size(file):
+    """Kích thước (byte) của nguồn file nếu biết được: đường dẫn, bytes, UploadedFile/BytesIO."""
+    if isinstance(file, (str, os.PathLike)):
+        try:
+            return os.path.getsize(file)
+        except OSError:
+            return None
+    if isinstance(file, (bytes, bytearray)):
+        return len(file)
+    if hasattr(file, "getbuffer"):
+        return file.getbuffer().nbytes
+    return getattr(file, "size", None)
+
+# ================== Helpers ==================
+BASE_COLS = ["Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng"]
+
+@staged(source=True)
+def read_display_excel(file) -> pd.DataFrame:
+    """
+    Đọc sheet đầu của file trưng bày: dò hàng tiêu đề & cột theo tên (detect_display_layout),
+    rồi stream 1 lần chỉ các cột cần. File không có tiêu đề nhận ra được: layout cũ
+    (tiêu đề hàng 3, cột B,F,G,H,K,L,T).
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        return _normalize_display(_stream_display_sheet(wb.worksheets[0]))
+    finally:
+        wb.close()
+
+def extract_month_label(df: pd.DataFrame) -> str:
+    """Lấy nhãn tháng từ cột 'Giai đoạn' (giá trị phổ biến nhất)."""
+    vals = df["Giai đoạn"].dropna().astype(str).str.strip()
+    if vals.empty:
+        return "Tháng ?"
+    try:
+        return vals.mode().iloc[0]
+    except Exception:
+        return vals.iloc[0]
+
+def month_slots(df: pd.DataFrame):
+    """Số suất 1 tháng trưng bày cộng gộp theo BASE_COLS. Trả về (slots, tháng)."""
+    m = extract_month_label(df)
+    slots = (df.groupby(BASE_COLS, as_index=False)["Số suất đăng ký"]
+               .sum().rename(columns={"Số suất đăng ký": f"Giai đoạn - {m}"}))
+    return slots, m
+
+@staged()
+def combine_two_months(d1: pd.DataFrame, d2: pd.DataFrame):
+    """Gộp 2 tháng theo key BASE_COLS. Trả về (out, m1, m2)."""
+    d1_slots, m1 = month_slots(d1)
+    d2_slots, m2 = month_slots(d2)
+
+    out = d1_slots.merge(d2_slots, on=BASE_COLS, how="outer").fillna(0)
+    out[f"Giai đoạn - {m1}"] = out[f"Giai đoạn - {m1}"].astype(int)
+    out[f"Giai đoạn - {m2}"] = out[f"Giai đoạn - {m2}"].astype(int)
+
+    out[f"Doanh số - {m1}"] = 0
+    out[f"Doanh số - {m2}"] = 0
+    out["TRẠNG THÁI"] = ""
+
+    cols = BASE_COLS + [f"Giai đoạn - {m1}", f"Giai đoạn - {m2}",
+                        f"Doanh số - {m1}", f"Doanh số - {m2}", "TRẠNG THÁI"]
+    out = out[cols].sort_values(["Mã NPP","Tên NPP","Tên khách hàng"]).reset_index(drop=True)
+    return out, m1, m2
+
+# Tên cột (viết thường) được chấp nhận trong file doanh số
+SALES_ID_ALIASES = ["mã khách hàng","ma khach hang","mã kh","ma kh","customerid","customer id","makh","ma_kh","mã_kh"]
+SALES_TOTAL_ALIASES = ["tổng doanh số","tong doanh so","tongdoanhso","doanh so","doanh_số","sum sales","sales"]
+SALES_HEADER_SCAN_ROWS = 10  # số dòng đầu sheet được dò để tìm hàng tiêu đề
+
+def _sales_cell_key(v):
+    """Giá trị ô mã KH -> chuỗi giống pd.read_excel + astype(str).str.strip()."""
+    if v is None:
+        return None
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)  # pandas cũng đổi 123.0 -> 123 khi đọc Excel
+    return str(v).strip()
+
+def _sales_cell_number(v):
+    """Giá trị ô doanh số -> số (giống pd.to_numeric(errors='coerce').fillna(0))."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return v if v == v else 0  # NaN -> 0
+    if isinstance(v, str):
+        try:
+            return float(v.strip())
+        except ValueError:
+            return 0
+    return 0
+
+def _header_key(v) -> str:
+    """Tên cột để so alias: Unicode NFC (file cp1258 dùng dấu tổ hợp), bỏ khoảng trắng, chữ thường."""
+    return unicodedata.normalize("NFC", str(v)).strip().lower() if v is not None else ""
+
+def _find_sales_header(rows):
+    """
+    Dò hàng tiêu đề trong các dòng đầu: trả về (số thứ tự hàng 1-based, idx cột mã KH, idx cột doanh số).
+    Chọn cột đầu tiên khớp alias, giống cách đoán cột cũ.
+    """
+    seen_id = False
+    for r, row in enumerate(rows, start=1):
+        names = [_header_key(v) for v in row]
+        id_idx = next((i for i, c in enumerate(names) if c in SALES_ID_ALIASES), None)
+        sales_idx = next((i for i, c in enumerate(names) if c in SALES_TOTAL_ALIASES), None)
+        if id_idx is not None and sales_idx is not None:
+            return r, id_idx, sales_idx
+        seen_id = seen_id or id_idx is not None
+    if not seen_id:
+        raise ValueError("Không tìm thấy cột Mã khách hàng trong file doanh số")
+    raise ValueError("Không tìm thấy cột 'Tổng Doanh số' trong file doanh số")
+
+def _stream_sales_sheet(ws) -> pd.DataFrame:
+    """
+    Đọc 1 sheet doanh số (openpyxl read_only) theo kiểu streaming:
+    dò hàng tiêu đề, rồi chỉ đọc 2 cột mã KH / doanh số và cộng dồn theo KH.
+    Bộ nhớ tăng theo số KH, không theo độ rộng sheet.
+    """
+    ws.reset_dimensions()  # không tin kích thước ghi trong file (hay bị sai)
+    header_row, id_idx, sales_idx = _find_sales_header(
+        ws.iter_rows(max_row=SALES_HEADER_SCAN_ROWS, values_only=True))
+
+    lo = min(id_idx, sales_idx)
+    id_i, sales_i = id_idx - lo, sales_idx - lo
+    totals = {}
+    rows = ws.iter_rows(min_row=header_row + 1, min_col=lo + 1,
+                        max_col=max(id_idx, sales_idx) + 1, values_only=True)
+    for n, row in enumerate(rows, start=1):
+        if not n % PROGRESS_ROW_STEP:
+            report_progress(rows=n)
+        key = _sales_cell_key(row[id_i])
+        if key is None:
+            continue
+        totals[key] = totals.get(key, 0) + _sales_cell_number(row[sales_i])
+
+    # mã chuẩn hoá (canonical_customer_keys) có thể gộp vài mã gốc ('00123', '123') -> cộng lại
+    return _aggregate_sales_columns(pd.Series(list(totals.keys()), dtype=object),
+                                    pd.Series(list(totals.values())))
+
+@staged(source=True)
+def read_sales_workbook(file, program_codes) -> dict:
+    """
+    Đọc file doanh số dùng chung nhiều CT: mở workbook 1 lần, đọc sheet của từng CT
+    (qua SHEET_NAME_ALIASES), mỗi sheet chỉ stream 1 lần kể cả khi nhiều CT trùng sheet.
+    Trả về {CT: DataFrame ['Mã khách hàng','Tổng Doanh số']}; CT không có sheet
+    thì giá trị là ValueError (lỗi CT nào chỉ ảnh hưởng CT đó).
+    """
+    from openpyxl import load_workbook
+
+    with stage("open_sales_workbook", in_bytes=source_size(file)):
+        wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        out, by_sheet = {}, {}
+        for prog in program_codes:
+            try:
+                sheet = _resolve_sheet_name(wb.sheetnames, prog)
+                if sheet not in by_sheet:
+                    with stage("read_sales_sheet", sheet=sheet) as st_:
+                        by_sheet[sheet] = _stream_sales_sheet(wb[sheet])
+                        st_.set(rows=len(by_sheet[sheet]))
+                out[prog] = by_sheet[sheet]
+            except ValueError as e:
+                out[prog] = e
+        return out
+    finally:
+        wb.close()
+
+def read_sales_excel(file, program_sheet_name: str) -> pd.DataFrame:
+    """
+    Đọc file doanh số: chỉ sheet trùng tên chương trình (ví dụ 'NMCD').
+    Tự chuẩn hoá alias sheet: GVG->GVIG, KOSXX->KOS&XX, ...
+    Trả về: ['Mã khách hàng', 'Tổng Doanh số'] đã cộng gộp theo KH.
+    """
+    out = read_sales_workbook(file, [program_sheet_name])[program_sheet_name]
+    if isinstance(out, Exception):
+        raise out
+    return out
+
+# ================== Đọc CSV / Parquet (xuất thẳng từ hệ thống nguồn) ==================
+# Cùng chuẩn hoá như đọc Excel: file trưng bày theo tên cột (DISPLAY_HEADER_ALIASES, hoặc vị trí
+# B,F,G,H,K,L,T như sheet Excel lưu ra CSV), file doanh số theo SALES_ID_ALIASES / SALES_TOTAL_ALIASES.
+DISPLAY_COLS = ["Giai đoạn"] + BASE_COLS + ["Số suất đăng ký"]
+DISPLAY_EXCEL_POSITIONS = [7, 1, 5, 6, 10, 11, 19]  # vị trí (0-based) H,B,F,G,K,L,T theo DISPLAY_COLS
+# Tên cột (viết thường) được chấp nhận trong file trưng bày, theo DISPLAY_COLS; thứ tự = ưu tiên
+# (tên chuẩn đứng đầu), xem _display_columns
+DISPLAY_HEADER_ALIASES = {
+    "Giai đoạn": ["giai đoạn","giai doan","giai_đoạn","kỳ","ky","tháng","thang","period"],
+    "Mã CTTB": ["mã cttb","ma cttb","mã_cttb","cttb","mã chương trình","ma chuong trinh","mã ct trưng bày"],
+    "Mã NPP": ["mã npp","ma npp","mã_npp","ma_npp","manpp","npp code","mã nhà phân phối","ma nha phan phoi"],
+    "Tên NPP": ["tên npp","ten npp","tên_npp","ten_npp","npp name","tên nhà phân phối","ten nha phan phoi","nhà phân phối"],
+    "Mã khách hàng": SALES_ID_ALIASES,
+    "Tên khách hàng": ["tên khách hàng","ten khach hang","tên kh","ten kh","tên_kh","ten_kh","customer name","khách hàng"],
+    "Số suất đăng ký": ["số suất đăng ký","so suat dang ky","số suất đk","so suat dk","số suất","so suat","suất đăng ký","slots"],
+}
+# Cột tên CT trong file doanh số dạng bảng (1 file cho nhiều CT thay cho nhiều sheet)
+SALES_PROGRAM_ALIASES = ["ct","mã ct","ma ct","chương trình","chuong trinh","program","sheet"]
+CSV_ENCODINGS = ["utf-8-sig", "cp1258", "utf-16"]
+
+def input_format(file) -> str:
+    """'xlsx' | 'parquet' | 'csv' theo nội dung đầu file (file upload gửi sang process con không còn tên)."""
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as fh:
+            head = fh.read(4)
+    elif isinstance(file, (bytes, bytearray)):
+        head = bytes(file[:4])
+    else:
+        pos = file.tell()
+        head = file.read(4)
+        file.seek(pos)
+    if head.startswith(b"PK"):
+        return "xlsx"
+    if head == b"PAR1":
+        return "parquet"
+    return "csv"
+
+def _as_source(file):
+    """bytes -> BytesIO; file-like -> quay về đầu (có thể đọc lại nhiều lần)."""
+    if isinstance(file, (bytes, bytearray)):
+        return BytesIO(file)
+    if hasattr(file, "seek"):
+        file.seek(0)
+    return file
+
+def _csv_encodings(sample: bytes) -> list:
+    """
+    Bảng mã thử cho CSV: có BOM UTF-16 (FF FE / FE FF) -> chỉ utf-16; không thì CSV_ENCODINGS trừ utf-16
+    (cp1258 giải mã được gần như mọi chuỗi byte, kể cả BOM UTF-16, nên phải nhận BOM trước).
+    """
+    if sample.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return ["utf-16"]
+    return [e for e in CSV_ENCODINGS if e != "utf-16"]
+
+def _read_csv(file, **kwargs) -> pd.DataFrame:
+    """pd.read_csv tự đoán dấu phân cách (, ; tab |) và bảng mã (_csv_encodings)."""
+    file = _as_source(file)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as fh:
+            sample = fh.read(65536)
+    else:
+        sample = file.read(65536)
+        file.seek(0)
+    encodings = _csv_encodings(sample)
+    for encoding in encodings:
+        try:
+            if encoding == "utf-16":
+                # UTF-16: tách dòng sau khi giải mã (byte '\n' nằm giữa 1 ký tự 2 byte)
+                first = sample.decode(encoding, errors="ignore").split("\n", 1)[0]
+            else:
+                first = sample.split(b"\n", 1)[0].decode(encoding)  # chỉ dòng đầu: không cắt giữa ký tự
+            sep = max([",", ";", "\t", "|"], key=first.count)
+            return pd.read_csv(file, sep=sep, encoding=encoding, **kwargs)
+        except UnicodeError:
+            file = _as_source(file)
+    raise ValueError(f"Không đọc được file CSV (đã thử bảng mã {', '.join(encodings)})")
+
+def _normalize_display(df: pd.DataFrame) -> pd.DataFrame:
+    """Chuẩn hoá bảng trưng bày đã đặt tên cột DISPLAY_COLS (dùng chung cho Excel / CSV / Parquet)."""
+    # mã KH giữ nguyên chuỗi gốc để hiển thị / xuất; dạng chuẩn chỉ dùng để ghép (customer_key_codes)
+    has_key = canonical_customer_keys(df["Mã khách hàng"]).notna()
+    for c in ["Mã CTTB","Mã NPP","Tên NPP","Mã khách hàng","Tên khách hàng","Giai đoạn"]:
+        df[c] = df[c].astype(str).str.strip()
+    df = df[(df["Mã CTTB"]!="") & has_key & (df["Giai đoạn"]!="")].copy()
+    df["Số suất đăng ký"] = pd.to_numeric(df["Số suất đăng ký"], errors="coerce").fillna(0).astype(int)
+    return df[DISPLAY_COLS]
+
+def _display_columns(columns) -> list:
+    """
+    Vị trí các cột DISPLAY_COLS trong hàng tiêu đề, None nếu thiếu cột nào. Mỗi cột lấy theo thứ tự
+    ưu tiên của DISPLAY_HEADER_ALIASES (tên chuẩn trước): có 'Giai đoạn' thì không lấy 'Tháng'.
+    Alias phụ khớp nhiều cột -> ValueError (không đoán).
+    """
+    names = [_header_key(c) for c in columns]
+    idx = []
+    for col in DISPLAY_COLS:
+        for rank, alias in enumerate(DISPLAY_HEADER_ALIASES[col]):
+            hits = [i for i, n in enumerate(names) if n == alias]
+            if len(hits) > 1 and rank > 0:
+                raise ValueError(f"File trưng bày có nhiều cột '{columns[hits[0]]}', "
+                                 f"không xác định được cột '{col}'")
+            if hits:
+                idx.append(hits[0])
+                break
+        else:
+            return None
+    return idx
+
+# ----- Layout sheet trưng bày: dò 1 lần, nhớ theo chữ ký hàng tiêu đề -----
+# Chữ ký = vị trí hàng + tên các ô của hàng tiêu đề; file sau cùng layout (cùng mẫu xuất của vùng)
+# nhận ngay hàng tiêu đề & vị trí cột đã nhớ, không dò alias / layout cũ lại. Lưu cạnh cache đọc file
+# (process con đọc file cũng dùng được).
+DISPLAY_LEGACY_HEADER_ROW = 3  # layout cũ: tiêu đề hàng 3, cột theo DISPLAY_EXCEL_POSITIONS
+DISPLAY_LAYOUTS_FILE = "display_layouts.json"  # trong PARSE_CACHE_DIR
+DISPLAY_LAYOUTS_MAX = 500
+DISPLAY_LAYOUTS_VERSION = 2  # tăng khi đổi cách dò để bỏ layout đã nhớ
+_display_layouts = {}
+_DISPLAY_LAYOUTS_LOCK = threading.Lock()
+
+def _layout_signature(row_no: int, row) -> str:
+    names = [_header_key(v) for v in row]
+    while names and not names[-1]:
+        names.pop()
+    key = json.dumps([DISPLAY_LAYOUTS_VERSION, row_no, names], ensure_ascii=False)
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+def _known_display_layouts() -> dict:
+    """Layout đã nhớ {chữ ký: {"row", "cols"}} (nạp từ đĩa ở lần dùng đầu của process)."""
+    with _DISPLAY_LAYOUTS_LOCK:
+        if not _display_layouts:
+            try:
+                with open(os.path.join(PARSE_CACHE_DIR, DISPLAY_LAYOUTS_FILE), encoding="utf-8") as fh:
+                    _display_layouts.update(json.load(fh))
+            except (OSError, ValueError):
+                pass
+        return _display_layouts
+
+def _atomic_write(path: str, write):
+    """
+    Ghi nguyên tử: write(đường dẫn tạm) rồi os.replace -> process / phiên khác không đọc phải file dở.
+    Lỗi khi ghi -> xoá file tạm, ném lại lỗi.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _remember_display_layout(signature: str, row: int, cols: list):
+    with _DISPLAY_LAYOUTS_LOCK:
+        _display_layouts.pop(signature, None)
+        _display_layouts[signature] = {"row": row, "cols": cols}
+        while len(_display_layouts) > DISPLAY_LAYOUTS_MAX:
+            _display_layouts.pop(next(iter(_display_layouts)))
+        snapshot = dict(_display_layouts)
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        def write(tmp):
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(snapshot, fh)
+        _atomic_write(os.path.join(PARSE_CACHE_DIR, DISPLAY_LAYOUTS_FILE), write)
+    except OSError:
+        pass  # chỉ để tăng tốc, lỗi ghi không ảnh hưởng kết quả
+
+def detect_display_layout(rows):
+    """
+    Từ các dòng đầu sheet trưng bày: (hàng tiêu đề 1-based, vị trí cột theo DISPLAY_COLS, layout đã nhớ?).
+    Hàng có chữ ký đã nhớ -> dùng luôn; không thì dò theo DISPLAY_HEADER_ALIASES; không hàng nào khớp
+    -> layout cũ nếu sheet đủ cột. Không đoán được thì báo lỗi thay vì đọc nhầm cột.
+    """
+    rows = list(rows)
+    signatures = [_layout_signature(r, row) for r, row in enumerate(rows, start=1)]
+    known = _known_display_layouts()
+    for sig in signatures:
+        if sig in known:
+            return known[sig]["row"], known[sig]["cols"], True
+    found = next(((r, idx) for r, idx in ((r, _display_columns(row)) for r, row in enumerate(rows, start=1))
+                  if idx is not None), None)
+    if found is None:
+        legacy = DISPLAY_LEGACY_HEADER_ROW
+        if len(rows) < legacy or len(rows[legacy - 1]) <= max(DISPLAY_EXCEL_POSITIONS):
+            raise ValueError("File trưng bày thiếu cột (cần: " + ", ".join(DISPLAY_COLS) + ")")
+        found = (legacy, list(DISPLAY_EXCEL_POSITIONS))
+    _remember_display_layout(signatures[found[0] - 1], *found)
+    return found[0], found[1], False
+
+def _excel_like_column(s: pd.Series) -> pd.Series:
+    """Cột giá trị ô openpyxl -> như pd.read_excel: ô trống NaN, số nguyên dạng float (5.0) thành int."""
+    if s.dtype == object:
+        if pd.api.types.infer_dtype(s, skipna=True) in ("string", "empty", "integer", "datetime"):
+            return s.fillna(np.nan)
+        return s.map(lambda v: int(v) if isinstance(v, float) and v.is_integer() else v).fillna(np.nan)
+    if s.dtype.kind == "f":
+        whole = (s % 1 == 0).to_numpy()
+        if whole.any():
+            s = s.astype(object)
+            s[whole] = s[whole].astype(np.int64)
+    return s
+
+def _stream_display_sheet(ws) -> pd.DataFrame:
+    """
+    Đọc 1 sheet trưng bày (openpyxl read_only): dò layout ở vài dòng đầu, rồi stream 1 lần
+    chỉ khoảng cột cần (từ cột trái nhất tới phải nhất của DISPLAY_COLS). Trả về bảng cột DISPLAY_COLS.
+    """
+    ws.reset_dimensions()  # không tin kích thước ghi trong file (hay bị sai)
+    header_row, idx, _ = detect_display_layout(ws.iter_rows(max_row=SALES_HEADER_SCAN_ROWS, values_only=True))
+    lo, hi = min(idx), max(idx)
+    records = []
+    rows = ws.iter_rows(min_row=header_row + 1, min_col=lo + 1, max_col=hi + 1, values_only=True)
+    for n, row in enumerate(rows, start=1):
+        if not n % PROGRESS_ROW_STEP:
+            report_progress(rows=n)
+        records.append(row)
+    while records and all(v is None for v in records[-1]):
+        records.pop()  # pd.read_excel cũng bỏ các dòng trống cuối sheet
+    raw = pd.DataFrame.from_records(records, columns=range(hi - lo + 1))
+    return pd.DataFrame({c: _excel_like_column(raw[i - lo]) for c, i in zip(DISPLAY_COLS, idx)})
+
+@staged(source=True)
+def read_display_table(file, fmt: str = None) -> pd.DataFrame:
+    """
+    Đọc file trưng bày CSV / Parquet. Cột lấy theo tên (Mã CTTB, Mã NPP, ..., Số suất đăng ký);
+    CSV không có các tên đó ở hàng đầu thì dò hàng tiêu đề trong các dòng đầu, rồi mới
+    lấy theo vị trí B,F,G,H,K,L,T (sheet Excel lưu ra CSV: tiêu đề ở hàng 3).
+    """
+    fmt = fmt or input_format(file)
+    if fmt == "parquet":
+        df = pd.read_parquet(_as_source(file))
+        idx = _display_columns(df.columns)
+        if idx is None and len(df.columns) > max(DISPLAY_EXCEL_POSITIONS):
+            idx = DISPLAY_EXCEL_POSITIONS
+    else:
+        head = _read_csv(file, header=None, nrows=SALES_HEADER_SCAN_ROWS, dtype=str, keep_default_na=False)
+        row = next((r for r in range(len(head)) if _display_columns(head.iloc[r]) is not None), None)
+        if row is None and head.shape[1] > max(DISPLAY_EXCEL_POSITIONS):
+            row = 2
+        df = _read_csv(file, skiprows=row or 0, dtype=str)  # giữ mã dạng chuỗi gốc ('001')
+        idx = _display_columns(df.columns)
+        if idx is None and len(df.columns) > max(DISPLAY_EXCEL_POSITIONS):
+            idx = DISPLAY_EXCEL_POSITIONS
+    if idx is None:
+        raise ValueError("File trưng bày thiếu cột (cần: " + ", ".join(DISPLAY_COLS) + ")")
+    df = df.iloc[:, idx]
+    df.columns = DISPLAY_COLS
+    return _normalize_display(df).reset_index(drop=True)
+
+def read_display_file(file) -> pd.DataFrame:
+    """Đọc file trưng bày bất kỳ định dạng (.xlsx / .csv / .parquet)."""
+    fmt = input_format(file)
+    df = read_display_excel(_as_source(file)) if fmt == "xlsx" else read_display_table(file, fmt)
+    report_progress(rows=len(df))
+    return df
+
+def _aggregate_sales_columns(ids: pd.Series, values: pd.Series) -> pd.DataFrame:
+    """Cộng doanh số theo mã KH đã chuẩn hoá (canonical_customer_keys); bỏ dòng không có mã."""
+    keys = canonical_customer_keys(ids)
+    keep = keys.notna().to_numpy()
+    if values.dtype == object:
+        values = values.astype(str).str.strip()
+    amounts = pd.to_numeric(values[keep], errors="coerce").fillna(0)
+    out = amounts.groupby(keys[keep].to_numpy(), sort=True).sum()
+    return pd.DataFrame({"Mã khách hàng": out.index.astype(str), "Tổng Doanh số": out.to_numpy()})
+
+@staged(source=True)
+def read_sales_table(file, program_codes, fmt: str = None) -> dict:
+    """
+    Đọc file doanh số CSV / Parquet. Trả về giống read_sales_workbook: {CT: DataFrame | ValueError}.
+    Có cột tên CT (SALES_PROGRAM_ALIASES) -> mỗi CT lấy các dòng của mình (so tên như sheet);
+    không có -> cả bảng dùng cho mọi CT được hỏi.
+    """
+    fmt = fmt or input_format(file)
+    if fmt == "parquet":
+        df = pd.read_parquet(_as_source(file))
+        _, id_idx, sales_idx = _find_sales_header([list(df.columns)])
+    else:
+        head = _read_csv(file, header=None, nrows=SALES_HEADER_SCAN_ROWS, dtype=str, keep_default_na=False)
+        row, id_idx, sales_idx = _find_sales_header(head.itertuples(index=False))
+        df = _read_csv(file, skiprows=row - 1)
+    report_progress(rows=len(df))
+    names = [_header_key(c) for c in df.columns]
+    prog_idx = next((i for i, c in enumerate(names) if c in SALES_PROGRAM_ALIASES), None)
+
+    ids, values = df.iloc[:, id_idx], df.iloc[:, sales_idx]
+    if prog_idx is None:
+        whole = _aggregate_sales_columns(ids, values)
+        return {prog: whole for prog in program_codes}
+    labels = df.iloc[:, prog_idx].astype(str).str.strip()
+    out, by_label = {}, {}
+    for prog in program_codes:
+        try:
+            label = _resolve_sheet_name(sorted(labels.unique()), prog)
+            if label not in by_label:
+                rows = (labels == label).to_numpy()
+                by_label[label] = _aggregate_sales_columns(ids[rows], values[rows])
+            out[prog] = by_label[label]
+        except ValueError as e:
+            out[prog] = e
+    return out
+
+def read_sales_file(file, program_codes) -> dict:
+    """read_sales_workbook cho file bất kỳ định dạng (.xlsx / .csv / .parquet)."""
+    fmt = input_format(file)
+    if fmt == "xlsx":
+        return read_sales_workbook(_as_source(file), program_codes)
+    return read_sales_table(file, program_codes, fmt)
+
+# ================== Mã khách hàng: chuẩn hoá & khớp bằng khoá số nguyên ==================
+# Bảng trưng bày giữ mã KH gốc (hiển thị / xuất); doanh số được cộng theo mã dạng chuẩn khi đọc.
+# Lúc ghép doanh số, mã của bảng kết quả được chuẩn hoá rồi đánh số nguyên liền 0..K-1 (pd.factorize)
+# và doanh số được cộng vào mảng theo số đó -> tra mảng thay vì merge theo chuỗi, kèm báo cáo khớp mã.
+KEY_REPORT_ATTR = "key_report"  # df.attrs[...] của kết quả: báo cáo khớp mã (key_match_report)
+KEY_REPORT_SAMPLE = 20          # số mã ví dụ giữ trong báo cáo
+
+def canonical_customer_keys(keys: pd.Series) -> pd.Series:
+    """
+    Mã KH -> dạng chuẩn (object, ô trống -> None): bỏ khoảng trắng, Unicode NFC, chữ hoa;
+    mã số bỏ phần '.0' và số 0 đầu (123, 123.0, '123.0', '00123' -> '123').
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    a = pa.array(keys.astype("string[pyarrow]"))
+    a = pc.utf8_trim_whitespace(a)
+    if not pc.all(pc.string_is_ascii(a)).as_py():
+        a = pc.utf8_normalize(a, "NFC")
+    a = pc.utf8_upper(a)
+    dot = pc.match_substring(a, ".")
+    if pc.any(dot).as_py():  # ô số bị đọc thành số thực: '123.0'
+        a = pc.if_else(dot, pc.replace_substring_regex(a, r"^(\d+)\.0+$", r"\1"), a)
+    digits = pc.utf8_is_digit(a)
+    if pc.any(digits).as_py():
+        trimmed = pc.utf8_ltrim(a, "0")
+        a = pc.if_else(digits, pc.if_else(pc.equal(trimmed, ""), "0", trimmed), a)
+    a = pc.if_else(pc.equal(a, ""), pa.scalar(None, pa.string()), a)
+    return pd.Series(a.to_numpy(zero_copy_only=False), index=keys.index, dtype=object)
+
+def customer_key_codes(keys: pd.Series):
+    """
+    Từ điển mã KH: (mã số nguyên 0..K-1 của từng dòng, pd.Index K mã chuẩn theo số đó).
+    Mã gốc khác nhau cùng dạng chuẩn ('001', '1') nhận cùng 1 số; chỉ chuẩn hoá các mã phân biệt.
+    """
+    codes, uniques = pd.factorize(keys)
+    canon, index = pd.factorize(canonical_customer_keys(pd.Series(uniques, dtype=object)))
+    return canon[codes], pd.Index(index)
+
+def lookup_sales(codes: np.ndarray, index: pd.Index, sales: pd.DataFrame):
+    """
+    Doanh số của từng dòng theo khoá số nguyên (customer_key_codes), không merge chuỗi:
+    mã của bảng doanh số -> số trong index (get_indexer), cộng vào mảng K phần tử, rồi lấy theo codes.
+    Trả về (doanh số từng dòng float64, mảng bool dòng có doanh số, thống kê khớp mã).
+    """
+    ids = canonical_customer_keys(sales["Mã khách hàng"])
+    pos = index.get_indexer(ids)
+    found = pos >= 0
+    amounts = pd.to_numeric(sales["Tổng Doanh số"], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+    per_key = np.bincount(pos[found], weights=amounts[found], minlength=len(index))
+    has_sales = np.bincount(pos[found], minlength=len(index)) > 0
+    matched = has_sales[codes]
+    stats = {
+        "rows_matched": int(matched.sum()),
+        "rows_unmatched": int(len(codes) - matched.sum()),
+        "sales_keys": int(len(ids)),
+        "sales_unmatched": int((~found).sum()),
+        "sales_unmatched_amount": float(amounts[~found].sum()),
+        "sample_sales_unmatched": ids[~found].head(KEY_REPORT_SAMPLE).astype(str).tolist(),
+    }
+    return per_key[codes], matched, stats
+
+def key_match_report(df: pd.DataFrame) -> dict:
+    """
+    Báo cáo khớp mã của kết quả (build_program_result / evaluate_window), {} nếu không có:
+      rows, keys, ambiguous_keys / ambiguous_rows / sample_ambiguous (mã KH nằm ở nhiều dòng
+      kết quả -> mỗi dòng nhận đủ doanh số của mã), months = {tháng: thống kê lookup_sales}.
+    """
+    return df.attrs.get(KEY_REPORT_ATTR, {})
+
+def _key_report_base(codes: np.ndarray, index: pd.Index) -> dict:
+    counts = np.bincount(codes, minlength=len(index))
+    ambiguous = counts > 1
+    return {
+        "rows": int(len(codes)), "keys": int(len(index)),
+        "ambiguous_keys": int(ambiguous.sum()), "ambiguous_rows": int(counts[ambiguous].sum()),
+        "sample_ambiguous": index[ambiguous][:KEY_REPORT_SAMPLE].astype(str).tolist(),
+        "months": {},
+    }
+
+STATUS_LABELS = ["Đạt", "Không Đạt", "Không xét"]
+
+def slot_min_rule_index(df: pd.DataFrame, prog: str, month: str, rules=None) -> np.ndarray:
+    """
+    Quy tắc SLOT_MIN_RULES áp cho từng dòng (vị trí trong rules; -1 = không khớp quy tắc nào,
+    dùng PER_SLOT_MIN). Mẫu chỉ được so trên các giá trị 'Mã NPP' khác nhau rồi ánh xạ lại theo mã.
+    """
+    rules = SLOT_MIN_RULES if rules is None else rules
+    codes, npp = pd.factorize(df["Mã NPP"])
+    npp = pd.Index(npp).astype(str)
+    rule = np.full(len(npp), -1, dtype=np.int64)
+    for i, (r_prog, pattern, r_month, _) in enumerate(rules):
+        if r_prog != prog or (r_month is not None and r_month != month):
+            continue
+        hit = rule < 0
+        if pattern is not None:
+            hit &= np.asarray(npp.str.contains(pattern, case=False, regex=True), dtype=bool)
+        rule[hit] = i
+    return rule[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+def per_slot_min_array(df: pd.DataFrame, prog: str, month: str, rules=None) -> np.ndarray:
+    """
+    Mức tối thiểu / 1 suất cho từng dòng theo SLOT_MIN_RULES (khớp CT, mẫu 'Mã NPP', tháng).
+    Dòng không khớp quy tắc nào -> PER_SLOT_MIN của CT.
+    """
+    rules = SLOT_MIN_RULES if rules is None else rules
+    values = np.array([r[3] for r in rules] + [PER_SLOT_MIN.get(prog, 0)], dtype=np.int64)
+    return values[slot_min_rule_index(df, prog, month, rules)]  # -1 -> phần tử cuối (PER_SLOT_MIN)
+
+def apply_status(df: pd.DataFrame, m1: str, m2: str, prog: str, rules=None) -> pd.DataFrame:
+    """
+    Tính TRẠNG THÁI cho mọi CT (vector hoá):
+      - Không tham gia đủ 2 tháng                 -> 'Không xét'
+      - Tham gia đủ nhưng cả 2 tháng không đạt   -> 'Không Đạt'
+      - Còn lại                                   -> 'Đạt'
+    Mức tối thiểu / suất lấy theo per_slot_min_array (PER_SLOT_MIN + SLOT_MIN_RULES).
+    """
+    return apply_status_months(df, [m1, m2], prog, rules)
+
+@staged()
+def apply_status_months(df: pd.DataFrame, months: list, prog: str, rules=None) -> pd.DataFrame:
+    """
+    apply_status cho cửa sổ N tháng bất kỳ:
+      - Không tham gia đủ mọi tháng trong cửa sổ     -> 'Không xét'
+      - Tham gia đủ nhưng mọi tháng đều không đạt   -> 'Không Đạt'
+      - Còn lại                                      -> 'Đạt'
+    Thêm cột 'Tối thiểu - <tháng>' cho từng tháng.
+    """
+    out = df.copy(deep=False)
+    joined = np.ones(len(out), dtype=bool)
+    meet_any = np.zeros(len(out), dtype=bool)
+    for m in months:
+        for c in (f"Giai đoạn - {m}", f"Doanh số - {m}"):
+            out[c] = pd.to_numeric(out[c], errors="coerce").fillna(0).astype(np.int64)
+        slots = out[f"Giai đoạn - {m}"].to_numpy()
+        minimum = slots * per_slot_min_array(out, prog, m, rules)
+        joined &= slots > 0
+        meet_any |= out[f"Doanh số - {m}"].to_numpy() >= minimum
+        out[f"Tối thiểu - {m}"] = minimum
+
+    codes = np.select([~joined, ~meet_any], [2, 1], default=0).astype(np.int8)
+    out["TRẠNG THÁI"] = pd.Categorical.from_codes(codes, categories=STATUS_LABELS)
+    return out
+
+# ================== Mô phỏng mức tối thiểu / suất (what-if) ==================
+# Chạy trên kết quả đã xử lý (không đọc lại file). Với KH tham gia đủ các tháng, đạt ở tháng m
+# với mức t / suất <=> Doanh số_m / Số suất_m >= t, nên mỗi dòng chỉ cần 1 "mức hoà vốn" r
+# (lớn nhất qua các tháng thuộc nhóm đang đổi mức) + cờ đã đạt ở tháng giữ mức cũ; cả lưới
+# ngưỡng được so 1 lần bằng broadcast r[:, None] >= ngưỡng[None, :] theo từng khối dòng.
+WHAT_IF_CHUNK_ROWS = 50_000  # số dòng / khối khi so ma trận dòng × ngưỡng (giới hạn bộ nhớ)
+
+def slot_min_targets(prog: str, rules=None) -> list:
+    """
+    Các nhóm mức tối thiểu có thể mô phỏng của CT: [(khoá, nhãn, mức hiện tại)].
+    khoá None = mọi KH của CT; số >= 0 = vị trí quy tắc trong SLOT_MIN_RULES; -1 = PER_SLOT_MIN
+    (chỉ có khi CT không có quy tắc áp cho mọi NPP / mọi tháng).
+    """
+    rules = SLOT_MIN_RULES if rules is None else rules
+    base = PER_SLOT_MIN.get(prog, 0)
+    out = [(None, "Mọi KH của CT", base)]
+    catch_all = False
+    for i, (r_prog, pattern, r_month, value) in enumerate(rules):
+        if r_prog != prog:
+            continue
+        where = f"NPP chứa '{pattern}'" if pattern is not None else "NPP còn lại"
+        if r_month is not None:
+            where += f", tháng {r_month}"
+        out.append((i, where, value))
+        catch_all |= pattern is None and r_month is None
+    if not catch_all:
+        out.append((-1, "Mức chung (PER_SLOT_MIN)", base))
+    return out
+
+def _what_if_inputs(df: pd.DataFrame, months: list, prog: str, target=None, rules=None):
+    """
+    (r, giữ_đạt, xét, đạt_hiện_tại) cho từng dòng:
+      r          : mức / suất lớn nhất mà dòng vẫn đạt ở 1 tháng thuộc nhóm target (-inf nếu không có)
+      giữ_đạt    : đã đạt ở 1 tháng không thuộc nhóm (mức giữ nguyên, theo cột 'Tối thiểu - <tháng>')
+      xét        : TRẠNG THÁI khác 'Không xét' (tham gia đủ các tháng)
+    """
+    status = df["TRẠNG THÁI"].astype(str).to_numpy()
+    judged = status != "Không xét"
+    r = np.full(len(df), -np.inf)
+    keep_pass = np.zeros(len(df), dtype=bool)
+    for m in months:
+        sales = df[f"Doanh số - {m}"].to_numpy(dtype=np.float64)
+        slots = df[f"Giai đoạn - {m}"].to_numpy(dtype=np.float64)
+        if target is None:
+            in_group = np.ones(len(df), dtype=bool)
+        else:
+            in_group = slot_min_rule_index(df, prog, m, rules) == target
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(slots > 0, sales / slots, -np.inf)
+        r = np.where(in_group, np.maximum(r, ratio), r)
+        minimum = df[f"Tối thiểu - {m}"].to_numpy(dtype=np.float64)
+        keep_pass |= ~in_group & (sales >= minimum)
+    return r, keep_pass, judged, status == "Đạt"
+
+@staged()
+def what_if_sweep(df: pd.DataFrame, months: list, prog: str, thresholds, target=None, rules=None):
+    """
+    Mô phỏng cả lưới mức tối thiểu / suất cho nhóm target (xem slot_min_targets) trên kết quả đã tính.
+    Trả về (tổng hợp, theo NPP):
+      tổng hợp : 1 dòng / ngưỡng: Đạt, Không Đạt, Không xét, Tỷ lệ đạt (%), số KH đổi trạng thái
+                 (Đạt -> Không Đạt, Không Đạt -> Đạt) so với kết quả hiện tại.
+      theo NPP : Mã NPP, Tên NPP, Số KH xét, Đạt hiện tại, rồi 1 cột số KH Đạt / ngưỡng.
+    """
+    t = np.asarray(thresholds, dtype=np.float64)
+    r, keep_pass, judged, cur_pass = _what_if_inputs(df, months, prog, target, rules)
+
+    # chỉ dòng được xét mới đổi theo ngưỡng; sắp theo NPP để mỗi NPP là 1 đoạn dòng liền nhau
+    rows = np.flatnonzero(judged)
+    npp_codes, npp = pd.factorize(pd.MultiIndex.from_arrays([df["Mã NPP"].astype(str), df["Tên NPP"].astype(str)]))
+    rows = rows[np.argsort(npp_codes[rows], kind="stable")]
+    sorted_codes = npp_codes[rows]
+    kept = np.zeros(len(t), dtype=np.int64)  # KH đang Đạt vẫn Đạt ở từng ngưỡng
+    by_npp = np.zeros((len(npp), len(t)), dtype=np.int64)
+    for lo in range(0, len(rows), WHAT_IF_CHUNK_ROWS):
+        idx = rows[lo:lo + WHAT_IF_CHUNK_ROWS]
+        ok = keep_pass[idx, None] | (r[idx, None] >= t[None, :])  # khối dòng × ngưỡng
+        kept += np.count_nonzero(ok[cur_pass[idx]], axis=0)
+        # cộng từng đoạn NPP qua view uint8 (reduceat trên bool chậm hơn nhiều)
+        counts = ok.view(np.uint8)
+        codes = sorted_codes[lo:lo + WHAT_IF_CHUNK_ROWS]
+        bounds = np.r_[np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]), len(codes)]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            by_npp[codes[s]] += counts[s:e].sum(axis=0, dtype=np.int64)
+    passed = by_npp.sum(axis=0)
+    lost = int(cur_pass[rows].sum()) - kept
+    gained = passed - kept
+
+    n_judged = len(rows)
+    summary = pd.DataFrame({
+        "Mức / suất": t.astype(np.int64),
+        "Đạt": passed,
+        "Không Đạt": n_judged - passed,
+        "Không xét": len(df) - n_judged,
+        "Tỷ lệ đạt (%)": (passed / n_judged * 100).round(1) if n_judged else np.nan,
+        "Đổi trạng thái": lost + gained,
+        "Đạt -> Không Đạt": lost,
+        "Không Đạt -> Đạt": gained,
+    })
+    npp_table = pd.DataFrame({
+        "Mã NPP": npp.get_level_values(0),
+        "Tên NPP": npp.get_level_values(1),
+        "Số KH xét": np.bincount(npp_codes[rows], minlength=len(npp)),
+        "Đạt hiện tại": np.bincount(npp_codes[rows], weights=cur_pass[rows], minlength=len(npp)).astype(np.int64),
+    })
+    npp_table = pd.concat([npp_table, pd.DataFrame(by_npp, columns=summary["Mức / suất"].tolist())], axis=1)
+    return summary, npp_table.sort_values(["Mã NPP", "Tên NPP"], ignore_index=True)
+
+def what_if_changes(df: pd.DataFrame, months: list, prog: str, threshold, target=None, rules=None) -> pd.DataFrame:
+    """KH đổi trạng thái khi nhóm target dùng mức `threshold` / suất: các cột kết quả + 'TRẠNG THÁI mới'."""
+    r, keep_pass, judged, cur_pass = _what_if_inputs(df, months, prog, target, rules)
+    new_pass = judged & (keep_pass | (r >= threshold))
+    changed = judged & (new_pass != cur_pass)
+    out = df[changed].copy()
+    out["TRẠNG THÁI mới"] = np.where(new_pass[changed], "Đạt", "Không Đạt")
+    return out
+
+# Độ rộng cột của layout xuất Excel: 5 cột KH, mỗi tháng 1 cột Giai đoạn + 1 cột Doanh số, TRẠNG THÁI
+EXPORT_BASE_WIDTHS = [12,12,22,16,28]
+EXPORT_SLOT_WIDTH, EXPORT_SALES_WIDTH, EXPORT_STATUS_WIDTH = 14, 16, 14
+EXCEL_MAX_ROWS = 1_048_576
+EXPORT_CHUNK_ROWS = 20_000  # số dòng dữ liệu gom thành 1 khối XML trước khi nén
+
+_XML_SPECIAL_RE = r"[&<>\x00-\x08\x0b\x0c\x0e-\x1f]"
+
+def _xml_escape(s: str) -> str:
+    s = s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    # ký tự điều khiển -> _xHHHH_ (giống cách xlsxwriter xử lý)
+    return re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", lambda m: "_x%04X_" % ord(m.group()), s)
+
+def _layout_columns(df: pd.DataFrame, months: list):
+    """
+    Lấy các cột của layout, mỗi cột 1 lần (không iloc từng ô, không copy cả frame).
+    Trả về (texts, nums): 6 cột chữ (5 cột BASE_COLS + TRẠNG THÁI) giữ nguyên Series gốc
+    (chuyển sang chuỗi theo từng khối khi ghi, xem _text_chunk) và 2N cột số
+    (Giai đoạn từng tháng, rồi Doanh số từng tháng) dạng mảng int64.
+    """
+    n = len(df)
+    texts = []
+    for c in BASE_COLS + ["TRẠNG THÁI"]:
+        texts.append(df[c] if c in df.columns else pd.Series([""] * n, dtype=object))
+    nums = []
+    for c in [f"Giai đoạn - {m}" for m in months] + [f"Doanh số - {m}" for m in months]:
+        if c not in df.columns:
+            nums.append(np.zeros(n, dtype=np.int64))
+        elif pd.api.types.is_integer_dtype(df[c]):
+            nums.append(df[c].to_numpy(dtype=np.int64))  # cột int64 sẵn -> không copy
+        else:
+            nums.append(pd.to_numeric(df[c], errors="coerce").fillna(0).to_numpy().astype(np.int64))
+    return texts, nums
+
+def _text_chunk(s: pd.Series, lo: int, hi: int, strip: bool = False, escape: bool = True) -> list:
+    """
+    Các dòng [lo, hi) của cột chữ dưới dạng list chuỗi (giống astype(str)); ô trống (None / NaN) -> None.
+    Cột categorical chỉ chuyển / escape danh mục rồi lấy theo mã, không tạo chuỗi cho cả cột.
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        values = pd.Series(s.cat.categories.astype(str).tolist() + [""], dtype=object)
+        codes = s.cat.codes.to_numpy()[lo:hi]
+        missing = codes == -1  # mã -1 (NaN) -> phần tử "" cuối, đánh dấu None bên dưới
+    else:
+        part = s.iloc[lo:hi]
+        missing = part.isna().to_numpy()
+        values = part.astype(str)
+        codes = None
+    if strip:
+        values = values.str.strip()
+    if escape:
+        bad = values.str.contains(_XML_SPECIAL_RE, regex=True)
+        if bad.any():
+            values = values.where(~bad, values[bad].map(_xml_escape))
+    values = values.to_numpy(dtype=object)
+    if codes is not None:
+        values = values[codes]
+    if missing.any():
+        values[missing] = None
+    return values.tolist()
+
+def _text_cells(values: list, style: int) -> list:
+    """
+    Chuỗi đã escape -> XML ô inlineStr; None / chuỗi rỗng -> ô trống giữ format (như xlsxwriter).
+    Chuỗi có khoảng trắng đầu / cuối được ghi xml:space="preserve" để Excel không cắt mất.
+    """
+    head = '<c s="%d" t="inlineStr"><is><t>' % style
+    keep = '<c s="%d" t="inlineStr"><is><t xml:space="preserve">' % style
+    blank = '<c s="%d"/>' % style
+    return [(keep if v[0].isspace() or v[-1].isspace() else head) + v + "</t></is></c>" if v else blank
+            for v in values]
+
+def _layout_formats(wb) -> dict:
+    """Tạo bộ format dùng chung cho các sheet layout (1 lần / workbook)."""
+    return {
+        "header": wb.add_format({"bold": True,"align":"center","valign":"vcenter",
+                                 "border":1,"bg_color":"#00B0F0","font_color":"#FFFFFF"}),
+        "sub": wb.add_format({"bold": True,"align":"center","valign":"vcenter",
+                              "border":1,"bg_color":"#D9EDF7"}),
+        "cell": wb.add_format({"border":1}),
+        "center": wb.add_format({"border":1,"align":"center"}),
+        "int": wb.add_format({"border":1,"num_format":"#,##0"}),
+        # format cho conditional format: chỉ đổi màu nền, giữ viền/canh giữa của ô
+        "ok": wb.add_format({"bg_color":"#C6EFCE"}),
+        "bad": wb.add_format({"bg_color":"#FFC7CE"}),
+        "neut": wb.add_format({"bg_color":"#F2F2F2"}),
+    }
+
+def _add_layout_sheet(wb, sheet_name: str, months: list, texts, nums, fmt: dict):
+    """
+    Tạo sheet layout: header gộp 2 hàng, dòng dữ liệu đầu tiên, độ rộng cột,
+    freeze, footer và conditional format tô màu TRẠNG THÁI.
+    Các dòng dữ liệu còn lại được stream bởi _stream_layout_rows.
+    """
+    n, k = len(nums[0]), len(months)
+    if n + 2 > EXCEL_MAX_ROWS:
+        raise ValueError(f"Quá số dòng tối đa của Excel ({n:,} dòng dữ liệu)")
+    ws = wb.add_worksheet(sheet_name)
+    header, sub = fmt["header"], fmt["sub"]
+    status_col = 5 + 2 * k
+
+    # ==== header gộp (2 hàng) ====
+    for c, name in enumerate(BASE_COLS):
+        ws.merge_range(0, c, 1, c, name, header)
+    for c0, name in ((5, "Giai đoạn"), (5 + k, "Doanh số")):
+        if k > 1:
+            ws.merge_range(0, c0, 0, c0 + k - 1, name, header)
+        else:
+            ws.write(0, c0, name, header)
+        # Hàng 2 (subheader) chỉ ghi tiêu đề con (tên tháng) cho các cột nhóm
+        for j, m in enumerate(months):
+            ws.write(1, c0 + j, m, sub)
+    ws.merge_range(0, status_col, 1, status_col, "TRẠNG THÁI", header)
+
+    # Dòng dữ liệu đầu ghi bằng xlsxwriter để các format ô được đăng ký style
+    start_row = 2
+    if n:
+        first = [_text_chunk(t, 0, 1, strip=(i == 5), escape=False)[0] for i, t in enumerate(texts)]
+        for c in range(5):
+            ws.write(start_row, c, first[c], fmt["cell"])
+        for j in range(2 * k):
+            ws.write_number(start_row, 5 + j, nums[j][0], fmt["center"] if j < k else fmt["int"])
+        ws.write(start_row, status_col, first[5], fmt["center"])
+
+        # Tô màu TRẠNG THÁI: 1 quy tắc conditional format / trạng thái thay vì format từng ô
+        for label, key in (("Đạt", "ok"), ("Không Đạt", "bad"), ("Không xét", "neut")):
+            ws.conditional_format(start_row, status_col, start_row + n - 1, status_col, {
+                "type": "cell", "criteria": "==", "value": f'"{label}"', "format": fmt[key],
+            })
+
+    # width & freeze panes
+    widths = EXPORT_BASE_WIDTHS + [EXPORT_SLOT_WIDTH] * k + [EXPORT_SALES_WIDTH] * k + [EXPORT_STATUS_WIDTH]
+    for c, w in enumerate(widths):
+        ws.set_column(c, c, w)
+    ws.freeze_panes(start_row, 0)
+    ws.set_footer('&R© Nguyen Anh Tai')
+    return ws
+
+def _stream_layout_rows(texts, nums, fmt: dict):
+    """
+    Sinh XML các dòng dữ liệu thứ 2 trở đi theo từng khối EXPORT_CHUNK_ROWS dòng.
+    Mỗi dòng là 1 lần format chuỗi từ các cột đã lấy sẵn -> nhanh hơn nhiều so với
+    ghi từng ô qua xlsxwriter. Gọi sau wb.close() (khi format đã có chỉ số style).
+    """
+    n, k = len(nums[0]), len(nums) // 2
+    if n <= 1:
+        return
+    s_cell, s_center, s_int = (fmt[k_].xf_index for k_ in ("cell", "center", "int"))
+
+    # {0} = số hàng, {1}..{6} = 6 ô chữ (XML ô đủ, xem _text_cells), {7}.. = 2k cột số
+    num = '<c s="%d"><v>{%d}</v></c>'
+    row_xml = ('<row r="{0}">{1}{2}{3}{4}{5}'
+               + "".join(num % (s_center if j < k else s_int, 7 + j) for j in range(2 * k))
+               + "{6}</row>").format
+
+    start_row = 2
+    for lo in range(1, n, EXPORT_CHUNK_ROWS):
+        hi = min(lo + EXPORT_CHUNK_ROWS, n)
+        rows = range(start_row + 1 + lo, start_row + 1 + hi)  # số hàng Excel (1-based)
+        cols = [_text_cells(_text_chunk(t, lo, hi, strip=(i == 5)), s_center if i == 5 else s_cell)
+                for i, t in enumerate(texts)]
+        cols += [c[lo:hi].tolist() for c in nums]
+        yield "".join(map(row_xml, rows, *cols)).encode("utf-8")
+
+def _add_overview_sheet(wb, sheet_name: str, table: pd.DataFrame, fmt: dict):
+    """Sheet bảng nhỏ (vd. tổng quan trạng thái theo CT / NPP), ghi thẳng bằng xlsxwriter."""
+    ws = wb.add_worksheet(sheet_name)
+    for c, name in enumerate(table.columns):
+        ws.write(0, c, name, fmt["header"])
+        numeric = pd.api.types.is_numeric_dtype(table[name])
+        cell = fmt["int"] if numeric else fmt["cell"]
+        for r, v in enumerate(table[name].tolist(), start=1):
+            if numeric and pd.isna(v):
+                ws.write_blank(r, c, None, cell)
+            else:
+                ws.write(r, c, v, cell)
+        ws.set_column(c, c, max(12, min(30, len(str(name)) + 4)))
+    ws.freeze_panes(1, 0)
+    ws.set_footer('&R© Nguyen Anh Tai')
+    return ws
+
+def _write_layout_workbook(target, sheets: list, overview: tuple = None):
+    """
+    Ghi workbook gồm các sheet layout. sheets = [(tên sheet, df, [tháng...]), ...].
+    - xlsxwriter dựng phần khung (styles, header gộp, conditional format...).
+    - Dữ liệu được stream thẳng vào <sheetData> của từng sheet khi đóng gói zip
+      (nén mức 1); mỗi lần chỉ giữ 1 khối dòng XML trong bộ nhớ.
+    - Cột của từng sheet được lấy lại khi stream sheet đó (không giữ cột của mọi sheet cùng lúc)
+      -> peak bộ nhớ không tăng theo số sheet.
+    overview: (tên sheet, bảng nhỏ) ghi thành sheet đầu tiên (xem _add_overview_sheet).
+    target: đường dẫn file hoặc file-like (BytesIO).
+    """
+    import xlsxwriter
+    from xlsxwriter.utility import xl_col_to_name
+
+    skeleton = BytesIO()
+    with stage("export_skeleton", sheets=len(sheets)):
+        wb = xlsxwriter.Workbook(skeleton)
+        fmt = _layout_formats(wb)
+        if overview is not None:
+            _add_overview_sheet(wb, *overview, fmt)
+        parts = {}
+        for name, df, months in sheets:
+            texts, nums = _layout_columns(df, months)
+            ws = _add_layout_sheet(wb, name, months, texts, nums, fmt)
+            parts[f"xl/worksheets/sheet{ws.index + 1}.xml"] = (df, months, name)
+            texts = nums = None
+        wb.close()
+
+    with zipfile.ZipFile(skeleton) as zin, \
+         zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+        for info in zin.infolist():
+            raw = zin.read(info.filename)
+            if info.filename not in parts:
+                zout.writestr(info, raw)
+                continue
+            df, months, name = parts[info.filename]
+            texts, nums = _layout_columns(df, months)
+            last_cell = f"{xl_col_to_name(5 + len(nums))}{len(nums[0]) + 2}"
+            head, tail = raw.decode("utf-8").split("</sheetData>", 1)
+            head = re.sub(r'<dimension ref="[^"]*"/>', f'<dimension ref="A1:{last_cell}"/>', head, count=1)
+            entry = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+            entry.compress_type = zipfile.ZIP_DEFLATED
+            with stage("export_rows", sheet=name, rows=len(nums[0])) as st_:
+                with zout.open(entry, "w") as fh:
+                    fh.write(head.encode("utf-8"))
+                    for chunk in _stream_layout_rows(texts, nums, fmt):
+                        fh.write(chunk)
+                    fh.write(("</sheetData>" + tail).encode("utf-8"))
+                st_.set(xml_bytes=entry.file_size, zip_bytes=entry.compress_size)
+            texts = nums = None
+
+def export_excel_layout(df: pd.DataFrame, m1: str, m2: str, prog: str) -> bytes:
+    """
+    Xuất .xlsx:
+    - Header gộp 2 hàng (Giai đoạn m1/m2, Doanh số m1/m2).
+    - KHÔNG có hàng tiêu đề lặp ở dòng 3.
+    - Tô màu TRẠNG THÁI, định dạng số & độ rộng cột.
+    """
+    return export_excel_months(df, [m1, m2], prog)
+
+@staged()
+def export_excel_months(df: pd.DataFrame, months: list, prog: str) -> bytes:
+    """export_excel_layout cho N tháng (cột Giai đoạn / Doanh số gộp theo từng tháng)."""
+    buf = BytesIO()
+    _write_layout_workbook(buf, [(f"{prog}", df, list(months))])
+    return buf.getvalue()
+
+# ================== Cache kết quả đọc file (trên đĩa, dùng chung mọi phiên) ==================
+# Khoá = hash nội dung file + tham số đọc; lưu Parquet. Dọn theo tuổi & tổng dung lượng.
+PARSE_CACHE_DIR = os.environ.get("DSPS_CACHE_DIR",
+                                 os.path.join(tempfile.gettempdir(), "dsps_parse_cache"))
+PARSE_CACHE_MAX_BYTES = int(os.environ.get("DSPS_CACHE_MAX_MB", "2048")) * 1024 * 1024
+PARSE_CACHE_MAX_AGE_DAYS = int(os.environ.get("DSPS_CACHE_MAX_AGE_DAYS", "30"))
+PARSE_CACHE_VERSION = 6  # tăng khi đổi logic đọc/chuẩn hoá để bỏ cache cũ
+
+def file_digest(file) -> str:
+    """Hash nội dung file (đường dẫn, SpooledUpload, UploadedFile/BytesIO hoặc file-like)."""
+    if isinstance(file, SpooledUpload):
+        return file.digest  # đã tính khi ghi xuống đĩa
+    h = hashlib.blake2b(digest_size=20)
+    if isinstance(file, (str, os.PathLike)):
+        with MappedFile(file) as fh:
+            h.update(fh.getbuffer())
+    elif hasattr(file, "getbuffer"):
+        h.update(file.getbuffer())
+    else:
+        pos = file.tell()
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            h.update(chunk)
+        file.seek(pos)
+    return h.hexdigest()
+
+def _parse_cache_path(kind: str, digest: str, params: dict) -> str:
+    key = json.dumps([PARSE_CACHE_VERSION, kind, digest, params], sort_keys=True, ensure_ascii=False)
+    name = hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+    return os.path.join(PARSE_CACHE_DIR, f"{kind}-{name}.parquet")
+
+def _parse_cache_get(path: str):
+    with stage("parse_cache_get", entry=os.path.basename(path)) as s_:
+        df = _parse_cache_load(path)
+        s_.set(hit=df is not None)
+    return df
+
+def _parse_cache_load(path: str):
+    if not os.path.exists(path):
+        return None
+    try:
+        df = pd.read_parquet(path)
+        os.utime(path)  # đánh dấu vừa dùng (dọn theo LRU)
+        return df
+    except Exception:
+        # file hỏng / thiếu pyarrow -> coi như chưa có cache
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def _parse_cache_put(path: str, df: pd.DataFrame):
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        _atomic_write(path, lambda tmp: df.to_parquet(tmp, index=False))
+    except Exception:
+        return  # cache chỉ để tăng tốc, lỗi ghi không ảnh hưởng kết quả
+    _evict_parse_cache()
+
+def _evict_parse_cache():
+    """Xoá entry quá PARSE_CACHE_MAX_AGE_DAYS, rồi xoá entry cũ nhất tới khi dưới PARSE_CACHE_MAX_BYTES."""
+    try:
+        entries = []
+        for e in os.scandir(PARSE_CACHE_DIR):
+            if e.is_file() and e.name.endswith(".parquet"):
+                st_ = e.stat()
+                entries.append((st_.st_mtime, st_.st_size, e.path))
+    except OSError:
+        return
+    cutoff = time.time() - PARSE_CACHE_MAX_AGE_DAYS * 86400
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= PARSE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def _display_cache_path(digest: str) -> str:
+    return _parse_cache_path("display", digest, {"layout": "header"})
+
+@staged(source=True)
+def read_display_cached(file, digest: str = None) -> pd.DataFrame:
+    """read_display_file (xlsx / csv / parquet) có cache trên đĩa theo nội dung file."""
+    path = _display_cache_path(digest or file_digest(file))
+    df = _parse_cache_get(path)
+    if df is None:
+        df = read_display_file(file)
+        _parse_cache_put(path, df)
+    return df
+
+def _sales_cache_path(digest: str, prog: str) -> str:
+    return _parse_cache_path("sales", digest, {"program": prog})
+
+@staged(source=True)
+def read_sales_cached(file, program_codes, digest: str = None) -> dict:
+    """read_sales_file (xlsx / csv / parquet) có cache trên đĩa theo (nội dung file, CT); chỉ đọc CT chưa có cache."""
+    digest = digest or file_digest(file)
+    paths = {p: _sales_cache_path(digest, p) for p in program_codes}
+    out = {p: _parse_cache_get(paths[p]) for p in program_codes}
+    missing = [p for p in program_codes if out[p] is None]
+    if missing:
+        for p, df in read_sales_file(file, missing).items():
+            out[p] = df
+            if not isinstance(df, Exception):
+                _parse_cache_put(paths[p], df)
+    return out
+
+@staged()
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """Dấu vân tay nội dung DataFrame (giá trị + tên cột), dùng làm khoá cache."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+# ================== File upload trên đĩa (thay cho bytes trong RAM) ==================
+# File upload được ghi ngay xuống thư mục tạm của phiên (UploadSpool) rồi bỏ bản trong RAM;
+# khi đọc, file được ánh xạ bộ nhớ (MappedFile): process con chỉ nhận đường dẫn, trang file
+# nằm trong page cache của hệ điều hành (dùng chung, thu hồi được) thay vì bytes riêng từng process.
+UPLOAD_SPOOL_DIR = os.environ.get("DSPS_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "dsps_uploads"))
+UPLOAD_SPOOL_CHUNK = 8 << 20  # số byte / lần ghi khi chuyển file upload xuống đĩa
+
+class MappedFile(io.RawIOBase):
+    """File nhị phân chỉ đọc qua mmap (đọc / seek như file thường, getbuffer() không copy)."""
+    def __init__(self, path):
+        self.name = os.fspath(path)
+        with open(self.name, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._size, self._pos = size, 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        end = self._size if size is None or size < 0 else min(self._size, self._pos + size)
+        data = self._map[self._pos:end] if end > self._pos else b""
+        self._pos += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), self._size - self._pos))
+        b[:n] = self._map[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._map)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        super().close()
+
+class SpooledUpload(os.PathLike):
+    """File upload đã ghi xuống đĩa: dùng như đường dẫn; giữ tên gốc, kích thước và hash nội dung (file_digest)."""
+    def __init__(self, path: str, name: str, size: int, digest: str):
+        self.path, self.name, self.size, self.digest = path, name, size, digest
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def open(self) -> MappedFile:
+        return MappedFile(self.path)
+
+    def __repr__(self) -> str:
+        return f"SpooledUpload({self.name!r}, {self.size:,} B)"
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # có process nhưng không có quyền gửi tín hiệu
+    return True
+
+def sweep_upload_spools(root: str = None) -> int:
+    """Xoá thư mục phiên bị bỏ lại của process server đã dừng (tắt đột ngột). Trả về số thư mục đã xoá."""
+    root = root or UPLOAD_SPOOL_DIR
+    removed = 0
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return 0
+    for e in entries:
+        m = re.match(r"session-(\d+)-", e.name)
+        if e.is_dir() and m and not _pid_alive(int(m.group(1))):
+            shutil.rmtree(e.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+class UploadSpool:
+    """
+    Thư mục tạm chứa file upload của 1 phiên. File trùng nội dung chỉ ghi 1 lần (đếm tham chiếu).
+    Thư mục bị xoá khi close() hoặc khi đối tượng bị thu hồi (phiên kết thúc / process thoát).
+    """
+    def __init__(self, root: str = None):
+        root = root or UPLOAD_SPOOL_DIR
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f"session-{os.getpid()}-", dir=root)
+        self._refs = {}
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def add(self, file, name: str = None) -> SpooledUpload:
+        """Ghi file (UploadedFile / BytesIO / file-like) xuống đĩa theo từng khối, tính hash cùng lúc."""
+        name = name or getattr(file, "name", None) or "upload"
+        h = hashlib.blake2b(digest_size=20)
+        fd, tmp = tempfile.mkstemp(suffix=".part", dir=self.path)
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                if hasattr(file, "getbuffer"):
+                    view = file.getbuffer()
+                    try:
+                        for i in range(0, view.nbytes, UPLOAD_SPOOL_CHUNK):
+                            block = view[i:i + UPLOAD_SPOOL_CHUNK]
+                            h.update(block)
+                            out.write(block)
+                        size = view.nbytes
+                    finally:
+                        view.release()
+                else:
+                    for block in iter(lambda: file.read(UPLOAD_SPOOL_CHUNK), b""):
+                        h.update(block)
+                        out.write(block)
+                        size += len(block)
+            digest = h.hexdigest()
+            path = os.path.join(self.path, digest + os.path.splitext(name)[1].lower())
+            with self._lock:
+                if path in self._refs:
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, path)
+                self._refs[path] = self._refs.get(path, 0) + 1
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return SpooledUpload(path, name, size, digest)
+
+    def discard(self, upload: SpooledUpload):
+        """Bỏ 1 tham chiếu tới file; xoá file khi không còn ô upload nào dùng."""
+        with self._lock:
+            left = self._refs.get(upload.path, 0) - 1
+            if left > 0:
+                self._refs[upload.path] = left
+                return
+            self._refs.pop(upload.path, None)
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+
+    def disk_bytes(self) -> int:
+        with self._lock:
+            paths = list(self._refs)
+        return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    def close(self):
+        self._finalizer()
+
+# ================== Lưu gọn kết quả (session / bộ nhớ) ==================
+COMPACT_CATEGORY_COLS = ["Mã CTTB", "Mã NPP", "Tên NPP", "TRẠNG THÁI"]
+COMPACT_STRING_COLS = ["Mã khách hàng", "Tên khách hàng"]
+
+@staged()
+def compact_result(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bản gọn của kết quả để giữ lâu trong bộ nhớ:
+      - Mã CTTB / Mã NPP / Tên NPP / TRẠNG THÁI -> categorical (ít giá trị khác nhau)
+      - Mã / Tên khách hàng -> chuỗi Arrow (1 vùng nhớ liền cho cả cột, thay vì 1 object / ô)
+      - Giai đoạn (số suất) -> int32; Doanh số / Tối thiểu giữ int64 (có thể vượt 2 tỷ)
+    Giá trị không đổi; không có pyarrow thì giữ cột khách hàng dạng object.
+    """
+    out = df.copy(deep=False)
+    for c in COMPACT_CATEGORY_COLS:
+        if c in out.columns and not isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype("category")
+    for c in COMPACT_STRING_COLS:
+        if c in out.columns and out[c].dtype == object:
+            try:
+                out[c] = out[c].astype("string[pyarrow]")
+            except ImportError:
+                pass
+    for c in out.columns:
+        if c.startswith("Giai đoạn - ") and pd.api.types.is_integer_dtype(out[c]):
+            if len(out) == 0 or (out[c].min() >= np.iinfo(np.int32).min and out[c].max() <= np.iinfo(np.int32).max):
+                out[c] = out[c].astype(np.int32)
+    return out
+
+def memory_bytes(obj) -> int:
+    """Ước lượng bộ nhớ (byte) của kết quả / chỉ mục / cache: DataFrame, mảng numpy / Arrow, bytes, dict, list."""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, (np.ndarray, bytes, bytearray)):
+        return obj.nbytes if isinstance(obj, np.ndarray) else len(obj)
+    if hasattr(obj, "nbytes"):  # pyarrow.Array
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sum(memory_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(memory_bytes(v) for v in obj)
+    return 0
+
+# ================== Snapshot kết quả (mở lại / chia sẻ không cần xử lý lại) ==================
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META_KEY = b"dsps_snapshot"
+
+@staged()
+def save_snapshot(df: pd.DataFrame, m1: str, m2: str, prog: str, target=None):
+    """
+    Lưu kết quả đã xử lý của 1 CT (dữ liệu + nhãn tháng + mã CT) thành 1 file Parquet (zstd,
+    cột dạng gọn của compact_result). target: đường dẫn / file-like; None -> trả về bytes.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(compact_result(df), preserve_index=False)
+    meta = {"version": SNAPSHOT_VERSION, "program": prog, "months": [m1, m2],
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           SNAPSHOT_META_KEY: json.dumps(meta, ensure_ascii=False).encode("utf-8")})
+    buf = BytesIO() if target is None else target
+    pq.write_table(table, buf, compression="zstd")
+    return buf.getvalue() if target is None else None
+
+@staged(source=True)
+def load_snapshot(file):
+    """Mở file snapshot (save_snapshot). Trả về (df, m1, m2, CT)."""
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(_as_source(file))
+    raw = (table.schema.metadata or {}).get(SNAPSHOT_META_KEY)
+    if raw is None:
+        raise ValueError("File không phải snapshot kết quả (thiếu thông tin CT / tháng)")
+    meta = json.loads(raw)
+    if meta.get("version", 0) > SNAPSHOT_VERSION:
+        raise ValueError("Snapshot được tạo bởi phiên bản mới hơn của ứng dụng")
+    m1, m2 = meta["months"]
+    import pyarrow as pa
+    arrow_text = (pa.string(), pa.large_string())  # cột chữ -> chuỗi Arrow như compact_result
+    df = table.to_pandas(types_mapper=lambda t: pd.StringDtype("pyarrow") if t in arrow_text else None)
+    return df, m1, m2, meta["program"]
+
+# ================== Pipeline 1 CT / nhiều CT song song ==================
+@staged()
+def build_program_result(prog: str, df1: pd.DataFrame, df2: pd.DataFrame, s1=None, s2=None):
+    """
+    Gộp 2 tháng trưng bày, ghép doanh số (nếu có) và tính trạng thái. Trả về (result, m1, m2);
+    báo cáo khớp mã KH nằm ở result.attrs (xem key_match_report).
+    """
+    result, m1, m2 = combine_two_months(df1, df2)
+    report = {}
+    result = attach_sales(result, m1, m2, s1, s2, report=report)
+    result = apply_status(result, m1, m2, prog)
+    result.attrs[KEY_REPORT_ATTR] = report
+    return result, m1, m2
+
+@staged()
+def attach_sales(result: pd.DataFrame, m1: str, m2: str, s1=None, s2=None, report: dict = None) -> pd.DataFrame:
+    """
+    Ghép doanh số 2 tháng (bảng 'Mã khách hàng' / 'Tổng Doanh số', có thể None) vào kết quả gộp
+    bằng khoá số nguyên (lookup_sales). report (dict) -> điền báo cáo khớp mã.
+    """
+    codes, index = customer_key_codes(result["Mã khách hàng"])
+    if report is not None:
+        report.update(_key_report_base(codes, index))
+    for m, sales in ((m1, s1), (m2, s2)):
+        col = f"Doanh số - {m}"
+        if sales is not None:
+            with stage("merge_sales", month=m, rows=len(result), sales_rows=len(sales)):
+                values, matched, stats = lookup_sales(codes, index, sales)
+            result[col] = values
+            if report is not None:
+                stats["sample_rows_unmatched"] = (result["Mã khách hàng"][~matched]
+                                                  .head(KEY_REPORT_SAMPLE).astype(str).tolist())
+                report["months"][m] = stats
+
+    for c in [f"Doanh số - {m1}", f"Doanh số - {m2}"]:
+        result[c] = pd.to_numeric(result[c], errors="coerce").fillna(0).astype(int)
+    return result
+
+def _payload(source):
+    """Nguồn file -> dạng gửi được sang process con (đường dẫn / SpooledUpload giữ nguyên, file upload -> bytes)."""
+    if isinstance(source, (str, os.PathLike, bytes)):
+        return source
+    return source.getvalue() if hasattr(source, "getvalue") else source.read()
+
+def _parse_task(kind: str, payload, digest: str, programs: tuple):
+    """Việc đọc 1 file (chạy trong process con). kind: 'display' | 'sales'."""
+    _progress_local.task = (kind, digest)  # để hook của process con gắn tiến độ vào đúng file
+    if isinstance(payload, (str, os.PathLike)):
+        file = MappedFile(payload)  # file trên đĩa: ánh xạ bộ nhớ, không đọc cả file vào RAM
+    else:
+        file = BytesIO(payload) if isinstance(payload, bytes) else payload
+    try:
+        if kind == "display":
+            return read_display_cached(file, digest)
+        return read_sales_cached(file, programs, digest)
+    finally:
+        if isinstance(file, MappedFile):
+            file.close()
+
+def _parse_task_recorded(memory: bool, *args):
+    """_parse_task có ghi chẩn đoán trong process con. Trả về (kết quả hoặc lỗi, record, lúc bắt đầu ghi)."""
+    started = time.time()
+    start_diagnostics(memory=memory)
+    try:
+        out = _parse_task(*args)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        out = e  # trả lỗi kèm record (bước lỗi vẫn hiện trong panel chẩn đoán)
+    finally:
+        records = stop_diagnostics()
+    return out, records, started
+
+def _init_progress_worker(progress_queue, cancel_event):
+    """initializer của process con: gửi tiến độ về process chính qua queue, kiểm tra cờ huỷ."""
+    def hook(info):
+        if cancel_event.is_set():
+            raise JobCancelled()
+        progress_queue.put((getattr(_progress_local, "task", None), info))
+    _progress_local.hook = hook
+
+def _cached_task_result(kind: str, digest: str, programs: tuple):
+    """Kết quả có sẵn trong cache đĩa (không cần gửi file sang process con), hoặc None."""
+    if kind == "display":
+        return _parse_cache_get(_display_cache_path(digest))
+    out = {p: _parse_cache_get(_sales_cache_path(digest, p)) for p in programs}
+    return None if any(v is None for v in out.values()) else out
+
+# Tên bước hiển thị trong thông điệp tiến độ (bước không có ở đây -> dùng tên hàm)
+PROGRESS_STAGE_LABELS = {
+    "read_display_cached": "Đọc file trưng bày",
+    "read_display_excel": "Đọc file trưng bày",
+    "read_display_table": "Đọc file trưng bày",
+    "read_sales_cached": "Đọc file doanh số",
+    "read_sales_workbook": "Đọc file doanh số",
+    "read_sales_table": "Đọc file doanh số",
+    "open_sales_workbook": "Mở file doanh số",
+    "read_sales_sheet": "Đọc sheet doanh số",
+    "parse_cache_get": "Tìm trong cache đọc file",
+    "build_program_result": "Gộp & tính trạng thái",
+    "combine_two_months": "Gộp 2 tháng",
+    "attach_sales": "Ghép doanh số",
+    "merge_sales": "Ghép doanh số",
+    "apply_status_months": "Tính trạng thái",
+}
+PROGRESS_POLL_SECONDS = 0.2  # chu kỳ nhận tiến độ từ process con / kiểm tra huỷ
+# Tổng số process con đọc file của cả server: mọi run_programs (mọi phiên, mọi BackgroundJob)
+# cùng lấy suất từ 1 semaphore, pool của mỗi lần chạy chỉ lớn bằng số suất lấy được.
+POOL_WORKERS_MAX = int(os.environ.get("DSPS_POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+_POOL_SLOTS = threading.Semaphore(POOL_WORKERS_MAX)
+
+def _acquire_pool_slots(wanted: int, cancel=None, on_wait=None) -> int:
+    """
+    Lấy tối đa `wanted` suất process con: chờ tới khi có ít nhất 1 (on_wait() gọi 1 lần nếu phải chờ;
+    cancel được set -> JobCancelled), các suất còn lại chỉ lấy nếu đang rảnh. Trả về số suất đã lấy.
+    """
+    if not _POOL_SLOTS.acquire(blocking=False):
+        if on_wait is not None:
+            on_wait()
+        while not _POOL_SLOTS.acquire(timeout=PROGRESS_POLL_SECONDS):
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled()
+    got = 1
+    while got < wanted and _POOL_SLOTS.acquire(blocking=False):
+        got += 1
+    return got
+
+@staged()
+def run_programs(jobs: dict, max_workers: int = None, on_progress=None, cancel=None, on_result=None) -> dict:
+    """
+    Xử lý nhiều CT song song.
+    jobs = {CT: {"tb1": file, "tb2": file, "ds1": file | None, "ds2": file | None}}
+    - Mỗi file cần đọc là 1 nút; file trùng nội dung chỉ đọc 1 lần (file doanh số
+      dùng chung cho nhiều CT -> 1 lần mở, đọc sheet của mọi CT cần).
+    - Các nút chạy trên process pool; CT nào đủ dữ liệu vào thì gộp/tính trạng thái ngay.
+    - Lỗi của CT nào chỉ nằm ở CT đó.
+    on_progress(CT, số file đã xong, tổng số file, thông điệp) được gọi ở process chính,
+    cả khi xong từng file lẫn theo từng bước / số dòng đã đọc (kể cả trong process con).
+    cancel: threading.Event; được set -> dừng ở bước kế tiếp, ném JobCancelled.
+    on_result(CT, kết quả) được gọi ngay khi từng CT xong (không chờ các CT khác).
+    Trả về {CT: (result, m1, m2) hoặc Exception}.
+    """
+    results, nodes, needs = {}, {}, {}
+    values, errors = {}, {}  # kết quả / lỗi theo nút (kind, digest)
+    for prog, files in jobs.items():
+        if files.get("tb1") is None or files.get("tb2") is None:
+            results[prog] = ValueError("Cần đủ 2 file trưng bày")
+            continue
+        needs[prog] = {}
+        try:
+            for slot in ("tb1", "tb2", "ds1", "ds2"):
+                src = files.get(slot)
+                if src is None:
+                    continue
+                kind = "display" if slot.startswith("tb") else "sales"
+                digest = file_digest(src)
+                node = nodes.setdefault((kind, digest), {"src": src, "programs": []})
+                if kind == "sales" and prog not in node["programs"]:
+                    node["programs"].append(prog)
+                needs[prog][slot] = (kind, digest)
+        except Exception as e:
+            results[prog] = e
+            needs.pop(prog)
+
+    def report(prog, msg):
+        if on_progress is not None:
+            done = sum(1 for n in needs[prog].values() if n in values or n in errors)
+            on_progress(prog, done, len(needs[prog]), msg)
+
+    def step_message(info):
+        if "rows" in info:
+            return f"đã đọc {info['rows']:,} dòng"
+        return PROGRESS_STAGE_LABELS.get(info["stage"], info["stage"]) + "..."
+
+    def node_hook(node_key):
+        """Hook tiến độ khi đọc 1 file ngay trong luồng này (báo cho mọi CT cần file đó)."""
+        def hook(info):
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled()
+            for prog, slots in needs.items():
+                if prog not in results and node_key in slots.values():
+                    report(prog, step_message(info))
+        return hook
+
+    def program_hook(prog):
+        def hook(info):
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled()
+            report(prog, step_message(info))
+        return hook
+
+    def finish(node_key):
+        for prog, slots in needs.items():
+            if prog in results or node_key not in slots.values():
+                continue
+            report(prog, "Đã đọc xong 1 file")
+            if not all(n in values or n in errors for n in slots.values()):
+                continue
+            try:
+                for n in slots.values():
+                    if n in errors:
+                        raise errors[n]
+                sales = {}
+                for slot in ("ds1", "ds2"):
+                    if slot in slots:
+                        sales[slot] = values[slots[slot]][prog]
+                        if isinstance(sales[slot], Exception):
+                            raise sales[slot]
+                with progress_scope(program_hook(prog)):
+                    results[prog] = build_program_result(
+                        prog, values[slots["tb1"]], values[slots["tb2"]],
+                        sales.get("ds1"), sales.get("ds2"))
+                report(prog, "Hoàn tất")
+            except JobCancelled:
+                raise
+            except Exception as e:
+                results[prog] = e
+                report(prog, f"Lỗi: {e}")
+            if on_result is not None:
+                on_result(prog, results[prog])
+
+    pending = {}
+    for key, node in nodes.items():
+        kind, digest = key
+        cached = _cached_task_result(kind, digest, tuple(node["programs"]))
+        if cached is not None:
+            values[key] = cached
+        else:
+            pending[key] = node
+    for key in list(values):
+        finish(key)
+
+    if pending:
+        workers = max_workers or min(len(pending), os.cpu_count() or 1)
+        if workers <= 1:
+            for key, node in pending.items():
+                try:
+                    with progress_scope(node_hook(key)):
+                        values[key] = _parse_task(key[0], node["src"], key[1], tuple(node["programs"]))
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    errors[key] = e
+                finish(key)
+        else:
+            def waiting():  # mọi suất process con đang bận (việc khác của server)
+                for prog in needs:
+                    if prog not in results:
+                        report(prog, "Chờ lượt đọc file...")
+            slots = _acquire_pool_slots(min(workers, POOL_WORKERS_MAX), cancel, waiting)
+            try:
+                # spawn: process con import lại core (không kéo theo Streamlit / luồng của server)
+                ctx = multiprocessing.get_context("spawn")
+                progress_queue, cancel_event = ctx.Queue(), ctx.Event()
+                pool = ProcessPoolExecutor(max_workers=slots, mp_context=ctx, initializer=_init_progress_worker,
+                                           initargs=(progress_queue, cancel_event))
+                # luồng gọi đang ghi chẩn đoán -> process con ghi cùng chế độ, gửi record về để gộp
+                recording = getattr(_diag_local, "records", None) is not None
+                memory = getattr(_diag_local, "memory", False)
+                try:
+                    futures = {
+                        (pool.submit(_parse_task_recorded, memory, key[0], _payload(node["src"]), key[1],
+                                     tuple(node["programs"])) if recording else
+                         pool.submit(_parse_task, key[0], _payload(node["src"]), key[1],
+                                     tuple(node["programs"]))): key
+                        for key, node in pending.items()
+                    }
+                    running = set(futures)
+                    while running:
+                        done, running = wait(running, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                        while True:  # tiến độ từ process con
+                            try:
+                                task, info = progress_queue.get_nowait()
+                            except queue.Empty:
+                                break
+                            if task in nodes and task not in values and task not in errors:
+                                node_hook(task)(info)
+                        if cancel is not None and cancel.is_set():
+                            raise JobCancelled()
+                        for fut in done:
+                            key = futures[fut]
+                            try:
+                                out = fut.result()
+                                if recording:
+                                    out, records, started = out
+                                    merge_diagnostics(records, started, process="con")
+                                    if isinstance(out, Exception):
+                                        raise out
+                                values[key] = out
+                            except Exception as e:
+                                errors[key] = e
+                            finish(key)
+                except BaseException:
+                    # huỷ / lỗi: không chờ file đang đọc dở, process con tự dừng ở lần báo tiến độ kế tiếp
+                    cancel_event.set()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+                pool.shutdown()
+            finally:
+                for _ in range(slots):
+                    _POOL_SLOTS.release()
+    return results
+
+class BackgroundJob:
+    """
+    Chạy run_programs trên 1 luồng nền: nơi gọi (giao diện) không bị chặn, đọc trạng thái
+    bất cứ lúc nào qua state / progress / results, huỷ bằng cancel().
+    state: 'running' | 'done' | 'cancelled' | 'error' (lỗi ngoài từng CT, xem error).
+    progress = {CT: (số file đã xong, tổng số file, thông điệp)}; results = {CT: kết quả},
+    có dần khi từng CT xong. diagnostics=True -> ghi thời gian / bộ nhớ từng bước của việc
+    (memory: đo cả peak bộ nhớ) vào self.diagnostics khi việc kết thúc.
+    """
+    def __init__(self, jobs: dict, max_workers: int = None, diagnostics: bool = False, memory: bool = False):
+        self.programs = list(jobs)
+        self.progress = {prog: (0, 0, "Đang chờ...") for prog in jobs}
+        self.results = {}
+        self.state, self.error = "running", None
+        self.started, self.finished = time.time(), None
+        self.diagnostics = None  # record chẩn đoán của cả việc (khi diagnostics=True), có khi việc kết thúc
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(jobs, max_workers, diagnostics, memory),
+                                        name="dsps-job", daemon=True)
+        self._thread.start()
+
+    def _on_progress(self, prog, done, total, msg):
+        self.progress[prog] = (done, total, msg)
+
+    def _run(self, jobs, max_workers, diagnostics, memory):
+        # chẩn đoán ghi theo luồng: luồng của việc nền tự bật, không dùng phiên ghi của nơi gọi
+        if diagnostics:
+            start_diagnostics(memory=memory)
+        try:
+            out = run_programs(jobs, max_workers=max_workers, on_progress=self._on_progress,
+                               cancel=self._cancel, on_result=self.results.__setitem__)
+            self.results.update(out)
+            self.state = "done"
+        except JobCancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            self.error, self.state = e, "error"
+        finally:
+            if diagnostics:
+                self.diagnostics = stop_diagnostics()
+            self.finished = time.time()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    def wait(self, timeout: float = None) -> bool:
+        """Chờ việc kết thúc (dùng cho CLI / kiểm thử). True nếu đã kết thúc."""
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+# ================== Kho nhiều tháng (lưu trên đĩa theo CT) ==================
+# Mỗi CT 1 thư mục: months.json (thứ tự tháng) + mỗi tháng 1 file số suất & 1 file doanh số
+# đã chuẩn hoá. Thêm tháng mới chỉ đọc file của tháng đó; đánh giá chỉ nạp các tháng trong cửa sổ.
+# Tháng xếp theo thời gian đọc từ nhãn (month_period_key), trừ khi người dùng đã tự sắp (store_move_month).
+# Kho dùng chung cho mọi người dùng của server: thêm tháng đã có phải xác nhận ghi đè (overwrite=True).
+MONTH_STORE_DIR = os.environ.get("DSPS_STORE_DIR", os.path.join(os.path.expanduser("~"), ".dsps_store"))
+_MONTH_STORE_LOCK = threading.Lock()
+
+class MonthExistsError(ValueError):
+    """Tháng đã có trong kho; store_append_month(..., overwrite=True) để ghi đè."""
+    def __init__(self, prog: str, label: str, added_at: str = None):
+        self.prog, self.label, self.added_at = prog, label, added_at
+        when = f" (thêm lúc {added_at})" if added_at else ""
+        super().__init__(f"Kho của CT {prog} đã có tháng '{label}'{when}")
+
+def month_period_key(label) -> tuple:
+    """
+    Khoá sắp nhãn tháng theo thời gian: (năm, tháng). Đọc được '07/2025', '2025-07', 'T07/2025',
+    'Tháng 7 năm 2025'; không có năm ('T07') -> năm 0; không có tháng -> xếp sau cùng.
+    """
+    text = str(label)
+    year = re.search(r"(?<!\d)(?:19|20)\d{2}(?!\d)", text)
+    if year:
+        text = text[:year.start()] + " " + text[year.end():]
+    month = re.search(r"(?<!\d)(0?[1-9]|1[0-2])(?!\d)", text)
+    return (int(year.group()) if year else 0, int(month.group(1)) if month else 13)
+
+def _store_dir(prog: str) -> str:
+    return os.path.join(MONTH_STORE_DIR, re.sub(r"[^0-9A-Za-z_-]", "_", prog))
+
+def _store_read(prog: str) -> dict:
+    """months.json: {"months": [{"label", "slots", "sales", "added_at"}, ...], "order": "period" | "manual"}."""
+    path = os.path.join(_store_dir(prog), "months.json")
+    if not os.path.exists(path):
+        return {"months": [], "order": "period"}
+    with open(path, encoding="utf-8") as fh:
+        data = json.load(fh)
+    if data.get("order") != "manual":  # kho cũ (theo thứ tự thêm) cũng được xếp lại theo thời gian
+        data["months"].sort(key=lambda e: month_period_key(e["label"]))
+        data["order"] = "period"
+    return data
+
+def _store_manifest(prog: str) -> list:
+    """[{"label": tháng, "slots": tên file, "sales": tên file | None, ...}, ...] từ cũ tới mới."""
+    return _store_read(prog)["months"]
+
+def _manifest_writer(months: list, order: str = "period"):
+    def write(path):
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump({"months": months, "order": order}, fh, ensure_ascii=False, indent=1)
+    return write
+
+def store_months(prog: str) -> list:
+    """Các nhãn tháng đã có trong kho của CT (từ cũ tới mới)."""
+    return [e["label"] for e in _store_manifest(prog)]
+
+@staged()
+def store_append_month(prog: str, display_file, sales_file=None, overwrite: bool = False) -> str:
+    """
+    Thêm 1 tháng vào kho của CT: chỉ đọc file trưng bày (+ doanh số) của tháng đó
+    (qua cache đọc file), xếp vào đúng vị trí theo thời gian. Tháng đã có -> MonthExistsError,
+    trừ khi overwrite=True (thay dữ liệu tại chỗ). Trả về nhãn tháng.
+    """
+    slots, m = month_slots(read_display_cached(display_file))
+    sales = None
+    if sales_file is not None:
+        sales = read_sales_cached(sales_file, [prog])[prog]
+        if isinstance(sales, Exception):
+            raise sales
+
+    folder = _store_dir(prog)
+    stem = hashlib.blake2b(m.encode("utf-8"), digest_size=8).hexdigest()
+    with _MONTH_STORE_LOCK:
+        data = _store_read(prog)
+        months = data["months"]
+        labels = [e["label"] for e in months]
+        if m in labels and not overwrite:
+            raise MonthExistsError(prog, m, months[labels.index(m)].get("added_at"))
+        os.makedirs(folder, exist_ok=True)
+        entry = {"label": m, "slots": f"slots-{stem}.parquet",
+                 "sales": f"sales-{stem}.parquet" if sales is not None else None,
+                 "added_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        _atomic_write(os.path.join(folder, entry["slots"]),
+                     lambda p: slots.to_parquet(p, index=False))
+        if sales is not None:
+            _atomic_write(os.path.join(folder, entry["sales"]),
+                         lambda p: sales.to_parquet(p, index=False))
+        if m in labels:
+            months[labels.index(m)] = entry  # giữ vị trí tháng trong thứ tự
+        else:
+            key = month_period_key(m)
+            pos = next((i for i, e in enumerate(months) if month_period_key(e["label"]) > key), len(months))
+            months.insert(pos, entry)
+        _atomic_write(os.path.join(folder, "months.json"), _manifest_writer(months, data["order"]))
+    return m
+
+def store_move_month(prog: str, label: str, offset: int) -> list:
+    """Dời 1 tháng lên (offset < 0, cũ hơn) / xuống trong thứ tự của kho; từ đó kho giữ thứ tự tự sắp."""
+    with _MONTH_STORE_LOCK:
+        months = _store_manifest(prog)
+        labels = [e["label"] for e in months]
+        if label not in labels:
+            raise ValueError(f"Kho của CT {prog} chưa có tháng '{label}'")
+        i = labels.index(label)
+        j = min(max(i + offset, 0), len(months) - 1)
+        months.insert(j, months.pop(i))
+        _atomic_write(os.path.join(_store_dir(prog), "months.json"), _manifest_writer(months, "manual"))
+    return [e["label"] for e in months]
+
+def store_remove_month(prog: str, label: str):
+    """Bỏ 1 tháng khỏi kho của CT."""
+    folder = _store_dir(prog)
+    with _MONTH_STORE_LOCK:
+        data = _store_read(prog)
+        months = data["months"]
+        keep = [e for e in months if e["label"] != label]
+        _atomic_write(os.path.join(folder, "months.json"), _manifest_writer(keep, data["order"]))
+        for e in months:
+            if e["label"] == label:
+                for name in (e["slots"], e["sales"]):
+                    if name and os.path.exists(os.path.join(folder, name)):
+                        os.remove(os.path.join(folder, name))
+
+@staged()
+def evaluate_window(prog: str, window: int = 2, end: str = None, rules=None):
+    """
+    Đánh giá cửa sổ `window` tháng liên tiếp trong kho (theo thứ tự thời gian), kết thúc ở tháng
+    `end` (mặc định tháng mới nhất). Chỉ nạp dữ liệu các tháng trong cửa sổ.
+    Trả về (result, [tháng...]); window=2 cho kết quả giống build_program_result.
+    """
+    entries = _store_manifest(prog)
+    labels = [e["label"] for e in entries]
+    if end is not None:
+        if end not in labels:
+            raise ValueError(f"Kho của CT {prog} chưa có tháng '{end}'")
+        entries = entries[:labels.index(end) + 1]
+    if window < 1 or len(entries) < window:
+        raise ValueError(f"Kho của CT {prog} mới có {len(entries)} tháng, cần {window} tháng")
+    entries = entries[len(entries) - window:]
+    months = [e["label"] for e in entries]
+
+    folder = _store_dir(prog)
+    result = None
+    for e in entries:
+        slots = pd.read_parquet(os.path.join(folder, e["slots"]))
+        result = slots if result is None else result.merge(slots, on=BASE_COLS, how="outer")
+    result = result.fillna(0)
+    for m in months:
+        result[f"Giai đoạn - {m}"] = result[f"Giai đoạn - {m}"].astype(int)
+    result = result.sort_values(["Mã NPP","Tên NPP","Tên khách hàng"]).reset_index(drop=True)
+
+    codes, index = customer_key_codes(result["Mã khách hàng"])
+    report = _key_report_base(codes, index)
+    for e in entries:
+        col = f"Doanh số - {e['label']}"
+        if e["sales"] is None:
+            result[col] = 0
+            continue
+        sales = pd.read_parquet(os.path.join(folder, e["sales"]))
+        values, _, report["months"][e["label"]] = lookup_sales(codes, index, sales)
+        result[col] = values.astype(int)
+
+    result["TRẠNG THÁI"] = ""
+    result = apply_status_months(result, months, prog, rules)
+    result.attrs[KEY_REPORT_ATTR] = report
+    return result, months
+
+# ================== Chỉ mục lọc kết quả ==================
+# Dựng 1 lần / lần xử lý; mỗi lần lọc chỉ ghép mask boolean trên mảng có sẵn (không copy frame).
+FILTER_CATEGORY_COLS = {"npp_code": "Mã NPP", "npp_name": "Tên NPP", "status": "TRẠNG THÁI"}
+
+def _search_key(s: pd.Series) -> pd.Series:
+    """Chuẩn hoá chuỗi tìm kiếm: Unicode NFC + chữ thường."""
+    return s.astype(str).str.normalize("NFC").str.lower()
+
+@staged()
+def build_filter_index(df: pd.DataFrame, months: list) -> dict:
+    """
+    Chỉ mục lọc cho kết quả df (theo thứ tự dòng của df):
+      - npp_code / npp_name / status: (mã int32 từng dòng, danh sách giá trị đã sắp xếp)
+      - search: khoá 'mã kh' + '\\x1f' + 'tên kh' đã chuẩn hoá (mảng Arrow nếu có pyarrow)
+      - sales / slots: {tháng: mảng int64}
+      - orders: cache thứ tự dòng theo cột sắp xếp (điền dần bởi sort_order)
+    """
+    index = {"n": len(df), "orders": {}}  # orders: cache thứ tự sắp xếp (sort_order)
+    for key, col in FILTER_CATEGORY_COLS.items():
+        values = df[col]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(str)
+        codes, uniques = pd.factorize(values, sort=True)
+        index[key] = (codes.astype(np.int32), [str(v) for v in uniques])
+    keys = _search_key(df["Mã khách hàng"]) + "\x1f" + _search_key(df["Tên khách hàng"])
+    try:
+        import pyarrow as pa
+        index["search"] = pa.array(keys.to_numpy(dtype=object), type=pa.string())
+    except ImportError:
+        index["search"] = keys.reset_index(drop=True)
+    index["sales"] = {m: pd.to_numeric(df[f"Doanh số - {m}"], errors="coerce").fillna(0)
+                           .to_numpy(dtype=np.int64) for m in months}
+    index["slots"] = {m: pd.to_numeric(df[f"Giai đoạn - {m}"], errors="coerce").fillna(0)
+                           .to_numpy(dtype=np.int64) for m in months}
+    return index
+
+def filter_mask(index: dict, npp_codes=(), npp_names=(), statuses=(), keyword: str = "",
+                min_sales: dict = None, min_slots: dict = None) -> np.ndarray:
+    """
+    Mask boolean các dòng thoả bộ lọc (điều kiện trống = bỏ qua).
+    keyword: tìm chuỗi con (không phân biệt hoa/thường) trong Mã KH hoặc Tên KH.
+    min_sales / min_slots: {tháng: ngưỡng tối thiểu}.
+    """
+    mask = np.ones(index["n"], dtype=bool)
+    for key, selected in (("npp_code", npp_codes), ("npp_name", npp_names), ("status", statuses)):
+        if selected:
+            codes, uniques = index[key]
+            wanted = set(map(str, selected))
+            mask &= np.isin(codes, [i for i, v in enumerate(uniques) if v in wanted])
+    # doanh số luôn so ngưỡng (ngưỡng 0 vẫn loại doanh số âm); số suất chỉ xét khi ngưỡng > 0
+    for m, limit in (min_sales or {}).items():
+        mask &= index["sales"][m] >= int(limit)
+    for m, limit in (min_slots or {}).items():
+        if int(limit) > 0:
+            mask &= index["slots"][m] >= int(limit)
+    keyword = unicodedata.normalize("NFC", keyword.strip()).lower()
+    if keyword and mask.any():
+        search = index["search"]
+        if isinstance(search, pd.Series):
+            mask &= search.str.contains(keyword, regex=False).to_numpy(dtype=bool)
+        else:
+            import pyarrow.compute as pc
+            rows = np.flatnonzero(mask)
+            # chỉ dò chuỗi trên các dòng còn lại sau các bộ lọc rẻ hơn
+            sub = search if len(rows) == len(mask) else search.take(rows)
+            hit = pc.match_substring(sub, keyword).to_numpy(zero_copy_only=False)
+            mask[rows[~hit]] = False
+    return mask
+
+def sort_order(df: pd.DataFrame, col: str = None, ascending: bool = True, cache: dict = None) -> np.ndarray:
+    """
+    Chỉ số dòng (vị trí) của df khi sắp theo col (ổn định); col=None -> thứ tự gốc.
+    Cột chữ / categorical sắp theo mã factorize; cache (dict) giữ thứ tự đã tính cho lần sau.
+    """
+    key = (col, ascending)
+    if cache is not None and key in cache:
+        return cache[key]
+    n = len(df)
+    if col is None:
+        order = np.arange(n, dtype=np.int32 if n < 2**31 else np.int64)
+        if not ascending:
+            order = order[::-1].copy()
+    else:
+        s = df[col]
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            values = s.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = pd.factorize(s if isinstance(s.dtype, pd.CategoricalDtype) else s.astype(str), sort=True)[0]
+        order = np.argsort(values if ascending else -values, kind="stable")
+        if n < 2**31:
+            order = order.astype(np.int32)
+    if cache is not None:
+        cache[key] = order
+    return order
+
+def visible_rows(order: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """Các dòng theo thứ tự order mà mask giữ lại (mask=None -> tất cả)."""
+    if mask is None or mask.all():
+        return order
+    return order[mask[order]]
+
+@staged()
+def npp_summary(df: pd.DataFrame, months: list) -> pd.DataFrame:
+    """
+    Bảng tổng hợp theo (Mã NPP, Tên NPP): số KH từng TRẠNG THÁI, tỷ lệ đạt
+    (Đạt / (Đạt + Không Đạt), không tính 'Không xét'), tổng số suất & doanh số từng tháng.
+    Dòng cuối 'TỔNG' cộng toàn bộ. Tính 1 lần bằng 1 groupby khi xử lý.
+    """
+    status = df["TRẠNG THÁI"]
+    parts = {"Mã NPP": df["Mã NPP"], "Tên NPP": df["Tên NPP"]}
+    for label in STATUS_LABELS:
+        parts[label] = (status == label).to_numpy(dtype=np.int64)
+    value_cols = [f"Giai đoạn - {m}" for m in months] + [f"Doanh số - {m}" for m in months]
+    for c in value_cols:
+        parts[c] = df[c].to_numpy(dtype=np.int64)
+    table = (pd.DataFrame(parts)
+               .groupby(["Mã NPP", "Tên NPP"], observed=True, sort=True, dropna=False)
+               .sum().reset_index())
+    for c in ("Mã NPP", "Tên NPP"):
+        table[c] = table[c].astype(str)
+    total = table[STATUS_LABELS + value_cols].sum()
+    table.loc[len(table)] = {"Mã NPP": "TỔNG", "Tên NPP": "", **total.to_dict()}
+    table.insert(2, "Số KH", table[STATUS_LABELS].sum(axis=1))
+    judged = table["Đạt"] + table["Không Đạt"]
+    rate = (table["Đạt"] / judged.where(judged > 0) * 100).round(1)
+    table.insert(6, "Tỷ lệ đạt (%)", rate)
+    return table
+
+# ================== Xuất 1 file gộp nhiều CT ==================
+CONSOLIDATED_OVERVIEW_SHEET = "Tổng quan"
+OVERVIEW_COLS = ["Mã NPP", "Tên NPP", "Số KH"] + STATUS_LABELS + ["Tỷ lệ đạt (%)"]
+
+def program_overview(results: dict, summaries: dict = None) -> pd.DataFrame:
+    """
+    Bảng tổng quan số KH từng TRẠNG THÁI theo CT & NPP (mỗi CT kết thúc bằng dòng 'TỔNG').
+    results = {CT: (df, [tháng...])}; summaries = {CT: npp_summary đã tính sẵn} (tuỳ chọn).
+    """
+    parts = []
+    for prog, (df, months) in results.items():
+        table = (summaries or {}).get(prog)
+        if table is None:
+            table = npp_summary(df, months)
+        table = table[OVERVIEW_COLS].copy()
+        table.insert(0, "Giai đoạn", " – ".join(months))
+        table.insert(0, "CT", prog)
+        parts.append(table)
+    if not parts:
+        return pd.DataFrame(columns=["CT", "Giai đoạn"] + OVERVIEW_COLS)
+    return pd.concat(parts, ignore_index=True)
+
+@staged()
+def export_consolidated(results: dict, target=None, summaries: dict = None, temp_dir: str = None) -> str:
+    """
+    1 file .xlsx cho nhiều CT: sheet 'Tổng quan' (program_overview) + mỗi CT 1 sheet
+    đúng layout export_excel_layout. results = {CT: (df, [tháng...])}.
+    Ghi thẳng ra file (target; mặc định file tạm mới trong temp_dir, vd thư mục UploadSpool của phiên)
+    theo từng khối dòng -> bộ nhớ không tăng theo số CT / số dòng. Trả về đường dẫn file
+    (người gọi tự xoá file tạm).
+    """
+    temp = target is None
+    if temp:
+        fd, target = tempfile.mkstemp(prefix="dsps_gop_", suffix=".xlsx", dir=temp_dir)
+        os.close(fd)
+    sheets = [(prog, df, list(months)) for prog, (df, months) in results.items()]
+    try:
+        _write_layout_workbook(target, sheets,
+                               overview=(CONSOLIDATED_OVERVIEW_SHEET, program_overview(results, summaries)))
+    except BaseException:
+        if temp:
+            os.remove(target)
+        raise
+    return target
+
+# ================== Tóm tắt & danh sách cảnh báo / huỷ ==================
+def status_summary(df: pd.DataFrame, by_npp: bool = False):
+    """
+    Đếm số KH theo TRẠNG THÁI. by_npp=True -> list dòng theo (Mã NPP, Tên NPP),
+    mỗi dòng có số KH của từng trạng thái.
+    """
+    status = df["TRẠNG THÁI"].astype(str)
+    if not by_npp:
+        counts = status.value_counts()
+        return {label: int(counts.get(label, 0)) for label in STATUS_LABELS}
+    table = (pd.crosstab([df["Mã NPP"], df["Tên NPP"]], status)
+               .reindex(columns=STATUS_LABELS, fill_value=0)
+               .reset_index())
+    return [{k: (int(v) if k in STATUS_LABELS else v) for k, v in row.items()}
+            for row in table.to_dict("records")]
+
+def warning_cancel_lists(df: pd.DataFrame, m1: str, m2: str):
+    """
+    Trả về (cảnh báo, huỷ):
+      - huỷ     : TRẠNG THÁI 'Không Đạt'
+      - cảnh báo: 'Đạt' nhưng doanh số tháng gần nhất (m2) dưới mức tối thiểu
+                  -> tháng sau không đạt tiếp sẽ thành 'Không Đạt'.
+    """
+    status = df["TRẠNG THÁI"].astype(str)
+    cancel = df[status == "Không Đạt"]
+    below = df[f"Doanh số - {m2}"] < df[f"Tối thiểu - {m2}"]
+    warning = df[(status == "Đạt") & below]
+    return warning, cancel